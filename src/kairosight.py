@@ -11,10 +11,12 @@ from decimal import Decimal
 from pathlib import Path, PurePath
 from random import random
 
-from util.preparation import open_stack, reduce_stack, mask_generate, mask_apply, img_as_uint, rescale
-from util.processing import normalize_stack, filter_drift, invert_signal, \
-    filter_spatial, calculate_snr, map_snr, find_tran_act
-from util.analysis import find_tran_start, find_tran_end, calc_tran_duration, calc_ensemble, map_tran_analysis, DUR_MAX
+from util.preparation import open_stack, TiffStack, reduce_stack, mask_generate, mask_apply, \
+    stack_key, save_stage, load_stage, latest_stage
+from util.processing import normalize_stack, filter_drift_stack, invert_stack, \
+    filter_spatial_stack, calculate_snr, map_snr, find_tran_act
+from util.analysis import find_tran_start, find_tran_end, calc_tran_duration, calc_ensemble, map_tran_analysis, \
+    TransientFeatures, DUR_MAX
 from ui.KairoSight_WindowMDI import Ui_WindowMDI
 from ui.KairoSight_WindowMain import Ui_WindowMain
 from PyQt5.QtCore import QObject, pyqtSignal, Qt
@@ -32,6 +34,8 @@ from tests.intergration.test_Map import fontsize3, fontsize4, marker1, marker3,
     color_snr, cmap_snr, cmap_activation, ACT_MAX_PIG_LV, ACT_MAX_PIG_WHOLE, cmap_duration, \
     add_map_colorbar_stats
 
+FEEDBACK_INTERVAL = 1  # minimum seconds between progress lines of long steps
+
 
 class WindowMDI(QMainWindow, Ui_WindowMDI):
     """Customization for Ui_MDIMainWindow, and MDI main window"""
@@ -120,13 +124,26 @@ class WindowMain(QWidget, Ui_WindowMain):
         self.file_purepath = file_purepath
         self.file_path_str = str(self.file_purepath)
         self.project_path_str = str(self.file_purepath.parent) + '\\' + str(self.file_purepath.stem) + '_ks_project'
-        self.video_data_raw, self.stack_real_meta = open_stack(source=self.file_path_str)
+        # Pixel data stays on disk until read, the video is decoded once below
+        self.video_data_raw, self.stack_real_meta = open_stack(source=self.file_path_str, lazy=True)
+        if type(self.video_data_raw) is TiffStack:
+            # Compressed frames can't be memory-mapped, decode them once and release the file
+            video_data_raw = self.video_data_raw
+            self.video_data_raw = np.asarray(video_data_raw)
+            video_data_raw.close()
         self.frame_n = self.video_data_raw.shape[0]
         self.width_raw, self.height_raw = self.video_data_raw.shape[2], self.video_data_raw.shape[1]
 
         # Copy imported video to preserve it
-        self.video_data = self.video_data_raw.copy()
+        self.video_data = np.array(self.video_data_raw)
         self.video_time = None
+        # Keys of the imported video and of the latest stored step output (see store_stage),
+        # the video's from its file's name, size, modification time and shape rather than all of its pixels
+        file_stat = os.stat(self.file_path_str)
+        self.stage_key_raw = stack_key(self.file_purepath.name, 'Open',
+                                       {'size': file_stat.st_size, 'mtime': file_stat.st_mtime_ns,
+                                        'shape': self.video_data_raw.shape})
+        self.stage_key = self.stage_key_raw
 
         # Setup project directory and files
         self.project_props_prp = {'fps': None, 'scale': None, 'type': None, 'subject': None,
@@ -171,6 +188,8 @@ class WindowMain(QWidget, Ui_WindowMain):
         # Set histogram to image levels and use a manual range
         self.graphicsView.histogram.setLevels(self.video_data.min(), self.video_data.max())
         self.graphicsView.histogram.setHistogramRange(self.video_data.min(), self.video_data.max())
+        # Resume an existing project from its latest stored step output
+        self.resume_stage()
         self.WindowMDI.status_print('- - -')
 
     def __del__(self):
@@ -214,6 +233,68 @@ class WindowMain(QWidget, Ui_WindowMain):
                 with open(self.project_path_str + '\\' + str(self.file_purepath.stem) + '.ks_anys', "w") as outfile:
                     json.dump(self.project_props_ans, outfile)
 
+    def store_stage(self, step_name, params, parent=None):
+        """Save the video output by a step to the project folder, keyed by its input and parameters"""
+        if self.mask is not None:
+            stack, extras = self.video_data_unmasked, {'mask': self.mask}
+        else:
+            stack, extras = self.video_data, None
+        parent = self.stage_key if parent is None else parent
+        self.stage_key = save_stage(self.project_path_str, stack, step_name, parent, params, extras,
+                                    progress=self.feedback_progress('Stored {} chunks'.format(step_name)))
+
+    def resume_stage(self):
+        """Load the latest step output stored for this video and pick up the steps after it,
+        instead of re-running the steps up to it"""
+        key = latest_stage(self.project_path_str, self.stage_key_raw)
+        if key is None:
+            return
+        stack, meta, extras = load_stage(self.project_path_str, key)
+        if stack is None:
+            return
+        self.stage_key = key
+        self.video_data_unmasked = stack
+        if 'mask' in extras:
+            self.mask = extras['mask']
+            self.video_data = mask_apply(stack, self.mask)
+        else:
+            self.video_data = stack
+        if self.project_props_prp['fps']:
+            # Generate array of timestamps in ms, as the Properties step does
+            fpms = self.project_props_prp['fps'] / 1000
+            t_final = math.floor(self.video_data.shape[0] / fpms)
+            self.video_time = np.linspace(start=0, stop=t_final, num=self.video_data.shape[0])
+
+        # Refresh the view
+        self.frame_n = self.video_data.shape[0]
+        self.horizontalScrollBar.setMaximum(self.frame_n)
+        self.lcdNumber_frame_n.display(self.frame_n)
+        self.graphicsView.histogram.setLevels(self.video_data.min(), self.video_data.max())
+        self.graphicsView.histogram.setHistogramRange(self.video_data.min(), self.video_data.max())
+        self.trace_crosshair.setSize([self.video_data.shape[2] // 20, self.video_data.shape[1] // 20])
+        self.update_video(frame=self.frame_current)
+        self.update_trace()
+
+        # Mark the steps up to the stored one as done, Properties stays available if it was never applied
+        skip_checkboxes = {self.buttonNextPrep_Bin: self.checkBoxSkipPrep_Bin,
+                           self.buttonNextPrep_Mask: self.checkBoxSkipPrep_Mask,
+                           self.buttonNextProc_Filter: self.checkBoxSkipProc_Filter,
+                           self.buttonNextProc_SNR: self.checkBoxSkipProc_SNR,
+                           self.buttonNextAnalysis_TimeCrop: self.checkBoxSkipAnalysis_TimeCrop}
+        steps = [step_button.accessibleName() for step_button in self.next_buttons]
+        stage_button = self.next_buttons[steps.index(meta['stage'])]
+        for step_button in self.next_buttons[:steps.index(meta['stage']) + 1]:
+            if step_button is not self.buttonNextPrep_Props or self.video_time is not None:
+                step_button.setEnabled(False)
+            if step_button in skip_checkboxes:
+                skip_checkboxes[step_button].setEnabled(False)
+        self.step_proceed(stage_button)
+        self.feedback_action('Loaded stored {} step output : {}'.format(meta['stage'], meta['params']))
+        if self.video_time is None:
+            self.feedback_action('Resumed after step {}, apply Properties before Analysis'.format(meta['stage']))
+        else:
+            self.feedback_action('Resumed after step {}'.format(meta['stage']), success=True)
+
     def update_video(self, frame=0):
         """Updates the video frame drawn to its canvas"""
         self.frame_current = frame
@@ -488,9 +569,8 @@ class WindowMain(QWidget, Ui_WindowMain):
         frame_bright = self.video_data_raw[frame_bright_idx]
         frame_scale = self.project_props_prp['scale']
         if self.project_props_prp['rescale'] != 1:
-            # frame_bright = reduce_stack(self.video_data_raw[frame_bright_idx], self.project_props_prp['rescale'])
-            reduction_factor = 1 / self.project_props_prp['rescale']
-            frame_bright = img_as_uint(rescale(frame_bright, reduction_factor, anti_aliasing=True, multichannel=False))
+            # bin the frame as the Bin step binned the video
+            frame_bright = reduce_stack(frame_bright[np.newaxis], self.project_props_prp['rescale'])[0]
             frame_scale = frame_scale / self.project_props_prp['rescale']
 
         frame_cmap_norm = colors.Normalize(vmin=frame_bright.min(),
@@ -574,15 +654,20 @@ class WindowMain(QWidget, Ui_WindowMain):
                 # Attempt Bin actions
                 self.update_parameters(step_name)
                 if self.project_props_prp['rescale'] == 1:
-                    self.video_data = self.video_data_raw
+                    self.video_data = np.array(self.video_data_raw)
                 else:
-                    self.video_data = reduce_stack(self.video_data_raw, self.project_props_prp['rescale'])
+                    self.video_data = reduce_stack(np.asarray(self.video_data_raw), self.project_props_prp['rescale'],
+                                                   workers=os.cpu_count())
+                # Binning starts over from the imported video, without a mask
+                self.mask = None
+                self.video_data_unmasked = self.video_data
                 self.graphicsView.histogram.setLevels(self.video_data.min(), self.video_data.max())
                 self.graphicsView.histogram.setHistogramRange(self.video_data.min(), self.video_data.max())
                 self.trace_crosshair.setSize([self.video_data.shape[2] // 20, self.video_data.shape[1] // 20])
                 self.traceXSpinBox.setValue(round(self.trace_xy[0] / self.project_props_prp['rescale']))
                 self.traceYSpinBox.setValue(round(self.trace_xy[1] / self.project_props_prp['rescale']))
                 self.update_inputs(self.kernelPixelsSpinBox)
+                self.store_stage(step_name, {'rescale': self.project_props_prp['rescale']}, parent=self.stage_key_raw)
             elif step_name == 'Mask':
                 # Attempt Mask actions
                 self.update_parameters(step_name)
@@ -612,6 +697,7 @@ class WindowMain(QWidget, Ui_WindowMain):
                 fig_mask.savefig(self.project_path_str + '\\' + 'prep_mask_{}.png'.format(datetime))
                 self.video_data_unmasked = self.video_data.copy()
                 self.video_data = mask_apply(self.video_data, self.mask)
+                self.store_stage(step_name, {'mask': strict})
 
         except ValueError:
             self.reset_progress(step_button)
@@ -651,32 +737,31 @@ class WindowMain(QWidget, Ui_WindowMain):
                 if self.driftCheckBox.isChecked():
                     # TODO confirm drift is working/trying
                     self.feedback_action('Removing Drift from video of shape {}...'.format(self.video_data.shape[1:]))
-                    for iy, ix in np.ndindex(self.video_data.shape[1:]):
-                        signal_filtered, drift = filter_drift(self.video_data[:, iy, ix], drift_order='exp')
-                        self.video_data_unmasked[:, iy, ix] = signal_filtered
-                        self.video_data[:, iy, ix] = signal_filtered
+                    filter_drift_stack(self.video_data, drift_order='exp', out=self.video_data)
+                    if self.video_data_unmasked is not self.video_data:
+                        self.video_data_unmasked[...] = self.video_data
                 if self.invertCheckBox.isChecked():
                     self.feedback_action('Inverting Signals ...')
-                    for iy, ix in np.ndindex(self.video_data.shape[1:]):
-                        signal_inverted = invert_signal(self.video_data[:, iy, ix])
-                        self.video_data_unmasked[:, iy, ix] = signal_inverted
-                        self.video_data[:, iy, ix] = signal_inverted
+                    invert_stack(self.video_data, out=self.video_data,
+                                 progress=self.feedback_progress('Inverted frames'))
+                    if self.video_data_unmasked is not self.video_data:
+                        self.video_data_unmasked[...] = self.video_data
+                self.store_stage(step_name, {'norm': self.project_props_prc['norm'],
+                                             'drift': self.driftCheckBox.isChecked(),
+                                             'invert': self.invertCheckBox.isChecked()})
 
             elif step_name == 'Filter':
                 # Attempt Filter actions
                 self.update_parameters(step_name)
-                for idx, frame in enumerate(self.video_data_unmasked):
-                    # print('\r\tFrame:\t{}\t/ {}'.format(idx + 1, stack_out.shape[0]), end='', flush=True)
-                    frame_filtered = filter_spatial(frame, kernel=self.project_props_prc['filter'])
-                    # f_filtered = np.ma.masked_where(f_filtered == 0, f_filtered)
-                    self.video_data_unmasked[idx, :, :] = frame_filtered
+                filter_spatial_stack(self.video_data_unmasked, kernel=self.project_props_prc['filter'],
+                                     out=self.video_data_unmasked, workers=os.cpu_count())
                 if self.mask is not None:
                     self.video_data = mask_apply(self.video_data_unmasked, self.mask)
                 else:
                     self.video_data = self.video_data_unmasked
                 # reapply normalization (filtering smooths min/max)
                 if self.normTypeComboBox.currentText() == '0 - 1':
-                    self.video_data_unmasked = normalize_stack(self.video_data_unmasked)
+                    self.video_data_unmasked = normalize_stack(self.video_data_unmasked, out=self.video_data_unmasked)
                     if self.mask is not None:
                         self.video_data = mask_apply(self.video_data_unmasked, self.mask)
                     else:
@@ -685,11 +770,13 @@ class WindowMain(QWidget, Ui_WindowMain):
                     self.graphicsView.histogram.setHistogramRange(-0.5, 1.5)
                     self.update_video()
                     self.update_trace()
+                self.store_stage(step_name, {'filter': self.project_props_prc['filter'],
+                                             'norm': self.normTypeComboBox.currentText()})
             elif step_name == 'SNR':
                 # Attempt SNR actions
                 self.update_parameters(step_name)
                 # TODO check for multiple transients, use last one
-                snr_map = map_snr(self.video_data)
+                snr_map = map_snr(self.video_data, workers=os.cpu_count())
                 self.export_map(snr_map, 'SNR')
         except:
             self.reset_progress(step_button)
@@ -726,6 +813,7 @@ class WindowMain(QWidget, Ui_WindowMain):
                 else:
                     self.video_data = self.video_data_unmasked
                 self.update_trace()
+                self.store_stage(step_name, {'time': (start_frame, end_frame)})
                 # TODO show Time Crop values on trace plot as vertical lines
             if step_name == 'Analyze':
                 self.update_parameters(step_name)
@@ -754,11 +842,12 @@ class WindowMain(QWidget, Ui_WindowMain):
                         self.feedback_action('Single transient detected during Trace Analysis ensemble ...')
                         x, y = self.trace_xy[0], self.trace_xy[1]
                         cycle_length = np.nan
-                        snr, *_ = calculate_snr(self.trace)
-                        start, activation = find_tran_start(self.trace), find_tran_act(self.trace)
+                        features = TransientFeatures(self.trace)
+                        snr, *_ = features.snr
+                        start, activation = features.start, features.activation
                         dur_20, dur_80, dur_90, dur_x = \
-                            calc_tran_duration(self.trace, 20), calc_tran_duration(self.trace, 80), \
-                            calc_tran_duration(self.trace, 90), calc_tran_duration(self.trace, dur_x_per)
+                            features.duration(20), features.duration(80), \
+                            features.duration(90), features.duration(dur_x_per)
                         trace_results = [self.project_props_prp['subject'], x, y, cycle_length, snr,
                                          start, activation, dur_20, dur_80, dur_90, dur_x]
                         results_df = pd.DataFrame([trace_results], columns=results_df_columns)
@@ -768,11 +857,12 @@ class WindowMain(QWidget, Ui_WindowMain):
                         for idx, signal in enumerate(signals):
                             x, y = self.trace_xy[0], self.trace_xy[1]
                             cycle_length = est_cycle_length
-                            snr, *_ = calculate_snr(signal)
-                            start, activation = find_tran_start(signal), find_tran_act(signal)
+                            features = TransientFeatures(signal)
+                            snr, *_ = features.snr
+                            start, activation = features.start, features.activation
                             dur_20, dur_80, dur_90, dur_x = \
-                                calc_tran_duration(signal, 20), calc_tran_duration(signal, 80), \
-                                calc_tran_duration(signal, 90), calc_tran_duration(signal, dur_x_per)
+                                features.duration(20), features.duration(80), \
+                                features.duration(90), features.duration(dur_x_per)
                             trace_results = [self.project_props_prp['subject'], x, y, cycle_length, snr,
                                              start, activation, dur_20, dur_80, dur_90, dur_x]
                             trace_results_dict = {results_df_columns[i]: trace_results[i]
@@ -803,12 +893,13 @@ class WindowMain(QWidget, Ui_WindowMain):
                 elif analysis_type == 'Map: Start':
                     pass
                 elif analysis_type == 'Map: Activation':
-                    activation_map = map_tran_analysis(self.video_data, find_tran_act, self.video_time)
+                    activation_map = map_tran_analysis(self.video_data, find_tran_act, self.video_time,
+                                                       workers=os.cpu_count())
                     self.export_map(activation_map, 'Activation')
                 elif analysis_type == 'Map: Duration':
                     duration = self.durationPerSpinBox.value()
                     duration_map = map_tran_analysis(self.video_data, calc_tran_duration, self.video_time,
-                                                     percent=duration)
+                                                     workers=os.cpu_count(), percent=duration)
                     self.export_map(duration_map, 'Duration')
                 elif analysis_type == 'Map: Diastolic Interval':
                     raise NotImplementedError
@@ -872,6 +963,17 @@ class WindowMain(QWidget, Ui_WindowMain):
         self.textBrowser_Feedback.append(time_string + action_text)
         self.textBrowser_Feedback.repaint()
 
+    def feedback_progress(self, action_text):
+        # A progress(done, total) callback for long steps, throttled to one feedback line per FEEDBACK_INTERVAL
+        time_last = [time.monotonic()]
+
+        def progress(done, total):
+            time_now = time.monotonic()
+            if done == total or time_now - time_last[0] >= FEEDBACK_INTERVAL:
+                time_last[0] = time_now
+                self.feedback_action('{} : {} / {}'.format(action_text, done, total))
+        return progress
+
     def setup_next_buttons(self):
         self.next_buttons = [self.buttonNextPrep_Props, self.buttonNextPrep_Bin, self.buttonNextPrep_Mask,
                              self.buttonNextProc_Norm, self.buttonNextProc_Filter, self.buttonNextProc_SNR,
@@ -960,7 +960,6 @@ class TestMapCouplingPig(unittest.TestCase):
 
         # Prep and Process both stacks
         self.reduction = 9  # set to XX (to min ~200 X 200 pixels)
-        self.reduction_factor = 1 / self.reduction
         self.scale_px_cm = int(self.scale_px_cm / self.reduction)
         self.scale_cm_px = self.scale_cm_px * self.reduction
         # mask_type = 'Random_walk'
@@ -975,17 +974,7 @@ class TestMapCouplingPig(unittest.TestCase):
         # *** Voltage ***
         # *** Preparation ***
         # Reduce
-        test_frame = rescale(self.stack_vm[0], self.reduction_factor, multichannel=False)
-        print('Reducing stack from W {} X H {} ... to size W {} X H {} ...'
-              .format(self.stack_vm.shape[2], self.stack_vm.shape[1], test_frame.shape[1], test_frame.shape[0]))
-        stack_reduced_shape = (self.stack_vm.shape[0], test_frame.shape[0], test_frame.shape[1])
-        stack_reduced = np.empty(stack_reduced_shape, dtype=self.stack_vm.dtype)  # empty stack
-        for idx, frame in enumerate(self.stack_vm):
-            print('\r\tFrame:\t{}\t/ {}'.format(idx + 1, self.stack_vm.shape[0]), end='', flush=True)
-            #     f_filtered = filter_spatial(frame, kernel=self.kernel)
-            frame_reduced = img_as_uint(rescale(frame, self.reduction_factor, anti_aliasing=True, multichannel=False))
-            stack_reduced[idx, :, :] = frame_reduced
-        self.stack_processed_vm = stack_reduced
+        self.stack_processed_vm = reduce_stack(self.stack_vm, self.reduction)
         print('\nDONE Reducing stack')
         # Mask
         print('Generating Masking ...')
@@ -1030,17 +1019,7 @@ class TestMapCouplingPig(unittest.TestCase):
         # *** Calcium ***
         # *** Preparation ***
         # Reduce
-        test_frame = rescale(self.stack_ca[0], self.reduction_factor, multichannel=False)
-        print('Reducing stack from W {} X H {} ... to size W {} X H {} ...'
-              .format(self.stack_ca.shape[2], self.stack_ca.shape[1], test_frame.shape[1], test_frame.shape[0]))
-        stack_reduced_shape = (self.stack_ca.shape[0], test_frame.shape[0], test_frame.shape[1])
-        stack_reduced = np.empty(stack_reduced_shape, dtype=self.stack_ca.dtype)  # empty stack
-        for idx, frame in enumerate(self.stack_ca):
-            print('\r\tFrame:\t{}\t/ {}'.format(idx + 1, self.stack_ca.shape[0]), end='', flush=True)
-            #     f_filtered = filter_spatial(frame, kernel=self.kernel)
-            frame_reduced = img_as_uint(rescale(frame, self.reduction_factor, anti_aliasing=True, multichannel=False))
-            stack_reduced[idx, :, :] = frame_reduced
-        self.stack_processed_ca = stack_reduced
+        self.stack_processed_ca = reduce_stack(self.stack_ca, self.reduction)
         print('\nDONE Reducing stack')
         # Mask
         print('Generating Masking ...')
@@ -1158,10 +1137,8 @@ class TestMapCouplingPig(unittest.TestCase):
         # image_colorbar(ax_map_ca, img_ca)
 
         # Activation maps
-        map_act_vm = map_tran_analysis(stack_processed_vm, find_tran_act, stack_time,
-                                       raw_data=True)
-        map_act_ca = map_tran_analysis(stack_processed_ca, find_tran_act, stack_time,
-                                       raw_data=True)
+        map_ec, stats_ec, map_act_vm, map_act_ca = map_coupling_stacks(stack_processed_vm, stack_processed_ca,
+                                                                       stack_time)
 
         act_map_min = np.nanmin([map_act_vm, map_act_ca])
         act_map_max = np.nanmax([map_act_vm, map_act_ca])
@@ -1193,10 +1170,9 @@ class TestMapCouplingPig(unittest.TestCase):
                                unit='ms', stat_color=colors_times['Activation'])
 
         # Coupling map
-        map_ec = map_coupling(map_vm=map_act_vm, map_ca=map_act_ca)
-        map_ec_min = np.nanmin(map_ec)
-        map_ec_max = np.nanmax(map_ec)
-        map_n_ec = np.count_nonzero(~np.isnan(map_ec))
+        map_ec_min = stats_ec['min']
+        map_ec_max = stats_ec['max']
+        map_n_ec = stats_ec['n']
         map_coup_min_display = 0
         map_coup_max_display = EC_MAX
         print('Coupling Map MIN value: ', map_ec_min)
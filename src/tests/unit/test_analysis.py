@@ -1,6 +1,7 @@
 import unittest
 
 from matplotlib.patches import Circle, ConnectionPatch
+from scipy.signal import find_peaks
 
 from util.datamodel import *
 from util.preparation import *
@@ -147,6 +148,50 @@ class TestStart(unittest.TestCase):
         fig_points.show()
 
 
+class TestTransientFeatures(unittest.TestCase):
+    def setUp(self):
+        # Create data to test with
+        self.signal_t = 200
+        self.signal_t0 = 10
+        self.signal_fps = 1000
+        self.signal_noise = 3
+
+        self.time_vm, self.signal_vm = model_transients(t=self.signal_t, t0=self.signal_t0, fps=self.signal_fps)
+        self.signal_vm = model_noise(self.signal_vm, self.signal_noise)
+        self.time, self.signal = self.time_vm, invert_signal(self.signal_vm)
+
+    def test_parameters(self):
+        # Make sure type errors are raised when necessary
+        signal_bad_type = np.full(100, True)
+        # signal_in : ndarray, dtyoe : uint16 or float
+        self.assertRaises(TypeError, TransientFeatures, signal_in=True)
+        self.assertRaises(TypeError, TransientFeatures, signal_in=signal_bad_type)
+
+    def test_results(self):
+        # Make sure features are identical to those of the individual analysis functions
+        features = TransientFeatures(self.signal)
+        np.testing.assert_equal(features.peak, find_tran_peak(self.signal))
+        np.testing.assert_equal(features.baselines, find_tran_baselines(self.signal))
+        np.testing.assert_equal(features.snr[0], calculate_snr(self.signal)[0])
+        np.testing.assert_equal(features.start, find_tran_start(self.signal))
+        np.testing.assert_equal(features.activation, find_tran_act(self.signal))
+        np.testing.assert_equal(features.end, find_tran_end(self.signal))
+        for percent in [20, 80, 90]:
+            np.testing.assert_equal(features.duration(percent), calc_tran_duration(self.signal, percent))
+
+        # Make sure features are only calculated once
+        self.assertIs(features.df, features.df)
+        self.assertIs(features.baselines, features.baselines)
+
+        # Make sure a flat signal has incalculable features
+        features_flat = TransientFeatures(np.full(100, 100, dtype=np.uint16))
+        self.assertIs(features_flat.peak, np.nan)
+        self.assertIs(features_flat.start, np.nan)
+        self.assertIs(features_flat.activation, np.nan)
+        self.assertIs(features_flat.end, np.nan)
+        self.assertIs(features_flat.duration(80), np.nan)
+
+
 class TestActivation(unittest.TestCase):
     def setUp(self):
         # Create data to test with
@@ -236,6 +281,87 @@ class TestPeak(unittest.TestCase):
         self.assertIsInstance(i_peak, np.int64)  # index of peak time
 
 
+class TestPeaks(unittest.TestCase):
+    def setUp(self):
+        # Create data to test with, signals with many plateaus and tied peaks
+        rng = np.random.default_rng(0)
+        self.signals = rng.integers(0, 6, (20, 300)).astype(np.uint16)
+        self.heights = self.signals.mean(axis=1)
+        self.prominences = rng.uniform(0, 3, 20)
+        # and a noisy stack of transients
+        self.size = (10, 10)
+        self.time_ca, self.stack_ca = model_stack_propagation(
+            model_type='Ca', size=self.size, t=200, t0=20)
+        self.stack_ca = model_noise(self.stack_ca, 3)
+        self.stack_ca[:, :2, :2] = 0  # masked pixels
+
+    def test_parameters(self):
+        # Make sure type errors are raised when necessary
+        self.assertRaises(TypeError, find_peaks_signals, signals_in=True)
+        self.assertRaises(TypeError, find_peaks_signals, signals_in=np.full((5, 100), True))
+        self.assertRaises(TypeError, find_peaks_signals, signals_in=np.zeros((5, 5, 5)))
+        self.assertRaises(TypeError, find_tran_peaks, signals_in=self.signals[0])
+
+        # Make sure parameters are valid, and valid errors are raised when necessary
+        self.assertRaises(ValueError, find_peaks_signals, signals_in=self.signals, distance=0)
+
+    def test_results(self):
+        # Make sure peaks match scipy's find_peaks for each signal
+        for distance in [None, 1, 7, 150]:
+            i_ptr, i_peaks, prominences = find_peaks_signals(self.signals, height=self.heights,
+                                                             prominence=self.prominences, distance=distance)
+            self.assertEqual(len(i_ptr), len(self.signals) + 1)
+            for i_signal, signal in enumerate(self.signals):
+                i_peaks_ideal, properties = find_peaks(signal, height=self.heights[i_signal],
+                                                       prominence=self.prominences[i_signal], distance=distance)
+                np.testing.assert_equal(i_peaks[i_ptr[i_signal]:i_ptr[i_signal + 1]], i_peaks_ideal)
+                np.testing.assert_allclose(prominences[i_ptr[i_signal]:i_ptr[i_signal + 1]],
+                                           properties['prominences'])
+
+        # Make sure transient peaks match those of each signal
+        signals = self.stack_ca.reshape(self.stack_ca.shape[0], -1).T
+        i_peaks = find_tran_peaks(signals)
+        i_peaks_ideal = [find_tran_peak(signal) for signal in signals]
+        np.testing.assert_equal(i_peaks, np.array(i_peaks_ideal, dtype=float))
+        self.assertTrue(np.isnan(i_peaks.reshape(self.size)[:2, :2]).all())
+
+
+class TestBaselines(unittest.TestCase):
+    def setUp(self):
+        # Create data to test with, a noisy stack of transients
+        self.size = (10, 10)
+        self.time_ca, self.stack_ca = model_stack_propagation(
+            model_type='Ca', size=self.size, t=200, t0=20)
+        self.stack_ca = model_noise(self.stack_ca, 5)
+        self.stack_ca[:, :2, :2] = 0  # masked pixels
+        self.signals = self.stack_ca.reshape(self.stack_ca.shape[0], -1).T
+
+    def test_parameters(self):
+        # Make sure type errors are raised when necessary
+        self.assertRaises(TypeError, find_tran_baselines_signals, signals_in=True)
+        self.assertRaises(TypeError, find_tran_baselines_signals, signals_in=self.signals[0])
+
+    def test_results(self):
+        # Make sure baselines match those of each signal
+        i_starts, i_ends = find_tran_baselines_signals(self.signals)
+        self.assertEqual(i_starts.dtype, float)
+        for i_signal, signal in enumerate(self.signals):
+            if np.isnan(find_tran_peak(signal)):
+                self.assertTrue(np.isnan(i_starts[i_signal]))
+                self.assertTrue(np.isnan(i_ends[i_signal]))
+                continue
+            np.testing.assert_equal(np.arange(i_starts[i_signal], i_ends[i_signal]),
+                                    find_tran_baselines(signal))
+        self.assertTrue(np.isnan(i_starts.reshape(self.size)[:2, :2]).all())
+
+        # Make sure provided peaks are used
+        i_peaks = find_tran_peaks(self.signals)
+        i_peaks[-1] = np.nan
+        i_starts_peaks, i_ends_peaks = find_tran_baselines_signals(self.signals, i_peaks=i_peaks)
+        self.assertTrue(np.isnan(i_starts_peaks[-1]))
+        np.testing.assert_equal(i_ends_peaks[:-1], i_ends[:-1])
+
+
 # class TestDownstroke(unittest.TestCase):
 #     # Setup data to test with
 #     signal_F0 = 1000
@@ -562,6 +688,58 @@ class TestAnalysisPoints(unittest.TestCase):
         fig_transient.show()
 
 
+class TestMapFeatures(unittest.TestCase):
+    def setUp(self):
+        # Create data to test with, a propagating stack of Ca transients
+        self.size = (10, 10)
+        self.signal_t0 = 20
+        self.signal_noise = 2
+        self.time_ca, self.stack_ca = model_stack_propagation(
+            model_type='Ca', size=self.size, t=200, t0=self.signal_t0)
+        self.stack_ca = model_noise(self.stack_ca, self.signal_noise)
+        self.stack_ca[:, :2, :2] = 0  # masked pixels
+
+    def test_parameters(self):
+        # Make sure type errors are raised when necessary
+        stack_bad_shape = np.full((100, 100), 100, dtype=np.uint16)
+        stack_bad_type = np.full(self.stack_ca.shape, True)
+        self.assertRaises(TypeError, map_tran_features, stack_in=True)
+        self.assertRaises(TypeError, map_tran_features, stack_in=stack_bad_shape)
+        self.assertRaises(TypeError, map_tran_features, stack_in=stack_bad_type)
+        self.assertRaises(TypeError, map_tran_features, stack_in=self.stack_ca, metrics='snr')
+        self.assertRaises(TypeError, map_tran_features, stack_in=self.stack_ca, percents=[80.0])
+
+        # Make sure parameters are valid, and valid errors are raised when necessary
+        self.assertRaises(ValueError, map_tran_features, stack_in=self.stack_ca, metrics=['apd'])
+        self.assertRaises(ValueError, map_tran_features, stack_in=self.stack_ca, percents=[100])
+
+    def test_results(self):
+        # Make sure feature maps are identical to individually generated maps
+        maps = map_tran_features(self.stack_ca, self.time_ca,
+                                 metrics=['snr', 'activation', 'duration'], percents=[20, 80])
+        self.assertEqual(sorted(maps.keys()), ['activation', 'duration_20', 'duration_80', 'snr'])
+        for map_feature in maps.values():
+            self.assertEqual(map_feature.shape, self.size)
+            self.assertTrue(np.isnan(map_feature[:2, :2]).all())
+
+        np.testing.assert_equal(maps['snr'], map_snr(self.stack_ca))
+        np.testing.assert_equal(maps['activation'],
+                                map_tran_analysis(self.stack_ca, find_tran_act, self.time_ca))
+        np.testing.assert_equal(maps['duration_80'],
+                                map_tran_analysis(self.stack_ca, calc_tran_duration, self.time_ca, percent=80))
+
+    def test_workers(self):
+        # Make sure parallel analysis maps are identical to serial maps
+        np.testing.assert_equal(map_tran_analysis(self.stack_ca, find_tran_act, self.time_ca, workers=2),
+                                map_tran_analysis(self.stack_ca, find_tran_act, self.time_ca))
+        np.testing.assert_equal(map_tran_analysis(self.stack_ca, calc_tran_duration, workers=2, percent=80),
+                                map_tran_analysis(self.stack_ca, calc_tran_duration, percent=80))
+        maps = map_tran_features(self.stack_ca, self.time_ca, percents=[80])
+        maps_workers = map_tran_features(self.stack_ca, self.time_ca, percents=[80], workers=2, tile_bytes=4000)
+        for key in maps:
+            np.testing.assert_equal(maps_workers[key], maps[key])
+
+
 class TestCoupling(unittest.TestCase):
     def setUp(self):
         # Create data to test with
@@ -763,6 +941,72 @@ class TestCoupling(unittest.TestCase):
 
 #  class TestDFreq(unittest.TestCase):
 
+class TestMapCoupling(unittest.TestCase):
+    def setUp(self):
+        # Create data to test with, propagating Vm and Ca stacks
+        self.size = (10, 10)
+        self.signal_t0 = 20
+        self.model_coupling = 10
+        self.time, self.stack_vm = model_stack_propagation(
+            size=self.size, t=200, t0=self.signal_t0)
+        self.time_ca, self.stack_ca = model_stack_propagation(
+            model_type='Ca', size=self.size, t=200, t0=self.signal_t0 + self.model_coupling)
+        self.stack_ca = self.stack_ca[:self.stack_vm.shape[0]]  # same recording length
+        self.stack_vm = model_noise(self.stack_vm, 2)
+        self.stack_ca = model_noise(self.stack_ca, 2, seed=1)
+        self.stack_vm = invert_stack(self.stack_vm)
+        self.stack_vm[:, :2, :2] = 0  # masked pixels
+        self.stack_ca[:, :2, :2] = 0
+
+    def test_parameters(self):
+        # Make sure type errors are raised when necessary
+        self.assertRaises(TypeError, map_coupling_stacks, stack_vm=True, stack_ca=self.stack_ca)
+        self.assertRaises(TypeError, map_coupling_stacks, stack_vm=self.stack_vm, stack_ca=self.stack_ca[0])
+        self.assertRaises(TypeError, calc_map_stats, map_in=True)
+
+        # Make sure parameters are valid, and valid errors are raised when necessary
+        self.assertRaises(ValueError, map_coupling_stacks, stack_vm=self.stack_vm, stack_ca=self.stack_ca[1:])
+
+    def test_map_coupling(self):
+        # Make sure NaN and out of range activation times are excluded
+        map_vm = np.array([[10, np.nan, 10, 10], [10, 10, 10, 10]])
+        map_ca = np.array([[15, 15, np.nan, 5], [10, 10 + EC_MAX, 11 + EC_MAX, 20]])
+        map_ec = map_coupling(map_vm, map_ca)
+        np.testing.assert_equal(map_ec, [[5, np.nan, np.nan, np.nan], [0, EC_MAX, np.nan, 10]])
+
+    def test_results(self):
+        # Make sure the coupling map matches individually generated maps
+        map_ec, stats_ec, map_act_vm, map_act_ca = map_coupling_stacks(self.stack_vm, self.stack_ca, self.time)
+        map_act_vm_ideal = map_tran_analysis(self.stack_vm, find_tran_act, self.time, raw_data=True)
+        map_act_ca_ideal = map_tran_analysis(self.stack_ca, find_tran_act, self.time, raw_data=True)
+        np.testing.assert_equal(map_act_vm, map_act_vm_ideal)
+        np.testing.assert_equal(map_act_ca, map_act_ca_ideal)
+        np.testing.assert_equal(map_ec, map_coupling(map_act_vm_ideal, map_act_ca_ideal))
+        self.assertTrue(np.isnan(map_ec[:2, :2]).all())
+        self.assertAlmostEqual(stats_ec['median'], self.model_coupling, delta=5)
+
+        # Make sure stats ignore NaNs
+        self.assertEqual(stats_ec['n'], np.count_nonzero(~np.isnan(map_ec)))
+        self.assertEqual(stats_ec['min'], np.nanmin(map_ec))
+        self.assertEqual(stats_ec['max'], np.nanmax(map_ec))
+        self.assertAlmostEqual(stats_ec['mean'], np.nanmean(map_ec))
+        self.assertAlmostEqual(stats_ec['sd'], np.nanstd(map_ec))
+        self.assertEqual(calc_map_stats(np.full(self.size, np.nan))['n'], 0)
+
+    def test_tiles(self):
+        # Make sure tiling both stacks gives the same maps, and progress counts the tiles of both
+        map_ec, stats_ec, map_act_vm, map_act_ca = map_coupling_stacks(self.stack_vm, self.stack_ca, self.time)
+        calls = []
+        map_ec_tiled, stats_ec_tiled, map_act_vm_tiled, map_act_ca_tiled = \
+            map_coupling_stacks(self.stack_vm, self.stack_ca, self.time, tile_bytes=self.stack_vm.shape[0] * 8 * 7,
+                                progress=lambda done, total: calls.append((done, total)))
+        np.testing.assert_equal(map_act_vm_tiled, map_act_vm)
+        np.testing.assert_equal(map_act_ca_tiled, map_act_ca)
+        np.testing.assert_equal(map_ec_tiled, map_ec)
+        self.assertEqual(calls, [(done, calls[-1][1]) for done in range(1, calls[-1][1] + 1)])
+        self.assertEqual(calls[-1][1], 2 * 20)  # 10 x 10 pixels in tiles of 7, 2 per row
+
+
 class TestEnsemble(unittest.TestCase):
     def setUp(self):
         # # Create data to test with
@@ -1360,5 +1604,68 @@ class TestEnsemble(unittest.TestCase):
 #         self.assertAlmostEqual(signal_ca_phase.min(), signal_vm_phase.max(), delta=0.01)
 
 
+class TestEnsembleStack(unittest.TestCase):
+    def setUp(self):
+        # Create data to test with, a propagating stack of repeated Ca transients
+        self.size = (20, 20)
+        self.cycle = 150
+        self.time_ca, self.stack_ca = model_stack_propagation(
+            model_type='Ca', size=self.size, t=1000, t0=50, num='full', cl=self.cycle)
+        self.stack_ca[:, :2, :2] = 0  # masked pixels
+        self.stack_ca_noisy = model_noise(self.stack_ca.astype(float), 2) * (self.stack_ca > 0)
+
+    def test_params(self):
+        # Make sure type errors are raised when necessary
+        stack_bad_shape = np.full((100, 100), 100, dtype=np.uint16)
+        stack_bad_type = self.stack_ca.astype(np.int32)
+        self.assertRaises(TypeError, calc_ensemble_stack, time_in=True, stack_in=self.stack_ca)
+        self.assertRaises(TypeError, calc_ensemble_stack, time_in=self.time_ca, stack_in=True)
+        self.assertRaises(TypeError, calc_ensemble_stack, time_in=self.time_ca, stack_in=stack_bad_shape)
+        self.assertRaises(TypeError, calc_ensemble_stack, time_in=self.time_ca, stack_in=stack_bad_type)
+        self.assertRaises(TypeError, calc_ensemble_stack, time_in=self.time_ca, stack_in=self.stack_ca,
+                          reference=True)
+
+        # Make sure parameters are valid, and valid errors are raised when necessary
+        self.assertRaises(ValueError, calc_ensemble_stack, time_in=self.time_ca[:-1], stack_in=self.stack_ca)
+        self.assertRaises(ValueError, calc_ensemble_stack, time_in=self.time_ca, stack_in=self.stack_ca,
+                          reference=np.zeros(10))
+        # Make sure too few beats are rejected
+        self.assertRaises(ArithmeticError, calc_ensemble_stack, time_in=self.time_ca[:300],
+                          stack_in=self.stack_ca[:300])
+
+    def test_results(self):
+        # Make sure results are correct
+        stack_out, ensemble_crop, ensemble_yx = calc_ensemble_stack(self.time_ca, self.stack_ca)
+        self.assertEqual(stack_out.shape, (self.cycle,) + self.size)
+        self.assertEqual(stack_out.dtype, get_precision())
+        self.assertEqual(ensemble_crop[1] - ensemble_crop[0], self.cycle)
+        # Masked pixels are left as zeros
+        np.testing.assert_equal(stack_out[:, :2, :2], 0)
+        # Identical beats ensemble into their own normalized beat
+        beat = self.stack_ca[ensemble_crop[0]:ensemble_crop[1], 5:, 5:].astype(float)
+        beat_norm = (beat - beat.min(axis=0)) / np.ptp(beat, axis=0)
+        np.testing.assert_allclose(stack_out[:, 5:, 5:], beat_norm, atol=1e-6)
+
+        # Make sure noisy beats are segmented alike and ensembled close to the ideal
+        stack_noisy, crop_noisy, _ = calc_ensemble_stack(self.time_ca, self.stack_ca_noisy)
+        self.assertEqual(crop_noisy, ensemble_crop)
+        self.assertLess(np.abs(stack_noisy - stack_out).mean(), 0.1)
+
+        # Make sure parallel ensembles are identical to serial ensembles
+        np.testing.assert_equal(calc_ensemble_stack(self.time_ca, self.stack_ca, workers=2)[0], stack_out)
+
+        # Make sure a table of the stack's beats is reused for segmentation
+        beats = segment_beats(self.stack_ca)
+        np.testing.assert_equal(calc_ensemble_stack(self.time_ca, self.stack_ca, beats=beats)[0], stack_out)
+        self.assertRaises(TypeError, calc_ensemble_stack, time_in=self.time_ca, stack_in=self.stack_ca, beats=True)
+
+        # Make sure an activation map reference keeps the segmentation
+        map_act = np.zeros(self.size, dtype=int)
+        map_act[:, 10:] = 3
+        stack_delayed, crop_delayed, _ = calc_ensemble_stack(self.time_ca, self.stack_ca, reference=map_act)
+        self.assertEqual(stack_delayed.shape, stack_out.shape)
+        self.assertEqual(crop_delayed, ensemble_crop)
+
+
 if __name__ == '__main__':
     unittest.main()
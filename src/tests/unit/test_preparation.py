@@ -1,8 +1,13 @@
 import unittest
+from unittest import mock
 # from memory_profiler import profile
 from util.datamodel import *
 from util.preparation import *
+import os
+import stat
 import sys
+import tempfile
+import tifffile
 import numpy as np
 from pathlib import Path
 import matplotlib.pyplot as plt
@@ -49,6 +54,38 @@ def image_colorbar(axis, image):
     cb_img.ax.tick_params(labelsize=fontsize3)
 
 
+class TestPrecision(unittest.TestCase):
+    def setUp(self):
+        # Create data to test with
+        self.precision = get_precision()
+        self.time, self.stack = model_stack(model_type='Ca', size=(20, 20), t=150, t0=20)
+
+    def tearDown(self):
+        set_precision(self.precision)
+
+    def test_params(self):
+        # Make sure type errors are raised when necessary
+        self.assertRaises(TypeError, set_precision, dtype=True)
+        self.assertRaises(TypeError, set_precision, dtype=np.uint16)
+        self.assertRaises(TypeError, set_precision, dtype=np.float16)
+
+    def test_results(self):
+        # Make sure float32 is the default, and float is an alias of float64
+        self.assertIs(get_precision(), np.float32)
+        set_precision(float)
+        self.assertIs(get_precision(), np.float64)
+        set_precision(np.float32)
+        self.assertIs(get_precision(), np.float32)
+
+        # Make sure stacks of either precision are accepted and keep their dtype
+        mask = np.zeros(self.stack.shape[1:], dtype=bool)
+        mask[:5] = True
+        for dtype in PRECISIONS:
+            stack_in = self.stack.astype(dtype)
+            self.assertEqual(mask_apply(stack_in, mask).dtype, dtype)
+            self.assertEqual(crop_stack(stack_in, d_x=2, d_y=2).dtype, dtype)
+
+
 class TestOpenSignal(unittest.TestCase):
     # File paths and files needed for tests
     file_name = '2019/04/04 rata-12-Ca, PCL 150ms'
@@ -133,6 +170,156 @@ class TestOpenStack(unittest.TestCase):
         self.assertIsInstance(self.meta2, str)
 
 
+class TestOpenStackLazy(unittest.TestCase):
+    def setUp(self):
+        # Files needed for tests, an uncompressed and a compressed 16-bit stack
+        self.dir_stacks = tempfile.TemporaryDirectory()
+        self.time, self.stack = model_stack(model_type='Ca', size=(30, 20), t=150, t0=20)
+        self.file_raw = str(Path(self.dir_stacks.name, 'stack_raw.tif'))
+        self.file_zip = str(Path(self.dir_stacks.name, 'stack_zip.tif'))
+        tifffile.imwrite(self.file_raw, self.stack)
+        try:
+            tifffile.imwrite(self.file_zip, self.stack, compression='zlib')
+        except TypeError:  # tifffile < 2020.9.30
+            tifffile.imwrite(self.file_zip, self.stack, compress=6)
+
+    def tearDown(self):
+        self.dir_stacks.cleanup()
+
+    def test_params(self):
+        # Make sure type errors are raised when necessary
+        self.assertRaises(TypeError, open_stack, source=self.file_raw, lazy=1)
+        self.assertRaises(TypeError, open_stack, source=self.file_raw, frames=[0, 10])
+        self.assertRaises(TypeError, open_stack, source=self.file_raw, frames=(0, 10.0))
+        self.assertRaises(TypeError, open_stack, source=self.file_raw, roi=(0, 10))
+        self.assertRaises(ValueError, TiffStack, source=dir_tests + '/data/02-250_Vm.pcoraw.rec')
+
+    def test_results(self):
+        # Make sure lazy stacks are read-only memory maps of uncompressed data
+        stack_raw, meta_raw = open_stack(source=self.file_raw, lazy=True)
+        self.assertIsInstance(stack_raw, np.ndarray)
+        self.assertFalse(stack_raw.flags.writeable)
+        np.testing.assert_equal(stack_raw, self.stack)
+        # or TiffStacks of compressed data
+        stack_zip, meta_zip = open_stack(source=self.file_zip, lazy=True)
+        self.assertIsInstance(stack_zip, TiffStack)
+        np.testing.assert_equal(np.asarray(stack_zip), self.stack)
+
+    def test_frames_roi(self):
+        # Make sure only the requested frames and pixels are read
+        frames, roi = (10, 60), (5, 25, 2, 18)
+        stack_crop = self.stack[frames[0]:frames[1], roi[0]:roi[1], roi[2]:roi[3]]
+        for file_stack in [self.file_raw, self.file_zip]:
+            for lazy in [False, True]:
+                stack, meta = open_stack(source=file_stack, lazy=lazy, frames=frames, roi=roi)
+                np.testing.assert_equal(stack, stack_crop)
+            stack, meta = open_stack(source=file_stack, frames=frames)
+            self.assertTrue(stack.flags.writeable)
+            np.testing.assert_equal(stack, self.stack[frames[0]:frames[1]])
+
+        # Make valid errors are raised when parameters are invalid
+        self.assertRaises(ValueError, open_stack, source=self.file_raw, frames=(10, 10))
+        self.assertRaises(ValueError, open_stack, source=self.file_raw, frames=(0, len(self.stack) + 1))
+        self.assertRaises(ValueError, open_stack, source=self.file_raw, roi=(0, 10, 0, 21))
+
+        # Make sure compressed stacks release their file once cropped, or when the crop is invalid
+        with mock.patch.object(TiffStack, 'close', autospec=True, side_effect=TiffStack.close) as close:
+            open_stack(source=self.file_zip, frames=frames)
+            self.assertRaises(ValueError, open_stack, source=self.file_zip, frames=(10, 10))
+            self.assertEqual(close.call_count, 2)
+
+    def test_pcoraw(self):
+        # Make sure .pcoraw files are read in place, without renaming or writing to them
+        file_pcoraw = str(Path(self.dir_stacks.name, 'stack.pcoraw'))
+        tifffile.imwrite(file_pcoraw, self.stack)
+        os.chmod(file_pcoraw, stat.S_IREAD)
+        for lazy in [False, True]:
+            stack, meta = open_stack(source=file_pcoraw, lazy=lazy)
+            self.assertIsInstance(meta, dict)
+            np.testing.assert_equal(stack, self.stack)
+        self.assertTrue(os.path.isfile(file_pcoraw))
+        self.assertFalse(os.path.isfile(str(Path(self.dir_stacks.name, 'stack.tif'))))
+
+    def test_tiffstack(self):
+        # Make sure frames are decoded as they are indexed
+        stack_zip = TiffStack(self.file_zip)
+        self.assertEqual(stack_zip.shape, self.stack.shape)
+        self.assertEqual(stack_zip.dtype, np.uint16)
+        self.assertEqual(len(stack_zip), len(self.stack))
+        np.testing.assert_equal(stack_zip[10], self.stack[10])
+        np.testing.assert_equal(stack_zip[10:20:3, 5, 2:], self.stack[10:20:3, 5, 2:])
+        np.testing.assert_equal(stack_zip[[3, 1]], self.stack[[3, 1]])
+        np.testing.assert_equal(stack_zip[-1], self.stack[-1])
+        self.assertEqual(stack_zip[5:5].shape, (0,) + self.stack.shape[1:])
+        stack_zip.close()
+
+
+class TestStage(unittest.TestCase):
+    def setUp(self):
+        # A project folder and stacks needed for tests
+        self.dir_project = tempfile.TemporaryDirectory()
+        self.project = self.dir_project.name
+        self.time, self.stack = model_stack(model_type='Ca', size=(30, 20), t=150, t0=20)
+        self.stack_prep = self.stack[:, ::2, ::2].astype(np.float32)
+
+    def tearDown(self):
+        self.dir_project.cleanup()
+
+    def test_params(self):
+        # Make sure type errors are raised when necessary
+        self.assertRaises(TypeError, stack_key, parent=[1, 2], stage='Bin')
+        self.assertRaises(TypeError, stack_key, parent=self.stack, stage=2)
+        self.assertRaises(TypeError, save_stage, project=self.project, stack_in=[1, 2],
+                          stage='Bin', parent=self.stack)
+        self.assertRaises(TypeError, save_stage, project=self.project, stack_in=self.stack_prep,
+                          stage='Bin', parent=self.stack, chunk_bytes=1.5)
+        # Make sure parameters are valid, and valid errors are raised when necessary
+        self.assertRaises(FileNotFoundError, save_stage, project=self.project + '/missing',
+                          stack_in=self.stack_prep, stage='Bin', parent=self.stack)
+        self.assertRaises(ValueError, save_stage, project=self.project, stack_in=self.stack_prep,
+                          stage='Bin', parent=self.stack, chunk_bytes=0)
+
+    def test_key(self):
+        # Make sure keys depend on the input data and the stage parameters
+        key = stack_key(self.stack, 'Bin', {'rescale': 2})
+        self.assertEqual(key, stack_key(self.stack.copy(), 'Bin', {'rescale': 2}))
+        self.assertEqual(key, stack_key(stack_key(self.stack), 'Bin', {'rescale': 2}))
+        self.assertNotEqual(key, stack_key(self.stack, 'Bin', {'rescale': 3}))
+        self.assertNotEqual(key, stack_key(self.stack, 'Mask', {'rescale': 2}))
+        stack_changed = self.stack.copy()
+        stack_changed[10, 5, 5] += 1
+        self.assertNotEqual(key, stack_key(stack_changed, 'Bin', {'rescale': 2}))
+
+    def test_results(self):
+        # Make sure stages are stored in chunks and loaded unchanged
+        mask = self.stack_prep[0] > self.stack_prep[0].mean()
+        key = save_stage(self.project, self.stack_prep, 'Mask', self.stack, params={'mask': (3, 5)},
+                         extras={'mask': mask}, chunk_bytes=self.stack_prep[:20].nbytes)
+        self.assertEqual(key, stack_key(self.stack, 'Mask', {'mask': (3, 5)}))
+        self.assertEqual(len(list(Path(self.project, key + STAGE_SUFFIX).glob('chunk_*.npz'))), 8)
+        stack, meta, extras = load_stage(self.project, key)
+        self.assertEqual(stack.dtype, np.float32)
+        np.testing.assert_equal(stack, self.stack_prep)
+        np.testing.assert_equal(extras['mask'], mask)
+        self.assertEqual(meta['stage'], 'Mask')
+        self.assertEqual(meta['parent'], stack_key(self.stack))
+        # Make sure missing or incomplete stages are not loaded
+        self.assertIsNone(load_stage(self.project, 'missing')[0])
+        Path(self.project, key + STAGE_SUFFIX, 'chunk_00003.npz').unlink()
+        self.assertIsNone(load_stage(self.project, key)[0])
+
+    def test_latest(self):
+        # Make sure the latest stage descending from an input is found
+        self.assertIsNone(latest_stage(self.project, self.stack))
+        key_bin = save_stage(self.project, self.stack_prep, 'Bin', self.stack, params={'rescale': 2})
+        self.assertEqual(latest_stage(self.project, self.stack), key_bin)
+        key_norm = save_stage(self.project, self.stack_prep / 2, 'Normalize', key_bin, params={'norm': '0 - 1'})
+        self.assertEqual(latest_stage(self.project, stack_key(self.stack)), key_norm)
+        # but not stages of other inputs
+        save_stage(self.project, self.stack_prep, 'Bin', self.stack_prep, params={'rescale': 2})
+        self.assertEqual(latest_stage(self.project, self.stack), key_norm)
+
+
 class TestCropStack(unittest.TestCase):
     def setUp(self):
         # File paths and files needed for tests
@@ -359,6 +546,43 @@ class TestCropDual(unittest.TestCase):
         print('DONE Cropping Dual\n')
 
 
+class TestReduceStack(unittest.TestCase):
+    def setUp(self):
+        # Stacks needed for tests
+        self.time, self.stack = model_stack(model_type='Ca', size=(30, 21), t=150, t0=20)
+        self.stack_float = self.stack.astype(np.float32) / FL_16BIT_MAX
+
+    def test_params(self):
+        # Make sure type errors are raised when necessary
+        self.assertRaises(TypeError, reduce_stack, stack_in=self.stack.tolist(), reduction=2)
+        self.assertRaises(TypeError, reduce_stack, stack_in=self.stack[0], reduction=2)
+        self.assertRaises(TypeError, reduce_stack, stack_in=self.stack, reduction='2')
+        # Make sure parameters are valid, and valid errors are raised when necessary
+        self.assertRaises(ValueError, reduce_stack, stack_in=self.stack, reduction=0.5)
+        self.assertRaises(ValueError, reduce_stack, stack_in=self.stack, reduction=40)
+
+    def test_results(self):
+        # Make sure integer reductions average each block of pixels
+        stack_binned = reduce_stack(self.stack, 2)
+        self.assertEqual(stack_binned.dtype, np.uint16)
+        self.assertEqual(stack_binned.shape, (150, 15, 10))
+        stack_blocks = self.stack[:, :30, :20].astype(float).reshape((150, 15, 2, 10, 2)).mean(axis=(2, 4))
+        np.testing.assert_array_equal(stack_binned, np.round(stack_blocks))
+        np.testing.assert_array_equal(reduce_stack(self.stack, 2.0), stack_binned)
+        stack_float_binned = reduce_stack(self.stack_float, 3)
+        self.assertEqual(stack_float_binned.dtype, np.float32)
+        self.assertEqual(stack_float_binned.shape, (150, 10, 7))
+        np.testing.assert_allclose(stack_float_binned[10, 0, 0], self.stack_float[10, :3, :3].mean(), rtol=1e-6)
+        # Make sure other reductions rescale each frame, the same with or without threads
+        stack_reduced = reduce_stack(self.stack, 2.5)
+        self.assertEqual(stack_reduced.dtype, np.uint16)
+        self.assertEqual(stack_reduced.shape, (150, 12, 8))
+        np.testing.assert_array_equal(reduce_stack(self.stack, 2.5, workers=4), stack_reduced)
+        stack_float_reduced = reduce_stack(self.stack_float, 2.5, workers=4)
+        self.assertEqual(stack_float_reduced.dtype, np.float32)
+        self.assertAlmostEqual(stack_float_reduced.mean(), self.stack_float.mean(), delta=0.01)
+
+
 class TestMaskGenerate(unittest.TestCase):
     def setUp(self):
         # Create data to test with, a propagating stack of varying SNR (highest in the center)
@@ -6,7 +6,11 @@ from pathlib import Path
 from math import pi
 import numpy as np
 import statistics
+import tempfile
+import threading
+from concurrent.futures import CancelledError
 from scipy.signal import freqz
+from scipy.interpolate import LSQUnivariateSpline
 from skimage.restoration import estimate_sigma
 import matplotlib.pyplot as plt
 import matplotlib.ticker as plticker
@@ -135,6 +139,133 @@ def run_trials_snr(self, trials_count, trial_noise):
     return results
 
 
+class TestSplineSignals(unittest.TestCase):
+    def setUp(self):
+        # Create data to test with, a propagating stack of noisy transients
+        self.signal_f0 = 1000
+        self.signal_famp = 100
+        self.signal_noise = 5
+        self.time_ca, self.stack_ca = model_stack_propagation(
+            model_type='Ca', size=(20, 20), f0=self.signal_f0, famp=self.signal_famp)
+        self.stack_ca = model_noise(self.stack_ca, self.signal_noise)
+        self.signals_ca = self.stack_ca.reshape(self.stack_ca.shape[0], -1).T
+
+    def test_params(self):
+        # Make sure type errors are raised when necessary
+        signals_bad_type = np.full((10, 100), True)
+        signals_bad_shape = np.full((10, 10, 100), 100, dtype=np.uint16)
+        # signals_in : ndarray, 1-D or 2-D, dtype : uint16 or float
+        self.assertRaises(TypeError, spline_signals, signals_in=True)
+        self.assertRaises(TypeError, spline_signals, signals_in=signals_bad_type)
+        self.assertRaises(TypeError, spline_signals, signals_in=signals_bad_shape)
+
+        # Make sure parameters are valid, and valid errors are raised when necessary
+        # signals_in : longer than the number of knots
+        self.assertRaises(ValueError, spline_signals, signals_in=self.signals_ca[:, :SPLINE_KNOTS])
+
+    def test_results(self):
+        # Make sure batched splines are identical to individual LSQ splines
+        x_spline, signals_spline, signals_df, signals_df2 = spline_signals(self.signals_ca)
+        frames = self.signals_ca.shape[1]
+        self.assertEqual(signals_spline.shape, (self.signals_ca.shape[0], frames * SPLINE_FIDELITY))
+        self.assertEqual(signals_df.shape, signals_spline.shape)
+        self.assertEqual(signals_df2.shape, signals_spline.shape)
+
+        xx_signal = np.arange(frames)
+        t_knots = np.linspace(xx_signal[0], xx_signal[-1], SPLINE_KNOTS)[2:-2]
+        for i_signal in [0, 77, len(self.signals_ca) - 1]:
+            sql = LSQUnivariateSpline(xx_signal, self.signals_ca[i_signal], t_knots, k=SPLINE_DEGREE)
+            xs = np.linspace(xx_signal[0], xx_signal[-1], frames * SPLINE_FIDELITY)
+            np.testing.assert_allclose(x_spline, xs)
+            np.testing.assert_allclose(signals_spline[i_signal], sql(xs), atol=1e-6)
+            np.testing.assert_allclose(signals_df[i_signal], sql.derivative()(xs), atol=1e-6)
+            np.testing.assert_allclose(signals_df2[i_signal], sql.derivative(2)(xs), atol=1e-6)
+
+        # A 1-D array is a single signal
+        x_spline, signal_spline, signal_df, signal_df2 = spline_signals(self.signals_ca[0])
+        self.assertEqual(signal_spline.shape, (1, frames * SPLINE_FIDELITY))
+
+
+class TestSplineOperators(unittest.TestCase):
+    def setUp(self):
+        # Create data to test with
+        self.time_ca, self.signal_ca = model_transients(model_type='Ca', t=500, t0=20, f0=1000, famp=100)
+        self.signal_ca = model_noise(self.signal_ca, 5)
+
+    def test_results(self):
+        # Make sure operators are shared and read-only
+        x_spline, t_full, basis_fit, basis_eval = spline_operators(len(self.signal_ca))
+        self.assertIs(spline_operators(len(self.signal_ca))[2], basis_fit)
+        self.assertEqual(basis_fit.shape, (len(t_full) - SPLINE_DEGREE - 1, len(self.signal_ca)))
+        self.assertEqual(basis_eval.shape, (3, len(x_spline), basis_fit.shape[0]))
+        self.assertFalse(basis_fit.flags.writeable)
+
+        # Make sure spline helpers match a scipy LSQ spline
+        xx_signal = np.arange(len(self.signal_ca))
+        t_knots = np.linspace(xx_signal[0], xx_signal[-1], SPLINE_KNOTS)[2:-2]
+        sql_scipy = LSQUnivariateSpline(xx_signal, self.signal_ca, t_knots, k=SPLINE_DEGREE)
+        xs, sql = spline_signal(self.signal_ca)
+        np.testing.assert_allclose(sql(xs), sql_scipy(xs), atol=1e-6)
+        x_df, df_spline = spline_deriv(self.signal_ca)
+        np.testing.assert_allclose(df_spline, sql_scipy.derivative()(xs), atol=1e-6)
+        x_df2, df2_spline = spline_deriv(df_spline)
+        self.assertEqual(len(df2_spline), len(df_spline) * SPLINE_FIDELITY)
+
+
+class TestAlignSignals(unittest.TestCase):
+    def setUp(self):
+        # Create data to test with, a Ca transient with its baseline removed
+        self.time_ca, self.signal_ca = model_transients(model_type='Ca', t=300, t0=50)
+        self.signal_ca = self.signal_ca.astype(float) - self.signal_ca.min()
+        self.shifts = np.array([-7, 0, 3, 12])
+        self.signals_ca = np.stack([np.roll(self.signal_ca, -shift) for shift in self.shifts])
+
+    def test_params(self):
+        # Make sure type errors are raised when necessary
+        self.assertRaises(TypeError, align_signals_fft, signal_ref=True, signals_in=self.signals_ca)
+        self.assertRaises(TypeError, align_signals_fft, signal_ref=self.signal_ca, signals_in=True)
+        self.assertRaises(TypeError, align_signals_fft, signal_ref=self.signal_ca, signals_in=self.signals_ca,
+                          subsample=1)
+        self.assertRaises(TypeError, align_signals_fft, signal_ref=self.signal_ca, signals_in=self.signals_ca,
+                          out=np.empty(self.signals_ca.shape, dtype=np.float32))
+
+        # Make sure parameters are valid, and valid errors are raised when necessary
+        self.assertRaises(ValueError, align_signals_fft, signal_ref=np.stack([self.signal_ca] * 3),
+                          signals_in=self.signals_ca)
+        self.assertRaises(ValueError, align_signals_fft, signal_ref=self.signal_ca, signals_in=self.signals_ca,
+                          out=np.empty(self.signal_ca.shape))
+
+    def test_results(self):
+        # Make sure shifted signals are aligned back to the template
+        signals_aligned, shifts = align_signals_fft(self.signal_ca, self.signals_ca)
+        self.assertEqual(signals_aligned.dtype, float)
+        np.testing.assert_equal(shifts, self.shifts)
+        for signal_aligned, shift in zip(signals_aligned, shifts):
+            self.assertEqual(np.count_nonzero(np.isnan(signal_aligned)), abs(shift))
+            is_aligned = ~np.isnan(signal_aligned)
+            np.testing.assert_equal(signal_aligned[is_aligned], self.signal_ca[is_aligned])
+
+        # Make sure signals can be aligned in place, each to its own template
+        signals_in = self.signals_ca.copy()
+        signals_ref = np.stack([self.signal_ca, np.roll(self.signal_ca, 5)])[:, np.newaxis]
+        _, shifts_both = align_signals_fft(signals_ref, signals_in[:1].copy())
+        np.testing.assert_equal(shifts_both[:, 0], [self.shifts[0], self.shifts[0] + 5])
+        signals_out, _ = align_signals_fft(self.signal_ca, signals_in, out=signals_in)
+        self.assertIs(signals_out, signals_in)
+        np.testing.assert_equal(signals_out, signals_aligned)
+
+        # Make sure lags are refined to sub-sample precision
+        xx = np.arange(200)
+        shifts_sub = np.array([-3.3, 0, 2.25, 5.5])
+        signals_sub = np.exp(-((xx - 100 - shifts_sub[:, np.newaxis]) / 8) ** 2)
+        _, shifts = align_signals_fft(np.exp(-((xx - 100) / 8) ** 2), signals_sub, subsample=True)
+        np.testing.assert_allclose(shifts, -shifts_sub, atol=0.05)
+
+        # Make sure pairs are aligned like a direct correlation
+        _, shift = align_signals(self.signal_ca, self.signals_ca[3])
+        self.assertEqual(shift, np.argmax(correlate(self.signal_ca, self.signals_ca[3])) - len(self.signal_ca))
+
+
 class TestFilterSpatial(unittest.TestCase):
     def setUp(self):
         # Create data to test with, a propagating stack of known SNR
@@ -417,6 +548,52 @@ class TestFilterSpatial(unittest.TestCase):
         fig_filters.show()
 
 
+class TestFilterSpatialStack(unittest.TestCase):
+    def setUp(self):
+        # Create data to test with, a noisy propagating stack
+        self.time_ca, self.stack_ca = model_stack_propagation(model_type='Ca', size=(30, 40), t=150, t0=5)
+        self.stack_ca = model_noise(self.stack_ca[:40], 5)
+        self.kernel = 5
+
+    def test_params(self):
+        # Make sure type errors are raised when necessary
+        self.assertRaises(TypeError, filter_spatial_stack, stack_in=True)
+        self.assertRaises(TypeError, filter_spatial_stack, stack_in=self.stack_ca[0])
+        self.assertRaises(TypeError, filter_spatial_stack, stack_in=self.stack_ca, filter_type=True)
+        self.assertRaises(TypeError, filter_spatial_stack, stack_in=self.stack_ca, kernel=True)
+        self.assertRaises(TypeError, filter_spatial_stack, stack_in=self.stack_ca,
+                          out=np.empty(self.stack_ca.shape))
+
+        # Make sure parameters are valid, and valid errors are raised when necessary
+        self.assertRaises(ValueError, filter_spatial_stack, stack_in=self.stack_ca, filter_type='gross')
+        self.assertRaises(NotImplementedError, filter_spatial_stack, stack_in=self.stack_ca,
+                          filter_type='best_ever')
+        self.assertRaises(ValueError, filter_spatial_stack, stack_in=self.stack_ca, kernel=8)
+        self.assertRaises(ValueError, filter_spatial_stack, stack_in=self.stack_ca,
+                          out=np.empty_like(self.stack_ca[1:]))
+
+    def test_results(self):
+        # Make sure results match those of each frame, for each filter, with and without threads
+        for filter_type in ['gaussian', 'median', 'mean', 'bilateral']:
+            frames_filtered = [filter_spatial(frame, filter_type=filter_type, kernel=self.kernel)
+                               for frame in self.stack_ca]
+            for workers in [None, 3]:
+                stack_out = filter_spatial_stack(self.stack_ca, filter_type=filter_type, kernel=self.kernel,
+                                                 workers=workers, tile_bytes=self.stack_ca[0].nbytes * 16)
+                self.assertEqual(stack_out.dtype, self.stack_ca.dtype)
+                np.testing.assert_equal(stack_out, np.array(frames_filtered))
+        # whether or not the filter type string is interned (e.g. read from project properties)
+        np.testing.assert_equal(filter_spatial_stack(self.stack_ca, filter_type=''.join(['gauss', 'ian']),
+                                                     kernel=self.kernel),
+                                filter_spatial_stack(self.stack_ca, filter_type='gaussian', kernel=self.kernel))
+
+        # Make sure float stacks can be filtered in place
+        stack_in = self.stack_ca.astype(float)
+        stack_out_ideal = np.array([filter_spatial(frame, kernel=self.kernel) for frame in stack_in])
+        self.assertIs(filter_spatial_stack(stack_in, kernel=self.kernel, out=stack_in), stack_in)
+        np.testing.assert_equal(stack_in, stack_out_ideal)
+
+
 class TestFilterTemporal(unittest.TestCase):
     def setUp(self):
         # Create data to test with
@@ -656,6 +833,60 @@ class TestFilterTemporal(unittest.TestCase):
         fig_filter.show()
 
 
+class TestFilterTemporalStack(unittest.TestCase):
+    def setUp(self):
+        # Create data to test with, a noisy propagating stack
+        self.time_ca, self.stack_ca = model_stack_propagation(model_type='Ca', size=(20, 30), t=300, t0=20)
+        self.stack_ca = model_noise(self.stack_ca, 5)
+        self.sample_rate = 1000.0
+
+    def test_params(self):
+        # Make sure type errors are raised when necessary
+        self.assertRaises(TypeError, filter_temporal_stack, stack_in=True, sample_rate=self.sample_rate)
+        self.assertRaises(TypeError, filter_temporal_stack, stack_in=self.stack_ca[:, 0],
+                          sample_rate=self.sample_rate)
+        self.assertRaises(TypeError, filter_temporal_stack, stack_in=self.stack_ca, sample_rate=True)
+        self.assertRaises(TypeError, filter_temporal_stack, stack_in=self.stack_ca, sample_rate=self.sample_rate,
+                          filter_order=True)
+        self.assertRaises(TypeError, filter_temporal_stack, stack_in=self.stack_ca, sample_rate=self.sample_rate,
+                          out=np.empty(self.stack_ca.shape))
+
+        # Make sure parameters are valid, and valid errors are raised when necessary
+        self.assertRaises(ValueError, filter_temporal_stack, stack_in=self.stack_ca, sample_rate=self.sample_rate,
+                          filter_order='gross')
+        self.assertRaises(ValueError, filter_temporal_stack, stack_in=self.stack_ca, sample_rate=self.sample_rate,
+                          method='gross')
+
+    def test_design(self):
+        # Make sure designs are reused and can't be changed
+        b, a = filter_temporal_design(self.sample_rate, 100.0, 'auto')
+        self.assertIs(filter_temporal_design(self.sample_rate, 100.0, 'auto')[0], b)
+        np.testing.assert_equal(a, [1.0])
+        self.assertRaises(ValueError, b.fill, 0)
+
+    def test_results(self):
+        for filter_order in ['auto', 5]:
+            for stack_in in [self.stack_ca, self.stack_ca / 3]:
+                stack_ideal = np.empty_like(stack_in)
+                for iy, ix in np.ndindex(stack_in.shape[1:]):
+                    stack_ideal[:, iy, ix] = filter_temporal(stack_in[:, iy, ix], self.sample_rate,
+                                                             filter_order=filter_order)
+                # Make sure results match those of each signal
+                stack_out = filter_temporal_stack(stack_in, self.sample_rate, filter_order=filter_order,
+                                                  tile_bytes=stack_in[:, 0].nbytes * 3)
+                self.assertEqual(stack_out.dtype, stack_in.dtype)
+                np.testing.assert_allclose(stack_out, stack_ideal, atol=1e-9)
+
+                # Make sure FFT results are close, away from the edges
+                stack_out_fft = filter_temporal_stack(stack_in, self.sample_rate, filter_order=filter_order,
+                                                      method='fft')
+                self.assertEqual(stack_out_fft.dtype, stack_in.dtype)
+                np.testing.assert_allclose(stack_out_fft[50:-50], stack_ideal[50:-50], rtol=0.01)
+                # whether or not the method string is interned (e.g. read from project properties)
+                np.testing.assert_equal(filter_temporal_stack(stack_in, self.sample_rate, filter_order=filter_order,
+                                                              method=''.join(['ff', 't'])), stack_out_fft)
+
+
 class TestFilterDrift(unittest.TestCase):
     def setUp(self):
         # Create data to test with
@@ -758,6 +989,55 @@ class TestFilterDrift(unittest.TestCase):
         fig_drift.savefig(dir_unit + '/results/processing_DriftFilterTraces.png')
 
 
+class TestFilterDriftStack(unittest.TestCase):
+    def setUp(self):
+        # Create data to test with, a noisy propagating stack with varied exponential drift
+        rng = np.random.default_rng(0)
+        self.time_vm, self.stack_vm = model_stack_propagation(model_type='Vm', size=(10, 12), t=300, t0=20)
+        drift_x = np.arange(len(self.stack_vm))[:, np.newaxis, np.newaxis]
+        drift = 80 * np.exp(-0.03 * drift_x) * rng.uniform(0.5, 1.5, self.stack_vm.shape[1:])
+        self.stack_vm = model_noise((self.stack_vm + drift).astype(np.uint16), 3)
+        self.stack_vm[:, :2, :2] = 0  # masked pixels
+
+    def test_params(self):
+        # Make sure type errors are raised when necessary
+        self.assertRaises(TypeError, filter_drift_stack, stack_in=True)
+        self.assertRaises(TypeError, filter_drift_stack, stack_in=self.stack_vm[:, 0])
+        self.assertRaises(TypeError, filter_drift_stack, stack_in=self.stack_vm, drift_order=True)
+        self.assertRaises(TypeError, filter_drift_stack, stack_in=self.stack_vm, out=np.empty(self.stack_vm.shape))
+
+        # Make sure parameters are valid, and valid errors are raised when necessary
+        self.assertRaises(ValueError, filter_drift_stack, stack_in=self.stack_vm, drift_order=0)
+        self.assertRaises(ValueError, filter_drift_stack, stack_in=self.stack_vm, drift_order='gross')
+
+    def test_results(self):
+        stack_in = self.stack_vm.astype(float)
+        # Make sure polynomial results match those of each signal
+        for drift_order in [1, 3]:
+            stack_out, map_drift = filter_drift_stack(stack_in, drift_order=drift_order)
+            self.assertEqual(map_drift.shape, (drift_order + 1,) + stack_in.shape[1:])
+            for iy, ix in np.ndindex(stack_in.shape[1:]):
+                signal_out, drift = filter_drift(stack_in[:, iy, ix], drift_order=drift_order)
+                np.testing.assert_allclose(stack_out[:, iy, ix], signal_out, atol=1e-6)
+            self.assertTrue(np.isnan(map_drift[:, :2, :2]).all())
+
+        # Make sure exponential fits are within bounds and as close as each signal's
+        stack_out, map_drift = filter_drift_stack(stack_in, drift_order='exp')
+        self.assertEqual(map_drift.shape, (3,) + stack_in.shape[1:])
+        np.testing.assert_equal(stack_out[:, :2, :2], stack_in[:, :2, :2])  # flat pixels are unchanged
+        drift_x = np.arange(len(stack_in))
+        for iy, ix in np.argwhere(~np.isnan(map_drift[0])):
+            a, b, c = map_drift[:, iy, ix]
+            self.assertTrue(DRIFT_EXP_B[0] <= b <= DRIFT_EXP_B[1])
+            signal_out, drift = filter_drift(stack_in[:, iy, ix], drift_order='exp')
+            cost = np.sum((stack_in[:, iy, ix] - (a * np.exp(-b * drift_x) + c)) ** 2)
+            self.assertLess(cost, np.sum((stack_in[:, iy, ix] - drift) ** 2) * 1.001)
+
+        # Make sure uint16 stacks keep their dtype
+        stack_out, map_drift = filter_drift_stack(self.stack_vm, drift_order=1)
+        self.assertEqual(stack_out.dtype, np.uint16)
+
+
 class TestInvert(unittest.TestCase):
     def setUp(self):
         # Create data to test with
@@ -770,6 +1050,10 @@ class TestInvert(unittest.TestCase):
         self.time_vm, self.signal_vm = model_transients_pig(t=self.signal_t, t0=self.signal_t0,
                                                             f0=self.signal_f0, famp=self.signal_famp,
                                                             noise=self.signal_noise, num=self.signal_num)
+        # and a noisy stack
+        self.time_stack, self.stack_vm = model_stack_propagation(model_type='Vm', size=(10, 10), t=200, t0=20)
+        self.stack_vm = model_noise(self.stack_vm, 3)
+        self.stack_vm[:, :2, :2] = 0  # masked pixels
 
     def test_params(self):
         signal_bad_type = np.full(100, True)
@@ -780,6 +1064,14 @@ class TestInvert(unittest.TestCase):
 
         # Make sure parameters are valid, and valid errors are raised when necessary
 
+    def test_params_stack(self):
+        # Make sure type errors are raised when necessary
+        self.assertRaises(TypeError, invert_stack, stack_in=True)
+        self.assertRaises(TypeError, invert_stack, stack_in=self.stack_vm[0])
+        self.assertRaises(TypeError, invert_stack, stack_in=self.stack_vm.astype(np.int32))
+        # Make sure parameters are valid, and valid errors are raised when necessary
+        self.assertRaises(ValueError, invert_stack, stack_in=self.stack_vm, out=np.empty((5, 5, 5)))
+
     def test_results(self):
         # Make sure results are correct
         signal_out = invert_signal(self.signal_vm)
@@ -792,6 +1084,23 @@ class TestInvert(unittest.TestCase):
         self.assertAlmostEqual(signal_out.min(), self.signal_f0 - self.signal_famp, delta=self.signal_noise * 4)  #
         self.assertAlmostEqual(signal_out.max(), self.signal_f0, delta=self.signal_noise * 4)  #
 
+    def test_results_stack(self):
+        # Make sure results match those of each signal, for both dtypes
+        for stack_in in [self.stack_vm, self.stack_vm.astype(float) / 3]:
+            progress_calls = []
+            stack_out = invert_stack(stack_in, tile_bytes=stack_in[0].size * 8 * 16,
+                                     progress=lambda done, total: progress_calls.append((done, total)))
+            self.assertEqual(stack_out.dtype, stack_in.dtype)
+            for iy, ix in np.ndindex(stack_in.shape[1:]):
+                np.testing.assert_equal(stack_out[:, iy, ix], invert_signal(stack_in[:, iy, ix]))
+            self.assertEqual(len(progress_calls), int(np.ceil(len(stack_in) / 16)))
+            self.assertEqual(progress_calls[-1], (len(stack_in), len(stack_in)))
+
+        # Make sure a stack can be inverted in place
+        stack_in = self.stack_vm.copy()
+        self.assertIs(invert_stack(stack_in, out=stack_in), stack_in)
+        np.testing.assert_equal(stack_in, invert_stack(self.stack_vm))
+
     def test_plot_single(self):
         # Make sure signal inversion looks correct
         signal_out = invert_signal(self.signal_vm)
@@ -828,6 +1137,10 @@ class TestNormalize(unittest.TestCase):
         self.time_ca, self.signal_ca = model_transients(model_type='Ca', t=self.signal_t, t0=self.signal_t0,
                                                         f0=self.signal_f0, famp=self.signal_famp,
                                                         noise=self.signal_noise)
+        # and a noisy stack
+        self.time_stack, self.stack_ca = model_stack_propagation(model_type='Ca', size=(10, 10), t=200, t0=20)
+        self.stack_ca = model_noise(self.stack_ca, 3)
+        self.stack_ca[:, :2, :2] = 0  # masked pixels
 
     def test_params(self):
         signal_bad_type = np.full(100, True)
@@ -838,6 +1151,15 @@ class TestNormalize(unittest.TestCase):
 
         # Make sure parameters are valid, and valid errors are raised when necessary
 
+    def test_params_stack(self):
+        # Make sure type errors are raised when necessary
+        self.assertRaises(TypeError, normalize_stack, stack_in=True)
+        self.assertRaises(TypeError, normalize_stack, stack_in=self.stack_ca[0])
+        self.assertRaises(TypeError, normalize_stack, stack_in=self.stack_ca, dtype=np.uint16)
+        self.assertRaises(TypeError, normalize_stack, stack_in=self.stack_ca, out=np.empty_like(self.stack_ca))
+        # Make sure parameters are valid, and valid errors are raised when necessary
+        self.assertRaises(ValueError, normalize_stack, stack_in=self.stack_ca, out=np.empty((5, 5, 5)))
+
     def test_results(self):
         # Make sure results are correct
         signal_out = normalize_signal(self.signal_ca)
@@ -845,6 +1167,33 @@ class TestNormalize(unittest.TestCase):
         # signal_out : ndarray, dtyoe : float
         self.assertIsInstance(signal_out, np.ndarray)  # normalized signal
 
+    def test_results_stack(self):
+        # Make sure results match those of each signal
+        stack_out = normalize_stack(self.stack_ca, dtype=float)
+        self.assertEqual(stack_out.dtype, float)
+        for iy, ix in np.ndindex(self.stack_ca.shape[1:]):
+            np.testing.assert_allclose(stack_out[:, iy, ix], normalize_signal(self.stack_ca[:, iy, ix]), atol=1e-12)
+        self.assertTrue((stack_out[:, :2, :2] == 0).all())  # flat pixels
+
+        stack_out_32 = normalize_stack(self.stack_ca, dtype=np.float32)
+        self.assertEqual(stack_out_32.dtype, np.float32)
+        np.testing.assert_allclose(stack_out_32, stack_out, atol=1e-6)
+
+        # Make sure the default dtype follows the precision setting
+        precision = get_precision()
+        self.assertEqual(normalize_stack(self.stack_ca).dtype, precision)
+        try:
+            set_precision(float)
+            self.assertEqual(normalize_stack(self.stack_ca).dtype, float)
+        finally:
+            set_precision(precision)
+
+        # Make sure a stack can be normalized in place
+        stack_in = self.stack_ca.astype(float)
+        stack_in_out = normalize_stack(stack_in, out=stack_in)
+        self.assertIs(stack_in_out, stack_in)
+        np.testing.assert_allclose(stack_in, stack_out, atol=1e-12)
+
     def test_plot_single(self):
         # Make sure signal normalization looks correct
         signal_out = normalize_signal(self.signal_ca)
@@ -1313,6 +1662,175 @@ class TestSnrMap(unittest.TestCase):
         fig_map_snr.show()
 
 
+class TestSnrSignals(unittest.TestCase):
+    def setUp(self):
+        # Create data to test with, a noisy stack of transients
+        self.size = (10, 10)
+        self.time_ca, self.stack_ca = model_stack_propagation(model_type='Ca', size=self.size, t=200, t0=20)
+        self.stack_ca = model_noise(self.stack_ca, 5)
+        self.stack_ca[:, :2, :2] = 0  # masked pixels
+        self.signals = self.stack_ca.reshape(self.stack_ca.shape[0], -1).T
+
+    def test_params(self):
+        # Make sure type errors are raised when necessary
+        self.assertRaises(TypeError, calculate_snr_signals, signals_in=True)
+        self.assertRaises(TypeError, calculate_snr_signals, signals_in=self.signals[0])
+
+    def test_results(self):
+        # Make sure results match those of each signal, for both dtypes
+        for signals in [self.signals, self.signals / 3]:
+            snr, rms_bounds, peak_peak, sd_noise = calculate_snr_signals(signals)
+            for i_signal, signal in enumerate(signals):
+                snr_ideal, rms_bounds_ideal, peak_peak_ideal, sd_noise_ideal, ir_noise, ir_peak = \
+                    calculate_snr(signal)
+                if snr_ideal is np.nan:
+                    self.assertTrue(np.isnan(snr[i_signal]))
+                    continue
+                np.testing.assert_allclose([snr[i_signal], peak_peak[i_signal], sd_noise[i_signal]],
+                                           [snr_ideal, peak_peak_ideal, sd_noise_ideal], rtol=1e-12)
+                np.testing.assert_equal(rms_bounds[:, i_signal], rms_bounds_ideal)
+            self.assertTrue(np.isnan(snr.reshape(self.size)[:2, :2]).all())
+
+        # Make sure mapped components match
+        maps_snr = map_snr(self.stack_ca, components=True)
+        self.assertEqual(maps_snr.shape, (len(SNR_COMPONENTS),) + self.size)
+        snr, rms_bounds, peak_peak, sd_noise = calculate_snr_signals(self.signals)
+        np.testing.assert_equal(maps_snr.reshape(len(SNR_COMPONENTS), -1),
+                                np.stack((snr, rms_bounds[0], rms_bounds[1], peak_peak, sd_noise)))
+        np.testing.assert_equal(map_snr(self.stack_ca), maps_snr[0])
+
+
+class TestMapTiles(unittest.TestCase):
+    def setUp(self):
+        # Create data to test with, a propagating stack of Ca transients
+        self.size = (10, 10)
+        self.time_ca, self.stack_ca = model_stack_propagation(
+            model_type='Ca', size=self.size, t=200, t0=20)
+        self.stack_ca = model_noise(self.stack_ca, 2)
+        self.stack_ca[:, :2, :2] = 0  # masked pixels
+
+    def test_params(self):
+        # Make sure type errors are raised when necessary
+        stack_bad_shape = np.full((100, 100), 100, dtype=np.uint16)
+        self.assertRaises(TypeError, map_tiles, stack_in=True, tile_func=np.ptp)
+        self.assertRaises(TypeError, map_tiles, stack_in=stack_bad_shape, tile_func=np.ptp)
+        self.assertRaises(TypeError, map_tiles, stack_in=self.stack_ca, tile_func=np.ptp, workers=2.0)
+
+        # Make sure parameters are valid, and valid errors are raised when necessary
+        self.assertRaises(ValueError, map_tiles, stack_in=self.stack_ca, tile_func=np.ptp, workers=0)
+        self.assertRaises(ValueError, map_tiles, stack_in=self.stack_ca, tile_func=np.ptp, tile_bytes=0)
+        self.assertRaises(ValueError, map_tiles, stack_in=self.stack_ca, tile_func=np.ptp,
+                          maps={'map_bad': np.zeros(5)})
+
+    def test_results(self):
+        # Make sure tiles are assembled like the whole stack
+        map_ptp = map_tiles(self.stack_ca, np.ptp, workers=3, axis=0)
+        np.testing.assert_equal(map_ptp, np.ptp(self.stack_ca, axis=0))
+
+        # Make sure parallel maps are identical to serial maps
+        np.testing.assert_equal(map_snr(self.stack_ca, workers=2), map_snr(self.stack_ca))
+
+    def test_tiles(self):
+        # Make sure tiles cover the map once and fit the memory budget
+        pixel_bytes = self.stack_ca.shape[0] * 8
+        for tile_pixels in [1, 3, 10, 25, 100, 1000]:
+            tiles = tile_bounds(self.size, pixel_bytes, tile_bytes=tile_pixels * pixel_bytes)
+            map_count = np.zeros(self.size, dtype=int)
+            for (y0, y1), (x0, x1) in tiles:
+                self.assertLessEqual((y1 - y0) * (x1 - x0), tile_pixels)
+                map_count[y0:y1, x0:x1] += 1
+            np.testing.assert_equal(map_count, 1)
+        self.assertEqual(len(tile_bounds(self.size, pixel_bytes, tiles_min=8)), 10)
+
+        # Make sure small tiles are assembled like the whole stack
+        map_ptp = map_tiles(self.stack_ca, np.ptp, tile_bytes=3 * pixel_bytes, axis=0)
+        np.testing.assert_equal(map_ptp, np.ptp(self.stack_ca, axis=0))
+        np.testing.assert_equal(map_snr(self.stack_ca, tile_bytes=7 * pixel_bytes), map_snr(self.stack_ca))
+
+    def test_progress(self):
+        # Make sure progress is reported after each tile
+        pixel_bytes = self.stack_ca.shape[0] * 8
+        reports = []
+        map_tiles(self.stack_ca, np.ptp, tile_bytes=20 * pixel_bytes,
+                  progress=lambda done, total: reports.append((done, total)), axis=0)
+        self.assertEqual(reports, [(1, 5), (2, 5), (3, 5), (4, 5), (5, 5)])
+
+        # Make sure a cancelled map stops between tiles
+        cancel = threading.Event()
+
+        def progress_cancel(done, total):
+            if done == 2:
+                cancel.set()
+        self.assertRaises(CancelledError, map_snr, self.stack_ca, tile_bytes=20 * pixel_bytes,
+                          progress=progress_cancel, cancel=cancel)
+        self.assertRaises(CancelledError, map_snr, self.stack_ca, workers=2, cancel=cancel)
+
+
+class TestBeatTable(unittest.TestCase):
+    def setUp(self):
+        # Create data to test with, a propagating stack of repeated Ca transients
+        self.size = (20, 20)
+        self.cycle = 150
+        self.time_ca, self.stack_ca = model_stack_propagation(
+            model_type='Ca', size=self.size, t=1000, t0=50, num='full', cl=self.cycle)
+        self.stack_ca[:, :2, :2] = 0  # masked pixels
+        self.beats = segment_beats(self.stack_ca)
+
+    def test_params(self):
+        # Make sure type errors are raised when necessary
+        stack_bad_shape = np.full((100, 100), 100, dtype=np.uint16)
+        self.assertRaises(TypeError, segment_beats, stack_in=True)
+        self.assertRaises(TypeError, segment_beats, stack_in=stack_bad_shape)
+        self.assertRaises(TypeError, segment_beats, stack_in=self.stack_ca.astype(np.int32))
+        self.assertRaises(TypeError, segment_beats, stack_in=self.stack_ca, reference=True)
+        self.assertRaises(TypeError, BeatTable, landmarks=True, windows=self.beats.windows, cycle=self.cycle)
+
+        # Make sure parameters are valid, and valid errors are raised when necessary
+        self.assertRaises(ValueError, segment_beats, stack_in=self.stack_ca, reference=np.zeros(10))
+        self.assertRaises(ValueError, BeatTable, landmarks=self.beats.landmarks[:3],
+                          windows=self.beats.windows, cycle=self.cycle)
+        self.assertRaises(ValueError, BeatTable, landmarks=self.beats.landmarks,
+                          windows=self.beats.windows[:-1], cycle=self.cycle)
+
+    def test_results(self):
+        # Make sure every beat is segmented once, into compact landmarks
+        self.assertEqual(self.beats.cycle, self.cycle)
+        self.assertEqual(self.beats.shape, self.size)
+        self.assertEqual(self.beats.landmarks.dtype, np.int32)
+        self.assertEqual(self.beats.landmarks.shape, (len(BEAT_LANDMARKS), self.beats.beats) + self.size)
+        np.testing.assert_equal(np.diff(self.beats.windows), self.cycle)
+        # Masked pixels have no landmarks
+        np.testing.assert_equal(self.beats.landmarks[:, :, :2, :2], BEAT_NONE)
+
+        # Make sure landmarks are ordered and match those of each beat's signal
+        pixel = self.beats.landmarks[:, :, 10, 10]
+        self.assertTrue((np.diff(pixel, axis=0)[1:] > 0).all())
+        for i_window, i_act, i_peak in zip(self.beats.windows, self.beats.activations[:, 10, 10],
+                                           self.beats.peaks[:, 10, 10]):
+            signal_beat = self.stack_ca[i_window:i_window + self.cycle, 10, 10]
+            self.assertEqual(i_peak - i_window, find_tran_peak(signal_beat))
+            self.assertEqual(i_act - i_window, find_tran_act(signal_beat))
+
+        # Make sure beat-resolved metrics read from the table
+        np.testing.assert_equal(self.beats.cycle_lengths()[:, 10, 10], self.cycle)
+        np.testing.assert_equal(self.beats.durations()[:-1] + self.beats.diastolic_intervals(),
+                                self.beats.cycle_lengths())
+        self.assertTrue(np.isnan(self.beats.cycle_lengths()[:, 0, 0]).all())
+
+        # Make sure parallel tables are identical to serial tables
+        np.testing.assert_equal(segment_beats(self.stack_ca, workers=2).landmarks, self.beats.landmarks)
+
+    def test_save(self):
+        # Make sure tables are loaded as they were saved
+        with tempfile.TemporaryDirectory() as dir_table:
+            file_table = str(Path(dir_table, 'beats.npz'))
+            self.beats.save(file_table)
+            beats_loaded = BeatTable.load(file_table)
+        np.testing.assert_equal(beats_loaded.landmarks, self.beats.landmarks)
+        np.testing.assert_equal(beats_loaded.windows, self.beats.windows)
+        self.assertEqual(beats_loaded.cycle, self.beats.cycle)
+
+
 class TestErrorSignal(unittest.TestCase):
     def setUp(self):
         # Create data to test with
@@ -1410,5 +1928,41 @@ class TestErrorSignal(unittest.TestCase):
         fig_stats_scatter.show()
 
 
+class TestMapValid(unittest.TestCase):
+    def setUp(self):
+        # Create data to test with, a propagating stack of Ca transients
+        self.size = (10, 10)
+        self.time_ca, self.stack_ca = model_stack_propagation(
+            model_type='Ca', size=self.size, t=200, t0=20)
+        self.stack_ca = model_noise(self.stack_ca, 2)
+        self.stack_ca[:, :2, :2] = 0  # masked pixels
+        self.stack_ca[:, -1, :] = 500  # constant pixels
+        self.stack_ca[:, -2, :] = (np.arange(self.stack_ca.shape[0]) % 5)[:, np.newaxis]  # too few distinct values
+        self.mask = np.full(self.size, False)
+        self.mask[4, 4] = True
+
+    def test_params(self):
+        # Make sure type errors are raised when necessary
+        stack_bad_shape = np.full((100, 100), 100, dtype=np.uint16)
+        self.assertRaises(TypeError, map_valid, stack_in=True)
+        self.assertRaises(TypeError, map_valid, stack_in=stack_bad_shape)
+        self.assertRaises(TypeError, map_valid, stack_in=self.stack_ca, mask=True)
+
+        # Make sure parameters are valid, and valid errors are raised when necessary
+        self.assertRaises(ValueError, map_valid, stack_in=self.stack_ca, mask=self.mask[1:])
+
+    def test_results(self):
+        # Make sure the valid map matches the flat signal test of each pixel
+        map_ideal = np.full(self.size, False)
+        for iy, ix in np.ndindex(self.size):
+            map_ideal[iy, ix] = len(np.unique(self.stack_ca[:, iy, ix])) >= UNIQUE_MIN
+
+        map_out = map_valid(self.stack_ca)
+        self.assertEqual(map_out.dtype, bool)
+        np.testing.assert_equal(map_out, map_ideal)
+        np.testing.assert_equal(map_valid(self.stack_ca, tile_bytes=1000), map_ideal)
+        np.testing.assert_equal(map_valid(self.stack_ca, mask=self.mask), map_ideal & ~self.mask)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,7 @@
 from util.processing import *
+from util.processing import _tran_peak, _tran_baselines, _tran_act, _tran_snr, _map_valid_tile, _map_baselines_tile
 import time
+from functools import wraps
 import numpy as np
 from scipy.signal import savgol_filter
 from scipy.misc import derivative
@@ -16,6 +18,218 @@ DUR_MIN = 20
 DUR_MAX = 300
 # Colormap and normalization limits for EC Coupling maps (ms)
 EC_MAX = 50
+# Transient features that can be mapped together
+MAP_FEATURES = ['snr', 'start', 'activation', 'downstroke', 'end', 'duration']
+
+
+def _memoized(method):
+    # A read-only property, calculated once per TransientFeatures object
+    name = method.__name__
+
+    @wraps(method)
+    def feature(self):
+        if name not in self._features:
+            self._features[name] = method(self)
+        return self._features[name]
+
+    return property(feature)
+
+
+class TransientFeatures:
+    """Analysis points and features of a single transient signal,
+    each calculated only when first needed and then reused
+    (e.g. one peak search and one LSQ derivative spline for SNR, Start, Activation and Durations)
+
+        Parameters
+        ----------
+        signal_in : ndarray
+            The array of data to be evaluated, dtype : uint16 or float
+        valid : bool, optional
+            Whether signal_in is already known to be analyzable (see map_valid),
+            skipping the flat signal check of find_tran_peak
+        peak : int or float, optional
+            The index of the peak if already found (e.g. by find_tran_peaks), or NaN if no peak was detected
+        baselines : ndarray or float, optional
+            The baseline indexes if already found (e.g. by find_tran_baselines_signals), or NaN if incalculable
+
+        Attributes
+        ----------
+        peak : np.int64
+            The index of the peak, or NaN if no peak was detected (see find_tran_peak)
+        baselines : ndarray
+            The indexes of the pre-upstroke baseline, or NaN (see find_tran_baselines)
+        spline : ndarray
+            The LSQ spline of the signal at SPLINE_FIDELITY resolution (see spline_signal)
+        df : ndarray
+            The 1st derivative of the LSQ spline (see spline_deriv)
+        df2 : ndarray
+            The 1st derivative of a LSQ spline of df, at SPLINE_FIDELITY ** 2 resolution
+        snr : tuple
+            snr, rms_bounds, peak_peak, sd_noise, ir_noise, ir_peak (see calculate_snr)
+        start, activation, downstroke, end : np.int64
+            Indexes of the signal's analysis points, or NaN if incalculable
+
+        Notes
+        -----
+            Use duration(percent) for any number of duration percentages, each is also calculated once.
+        """
+
+    def __init__(self, signal_in, valid=None, peak=None, baselines=None):
+        # Check parameters
+        if type(signal_in) is not np.ndarray:
+            raise TypeError('Signal data type must be an "ndarray"')
+        if signal_in.dtype not in [np.uint16, np.float32, np.float64]:
+            raise TypeError('Signal values must either be "int" or "float"')
+
+        self.signal = signal_in
+        self.valid = valid
+        self._features = {}
+        self._durations = {}
+        if peak is not None:
+            self._features['peak'] = np.nan if np.isnan(peak) else np.int64(peak)
+        if baselines is not None:
+            self._features['baselines'] = baselines
+
+    @_memoized
+    def peak(self):
+        if self.valid:
+            return _tran_peak(self.signal)
+        if self.valid is False:
+            return np.nan
+        return find_tran_peak(self.signal)
+
+    @_memoized
+    def coeffs(self):
+        x_spline, t_full, basis_fit, basis_eval = \
+            spline_operators(len(self.signal), SPLINE_KNOTS, SPLINE_DEGREE, SPLINE_FIDELITY)
+        return basis_fit @ self.signal
+
+    @_memoized
+    def spline(self):
+        x_spline, t_full, basis_fit, basis_eval = \
+            spline_operators(len(self.signal), SPLINE_KNOTS, SPLINE_DEGREE, SPLINE_FIDELITY)
+        return basis_eval[0] @ self.coeffs
+
+    @_memoized
+    def df(self):
+        x_spline, t_full, basis_fit, basis_eval = \
+            spline_operators(len(self.signal), SPLINE_KNOTS, SPLINE_DEGREE, SPLINE_FIDELITY)
+        return basis_eval[1] @ self.coeffs
+
+    @_memoized
+    def df2(self):
+        xdf2, df2_spline = spline_deriv(self.df)
+        return df2_spline
+
+    @_memoized
+    def baselines(self):
+        if self.peak is np.nan:
+            return np.nan
+        return _tran_baselines(self.signal, self.peak, self.df)
+
+    @_memoized
+    def snr(self):
+        if self.peak is np.nan:
+            return np.nan, np.nan, np.nan, np.nan, np.nan, np.nan
+        return _tran_snr(self.signal, self.peak, self.baselines)
+
+    @_memoized
+    def activation(self):
+        if self.peak is np.nan or self.baselines is np.nan:
+            return np.nan
+        return _tran_act(self.signal, self.peak, self.baselines, self.df)
+
+    @_memoized
+    def start(self):
+        # Limit search to
+        # before the peak and after the mid-baseline began
+        if self.peak is np.nan or self.baselines is np.nan:
+            return np.nan
+        i_search_l = self.baselines[int(len(self.baselines) / 2)]
+        i_search_r = self.peak
+
+        # find the 2nd derivative max within the search area
+        i_df_start = np.argmax(self.df2[i_search_l * SPLINE_FIDELITY * SPLINE_FIDELITY:
+                                        i_search_r * SPLINE_FIDELITY * SPLINE_FIDELITY])
+        i_start = i_search_l + int(i_df_start / SPLINE_FIDELITY / SPLINE_FIDELITY)
+
+        return i_start
+
+    @_memoized
+    def downstroke(self):
+        # Limit search to after the peak and before the end
+        if self.peak is np.nan:
+            return np.nan
+        search_min = self.peak
+        search_max = len(self.signal) - SPLINE_FIDELITY
+        # find the 1st derivative min within the search area
+        i_start_search = int(np.argmin(
+            self.df[search_min * SPLINE_FIDELITY:search_max * SPLINE_FIDELITY]) / SPLINE_FIDELITY)  # df min
+        i_downstroke = search_min + i_start_search
+
+        return i_downstroke
+
+    @_memoized
+    def end(self):
+        snr, rms_bounds, peak_peak, sd_noise, ir_noise, i_peak = self.snr
+        if snr is np.nan:
+            return np.nan
+
+        # Limit search to after the Downstroke and before a the end of the ending baseline
+        i_search_l = self.downstroke
+        cutoff = rms_bounds[0]  # TODO use baseline LSQ spline to the RIGHT of the peak
+
+        i_search = i_peak + np.where(self.signal[i_peak:] <= cutoff)
+        if len(i_search) == 0:
+            return np.nan  # exclusion criteria: transient does not return to cutoff value
+        if len(i_search[0]) == 0:
+            return np.nan  # exclusion criteria: transient does not return to cutoff value
+        i_search_r = i_search[0][-1]
+
+        # find the 2nd derivative max within the search area
+        i_df_start = np.argmax(self.df2[i_search_l * SPLINE_FIDELITY * SPLINE_FIDELITY:
+                                        i_search_r * SPLINE_FIDELITY * SPLINE_FIDELITY])
+        i_end = i_search_l + int(i_df_start / SPLINE_FIDELITY / SPLINE_FIDELITY)
+
+        return i_end
+
+    def duration(self, percent=80):
+        """The % duration of the transient in number of indices (see calc_tran_duration)"""
+        if percent not in self._durations:
+            self._durations[percent] = self._duration(percent)
+        return self._durations[percent]
+
+    def _duration(self, percent):
+        i_peak = self.peak
+        i_baselines = self.baselines
+        if i_baselines is np.nan:
+            return np.nan
+        baselines_rms = np.sqrt(np.mean(self.signal[i_baselines]) ** 2)
+        peak_peak = self.signal[i_peak] - baselines_rms
+        cutoff = baselines_rms + (float(peak_peak) * float(((100 - percent) / 100)))
+
+        i_spline_search = np.where(self.spline[i_peak * SPLINE_FIDELITY:] <= cutoff)
+
+        if len(i_spline_search) == 0 or len(i_spline_search[0]) == 0:
+            return np.nan  # exclusion criteria: transient does not return to cutoff value
+        i_cutoff = i_peak + int(i_spline_search[0][0] / SPLINE_FIDELITY)
+
+        i_activation = self.activation
+        if i_activation is np.nan or i_activation > i_peak:
+            return np.nan  # exclusion criteria: peak seems to before activation
+        duration = i_cutoff - i_activation
+
+        if duration < DUR_MIN:
+            return np.nan  # exclusion criteria: transient does not return to cutoff value
+
+        return duration
+
+
+def _pixel_features(signal_in, baselines_found):
+    # TransientFeatures of a pixel, given its peak, first and after-last baseline indexes (see _map_baselines_tile)
+    i_peak, i_start, i_end = baselines_found
+    baselines = np.nan if np.isnan(i_start) else np.arange(i_start, i_end, dtype=int)
+    return TransientFeatures(signal_in, peak=i_peak, baselines=baselines)
 
 
 # TODO finish remaining analysis point algorithms
@@ -42,20 +256,7 @@ def find_tran_start(signal_in):
     # if any(v < 0 for v in signal_in):
     #     raise ValueError('All signal values must be >= 0')
 
-    # Limit search to
-    # before the peak and after the mid-baseline began
-    baselines = find_tran_baselines(signal_in)
-    i_search_l = baselines[int(len(baselines) / 2)]
-    i_search_r = find_tran_peak(signal_in)
-
-    xdf, df_spline = spline_deriv(signal_in)
-    xdf2, df2_spline = spline_deriv(df_spline)
-    # find the 2nd derivative max within the search area
-    i_df_start = np.argmax(df2_spline[i_search_l * SPLINE_FIDELITY * SPLINE_FIDELITY:
-                                      i_search_r * SPLINE_FIDELITY * SPLINE_FIDELITY])
-    i_start = i_search_l + int(i_df_start / SPLINE_FIDELITY / SPLINE_FIDELITY)
-
-    return i_start
+    return TransientFeatures(signal_in).start
 
 
 def find_tran_downstroke(signal_in):
@@ -78,17 +279,7 @@ def find_tran_downstroke(signal_in):
     if signal_in.dtype not in [np.uint16, np.float32]:
         raise TypeError('Signal values must either be "int" or "float"')
 
-    # Limit search to after the peak and before the end
-    i_peak = find_tran_peak(signal_in)
-    search_min = i_peak
-    search_max = len(signal_in) - SPLINE_FIDELITY
-    xdf, df_spline = spline_deriv(signal_in)
-    # find the 2nd derivative max within the search area
-    i_start_search = int(np.argmin(
-        df_spline[search_min * SPLINE_FIDELITY:search_max * SPLINE_FIDELITY]) / SPLINE_FIDELITY)  # df min, Downstroke
-    i_downstroke = search_min + i_start_search
-
-    return i_downstroke
+    return TransientFeatures(signal_in).downstroke
 
 
 def find_tran_end(signal_in):
@@ -108,34 +299,10 @@ def find_tran_end(signal_in):
     # Check parameters
     if type(signal_in) is not np.ndarray:
         raise TypeError('Signal data type must be an "ndarray"')
-    if signal_in.dtype not in [np.uint16, float]:
+    if signal_in.dtype not in [np.uint16, np.float32, float]:
         raise TypeError('Signal values must either be "int" or "float"')
 
-    i_downstroke = find_tran_downstroke(signal_in)
-
-    # Limit search to after the Downstroke and before a the end of the ending baseline
-    i_search_l = i_downstroke
-
-    snr, rms_bounds, peak_peak, sd_noise, ir_noise, i_peak = calculate_snr(signal_in)
-    cutoff = rms_bounds[0]  # TODO use baseline LSQ spline to the RIGHT of the peak
-
-    i_search = i_peak + np.where(signal_in[i_peak:] <= cutoff)
-    if len(i_search) == 0:
-        return np.nan  # exclusion criteria: transient does not return to cutoff value
-    if len(i_search[0]) == 0:
-        return np.nan  # exclusion criteria: transient does not return to cutoff value
-    i_search_r = i_search[0][-1]
-    # search_min = i_peak
-    # search_max = len(signal_in) - SPLINE_FIDELITY
-
-    xdf, df_spline = spline_deriv(signal_in)
-    xdf2, df2_spline = spline_deriv(df_spline)
-    # find the 2nd derivative max within the search area
-    i_df_start = np.argmax(df2_spline[i_search_l * SPLINE_FIDELITY * SPLINE_FIDELITY:
-                                      i_search_r * SPLINE_FIDELITY * SPLINE_FIDELITY])
-    i_end = i_search_l + int(i_df_start / SPLINE_FIDELITY / SPLINE_FIDELITY)
-
-    return i_end
+    return TransientFeatures(signal_in).end
 
 
 def calc_tran_activation(signal_in):
@@ -156,7 +323,7 @@ def calc_tran_activation(signal_in):
     # Check parameters
     if type(signal_in) is not np.ndarray:
         raise TypeError('Signal data type must be an "ndarray"')
-    if signal_in.dtype not in [np.uint16, float]:
+    if signal_in.dtype not in [np.uint16, np.float32, float]:
         raise TypeError('Signal values must either be "int" or "float"')
 
     if any(v < 0 for v in signal_in):
@@ -192,32 +359,7 @@ def calc_tran_duration(signal_in, percent=80):
     if percent < 0 or percent >= 100:
         raise ValueError('Percent must be between 0-99%')
 
-    xs, signal_sql = spline_signal(signal_in)
-    signal_spline = signal_sql(xs)
-
-    i_peak = find_tran_peak(signal_in)
-    i_baselines = find_tran_baselines(signal_in)
-    if i_baselines is np.nan:
-        return np.nan
-    baselines_rms = np.sqrt(np.mean(signal_in[i_baselines]) ** 2)
-    peak_peak = signal_in[i_peak] - baselines_rms
-    cutoff = baselines_rms + (float(peak_peak) * float(((100 - percent) / 100)))
-
-    i_spline_search = np.where(signal_spline[i_peak * SPLINE_FIDELITY:] <= cutoff)
-
-    if len(i_spline_search) == 0 or len(i_spline_search[0]) == 0:
-        return np.nan  # exclusion criteria: transient does not return to cutoff value
-    i_cutoff = i_peak + int(i_spline_search[0][0] / SPLINE_FIDELITY)
-
-    i_activation = find_tran_act(signal_in)
-    if i_activation is np.nan or i_activation > i_peak:
-        return np.nan  # exclusion criteria: peak seems to before activation
-    duration = i_cutoff - i_activation
-
-    if duration < DUR_MIN:
-        return np.nan  # exclusion criteria: transient does not return to cutoff value
-
-    return duration
+    return TransientFeatures(signal_in).duration(percent)
 
 
 def calc_tran_tau(signal_in):
@@ -267,7 +409,13 @@ def calc_tran_di(signal_in):
         raise TypeError('Signal values must either be "int" or "float"')
 
 
-def map_tran_analysis(stack_in, analysis_type, time_in=None, raw_data=False, **kwargs):
+# Analysis types mapped with TransientFeatures, sharing each pixel's peak search and splines
+_ANALYSIS_FEATURES = {find_tran_start: 'start', find_tran_act: 'activation', find_tran_downstroke: 'downstroke',
+                      find_tran_end: 'end', calc_tran_duration: 'duration'}
+
+
+def map_tran_analysis(stack_in, analysis_type, time_in=None, raw_data=False, workers=None,
+                      tile_bytes=TILE_BYTES, progress=None, cancel=None, **kwargs):
     """Map an analysis point's values for a stack of transient fluorescent data
         i.e.
 
@@ -282,6 +430,15 @@ def map_tran_analysis(stack_in, analysis_type, time_in=None, raw_data=False, **k
             If used, map values are timestamps
         raw_data : bool
             Whether to return unconditioned activation times default : False
+        workers : int, optional
+            The number of worker processes to use (see map_tiles), default is None
+            If used, analysis_type must be a module-level function
+        tile_bytes : int
+            The memory budget (bytes) of each tile (see map_tiles), default is TILE_BYTES
+        progress : function, optional
+            Called as progress(done, total) between tiles (see map_tiles)
+        cancel : threading.Event, optional
+            Checked between tiles, once set a CancelledError is raised (see map_tiles)
 
         Returns
         -------
@@ -294,53 +451,168 @@ def map_tran_analysis(stack_in, analysis_type, time_in=None, raw_data=False, **k
         raise TypeError('Stack type must be an "ndarray"')
     if len(stack_in.shape) is not 3:
         raise TypeError('Stack must be a 3-D ndarray (T, Y, X)')
-    if stack_in.dtype not in [np.uint16, float]:
-        raise TypeError('Stack values must either be "np.uint16" or "float"')
+    if stack_in.dtype not in [np.uint16, np.float32, float]:
+        raise TypeError('Stack values must either be "np.uint16", "np.float32" or "float"')
 
     # if type(analysis_type) is not classmethod:
     #     raise TypeError('Analysis type must be a "classmethod"')
+    if analysis_type is calc_tran_duration:
+        percent = kwargs.get('percent', 80)
+        if type(percent) is not int:
+            raise TypeError('Percent data type must be an "int"')
+        if percent < 0 or percent >= 100:
+            raise ValueError('Percent must be between 0-99%')
 
     # print('Generating map with {} ...'.format(analysis_type))
-    map_shape = stack_in.shape[1:]
-    map_out = np.empty(map_shape)
+    map_out = map_tiles(stack_in, _map_analysis_tile, workers=workers, tile_bytes=tile_bytes,
+                        progress=progress, cancel=cancel,
+                        analysis_type=analysis_type, time_in=time_in, kwargs=kwargs)
+
+    # If mapping activation, align times with the "first" aka lowest activation time
+    if analysis_type is find_tran_act and raw_data is False:
+        map_out = map_out - np.nanmin(map_out)
+
+    print('\nDONE Generating map')
+
+    return map_out
+
 
-    # # Calculate with parallel processing
-    # with Pool(5) as p:
-    #     p.map()
+def _map_analysis_tile(stack_in, analysis_type, time_in, kwargs):
+    """Map an analysis point's values for each pixel in a tile of a stack"""
+    map_out = np.full(stack_in.shape[1:], np.nan)
+    feature = _ANALYSIS_FEATURES.get(analysis_type)
 
-    # Assign a value to each pixel
-    for iy, ix in np.ndindex(map_shape):
-        # print('\r\tRow:\t{}\t/ {}\tx\tCol:\t{}\t/ {}'.format(iy + 1, map_shape[0], ix + 1, map_shape[1]), end='',
-        #       flush=True)
+    # Assign a value to each analyzable pixel (or pixel with a peak, for features),
+    # masked (0 at every frame) or masked and spatially filtered (constant at every frame) pixels remain NaN
+    if feature is None:
+        pixels = np.argwhere(_map_valid_tile(stack_in))
+    else:
+        maps_baselines = _map_baselines_tile(stack_in)
+        pixels = np.argwhere(~np.isnan(maps_baselines[0]))
+    for iy, ix in pixels:
         pixel_data = stack_in[:, iy, ix]
-        # Check if pixel has been masked (0 at every frame)
-        # # or was masked and spatially filtered (constant at every frame)
-        # peak = find_tran_peak(pixel_data)
-        # if peak is np.nan:  # if there's no detectable peak
-        #     pixel_analysis_value = np.NaN
-
-        unique, counts = np.unique(pixel_data, return_counts=True)
-        if len(unique) < 10:  # signal is too flat to have a valid peak
-            pixel_analysis_value = np.NaN
-            map_out[iy, ix] = pixel_analysis_value
-        else:
+        if feature is None:
             analysis_result = analysis_type(pixel_data, **kwargs)
-            if analysis_result is np.nan:
-                map_out[iy, ix] = np.nan
+        elif feature == 'duration':
+            analysis_result = _pixel_features(pixel_data, maps_baselines[:, iy, ix]).duration(**kwargs)
+        else:
+            analysis_result = getattr(_pixel_features(pixel_data, maps_baselines[:, iy, ix]), feature)
+
+        if analysis_result is not np.nan:
+            if time_in is not None:
+                pixel_analysis_value = time_in[analysis_result]  # TODO catch issue w/ duration when t[0] != 0
             else:
-                if time_in is not None:
-                    pixel_analysis_value = time_in[analysis_result]  # TODO catch issue w/ duration when t[0] != 0
-                else:
-                    pixel_analysis_value = analysis_result
-                map_out[iy, ix] = pixel_analysis_value
+                pixel_analysis_value = analysis_result
+            map_out[iy, ix] = pixel_analysis_value
+
+    return map_out
+
+
+def map_tran_features(stack_in, time_in=None, metrics=None, percents=(20, 80, 90), raw_data=False,
+                      workers=None, tile_bytes=TILE_BYTES, progress=None, cancel=None):
+    """Map several transient features of a stack in a single pass,
+    calculating each pixel's peak, baselines and LSQ splines only once (see TransientFeatures)
+
+        Parameters
+        ----------
+        stack_in : ndarray
+            A 3-D array (T, Y, X) of an optical transient, dtype : uint16 or float
+        time_in : ndarray, optional
+            The array of timestamps (ms) corresponding to stack_in, dtype : int or float
+            If used, map values of analysis points and durations are timestamps
+        metrics : list, optional
+            The features to map, any of MAP_FEATURES, default is all of them
+        percents : list or tuple of ints
+            The percentages of each duration map (e.g. APD-80, CAD-90), default is (20, 80, 90)
+        raw_data : bool
+            Whether to return unconditioned activation times, default : False
+        workers : int, optional
+            The number of worker processes to use (see map_tiles), default is None
+        tile_bytes : int
+            The memory budget (bytes) of each tile (see map_tiles), default is TILE_BYTES
+        progress : function, optional
+            Called as progress(done, total) between tiles (see map_tiles)
+        cancel : threading.Event, optional
+            Checked between tiles, once set a CancelledError is raised (see map_tiles)
+
+        Returns
+        -------
+        maps : dict
+            2-D arrays of feature values (dtype : float) keyed by metric,
+            with duration maps keyed by percent, e.g. 'duration_80'
+
+        Notes
+        -----
+            Pixels with incalculable features are assigned a value of NaN
+        """
+    # Check parameters
+    if type(stack_in) is not np.ndarray:
+        raise TypeError('Stack type must be an "ndarray"')
+    if len(stack_in.shape) != 3:
+        raise TypeError('Stack must be a 3-D ndarray (T, Y, X)')
+    if stack_in.dtype not in [np.uint16, np.float32, float]:
+        raise TypeError('Stack values must either be "np.uint16", "np.float32" or "float"')
+    if metrics is None:
+        metrics = MAP_FEATURES
+    if type(metrics) not in [list, tuple]:
+        raise TypeError('Metrics must be a list')
+    if type(percents) not in [list, tuple] or any(type(percent) is not int for percent in percents):
+        raise TypeError('Percents must be a list of "int"')
+
+    for metric in metrics:
+        if metric not in MAP_FEATURES:
+            raise ValueError('Metrics must be any of the following: {}'.format(MAP_FEATURES))
+    for percent in percents:
+        if percent < 0 or percent >= 100:
+            raise ValueError('Percent must be between 0-99%')
+
+    features_mapped = [(metric, None) for metric in metrics if metric != 'duration']
+    map_keys = [metric for metric, _ in features_mapped]
+    if 'duration' in metrics:
+        features_mapped = features_mapped + [('duration', percent) for percent in percents]
+        map_keys = map_keys + ['duration_{}'.format(percent) for percent in percents]
+    maps_stacked = map_tiles(stack_in, _map_features_tile, workers=workers, tile_bytes=tile_bytes,
+                             progress=progress, cancel=cancel, time_in=time_in, features_mapped=features_mapped)
+    maps = dict(zip(map_keys, maps_stacked))
 
     # If mapping activation, align times with the "first" aka lowest activation time
-    if analysis_type is find_tran_act and raw_data is False:
-        map_out = map_out - np.nanmin(map_out)
+    if 'activation' in maps and raw_data is False and not np.isnan(maps['activation']).all():
+        maps['activation'] = maps['activation'] - np.nanmin(maps['activation'])
 
-    print('\nDONE Generating map')
+    return maps
 
-    return map_out
+
+def _map_features_tile(stack_in, time_in, features_mapped):
+    """Map transient features for each pixel in a tile of a stack,
+    stacked in the order of features_mapped, a list of (metric, percent) with percent None if unused"""
+    map_shape = stack_in.shape[1:]
+    maps = np.full((len(features_mapped),) + map_shape, np.nan)
+
+    # SNRs are calculated for every pixel at once
+    maps_baselines = _map_baselines_tile(stack_in)
+    if ('snr', None) in features_mapped:
+        signals = stack_in.reshape(stack_in.shape[0], -1).T
+        snr = calculate_snr_signals(signals, *maps_baselines.reshape(3, -1))[0]
+        maps[features_mapped.index(('snr', None))] = snr.reshape(map_shape)
+
+    # Assign each other feature's value to each pixel with a peak
+    for iy, ix in np.argwhere(~np.isnan(maps_baselines[0])):
+        features = _pixel_features(stack_in[:, iy, ix], maps_baselines[:, iy, ix])
+        for i_map, (metric, percent) in enumerate(features_mapped):
+            if metric == 'snr':
+                continue
+            elif metric == 'duration':
+                value = features.duration(percent)
+            else:
+                value = getattr(features, metric)
+
+            if value is np.nan:
+                continue
+            if time_in is not None:
+                value = time_in[value]
+            maps[i_map, iy, ix] = value
+
+    return maps
 
 
 def map_tran_tau(stack_in):
@@ -438,14 +710,18 @@ def map_coupling(map_vm, map_ca):
         Parameters
         ----------
         map_vm : ndarray
-            The array of optical voltage data to be evaluated, dtype : uint16 or float
+            A 2-D array of voltage activation times, dtype : uint16 or float
         map_ca : ndarray
-            The array of optical calcium data to be evaluated, dtype : uint16 or float
+            A 2-D array of calcium activation times, dtype : uint16 or float
 
         Returns
         -------
         map_coupling : ndarray
-            A 2-D array of analysis values, dtype : uint16 or float
+            A 2-D array of analysis values, dtype : float
+
+        Notes
+        -----
+            Pixels missing either activation time, or with coupling times < 0 or > EC_MAX, are assigned NaN
         """
     # Check parameters
 
@@ -459,21 +735,113 @@ def map_coupling(map_vm, map_ca):
             or map_ca.dtype not in [np.uint16, np.float32, np.float64]:
         raise TypeError('Map values must either be "int" or "float"')
 
-    map_ec = np.empty_like(map_ca)
+    map_vm = map_vm.astype(float)
+    map_ca = map_ca.astype(float)
+    map_ec = map_ca - map_vm
+    # Exclude pixels missing either activation time and those with Ca activating first or too late
+    with np.errstate(invalid='ignore'):
+        map_ec[(map_ec < 0) | (map_ec > EC_MAX)] = np.nan
 
-    for x, row in enumerate(map_vm):
-        for y, val_vm in enumerate(row):
-            val_ca = map_ca[x][y]
+    return map_ec
 
-            if val_vm == np.nan or val_ca == np.nan or val_vm > val_ca:
-                map_ec[x][y] = np.nan
-                continue
 
-            val_ec = val_ca - val_vm
-            if val_ec < 0 or val_ec > EC_MAX:
-                map_ec[x][y] = np.nan
-                continue
+def map_coupling_stacks(stack_vm, stack_ca, time_in=None, workers=None,
+                        tile_bytes=TILE_BYTES, progress=None, cancel=None):
+    """Map the Excitation-Contraction (EC) coupling times of paired voltage and calcium stacks,
+    tiling each stack in turn and pairing their activation maps
 
-            map_ec[x][y] = val_ec
+        Parameters
+        ----------
+        stack_vm : ndarray
+            A 3-D array (T, Y, X) of optical voltage data, dtype : uint16 or float
+        stack_ca : ndarray
+            A 3-D array (T, Y, X) of optical calcium data, aligned with stack_vm, dtype : uint16 or float
+        time_in : ndarray, optional
+            The array of timestamps (ms) corresponding to both stacks, dtype : int or float
+            If used, map values are times (ms)
+        workers : int, optional
+            The number of worker processes to use (see map_tiles), default is None
+        tile_bytes : int
+            The memory budget (bytes) of each tile (see map_tiles), default is TILE_BYTES
+        progress : function, optional
+            Called as progress(done, total) between tiles of both stacks (see map_tiles)
+        cancel : threading.Event, optional
+            Checked between tiles, once set a CancelledError is raised (see map_tiles)
 
-    return map_ec
+        Returns
+        -------
+        map_ec : ndarray
+            A 2-D array of EC coupling times (see map_coupling), dtype : float
+        stats_ec : dict
+            Summary statistics of map_ec (see calc_map_stats)
+        map_act_vm : ndarray
+            A 2-D array of unconditioned voltage activation times, dtype : float
+        map_act_ca : ndarray
+            A 2-D array of unconditioned calcium activation times, dtype : float
+        """
+    # Check parameters
+    if type(stack_vm) is not np.ndarray or type(stack_ca) is not np.ndarray:
+        raise TypeError('Stack type must be an "ndarray"')
+    if len(stack_vm.shape) != 3 or len(stack_ca.shape) != 3:
+        raise TypeError('Stacks must be a 3-D ndarray (T, Y, X)')
+    if stack_vm.dtype not in [np.uint16, np.float32, float] or stack_ca.dtype not in [np.uint16, np.float32, float]:
+        raise TypeError('Stack values must either be "np.uint16", "np.float32" or "float"')
+    if stack_vm.shape != stack_ca.shape:
+        raise ValueError('Stacks must have the same shape:'
+                         '\nVm:\t{}\nCa:\t{}'.format(stack_vm.shape, stack_ca.shape))
+
+    # Map each stack's activations in place, rather than copying both into one stack
+    maps_act = []
+    for i_stack, stack_in in enumerate((stack_vm, stack_ca)):
+        progress_stack = None
+        if progress is not None:
+            # report the tiles of both stacks as one count
+            def progress_stack(done, total, i_stack=i_stack):
+                progress(i_stack * total + done, 2 * total)
+        maps_act.append(map_tiles(stack_in, _map_activation_tile, workers=workers, tile_bytes=tile_bytes,
+                                  progress=progress_stack, cancel=cancel, time_in=time_in))
+    map_act_vm, map_act_ca = maps_act
+
+    map_ec = map_coupling(map_act_vm, map_act_ca)
+    stats_ec = calc_map_stats(map_ec)
+
+    return map_ec, stats_ec, map_act_vm, map_act_ca
+
+
+def _map_activation_tile(stack_in, time_in):
+    """Map the unconditioned activation times of a tile's signals"""
+    map_act = np.full(stack_in.shape[1:], np.nan)
+    maps_baselines = _map_baselines_tile(stack_in)
+    for iy, ix in np.argwhere(~np.isnan(maps_baselines[0])):
+        i_activation = _pixel_features(stack_in[:, iy, ix], maps_baselines[:, iy, ix]).activation
+        if i_activation is np.nan:
+            continue
+        map_act[iy, ix] = i_activation if time_in is None else time_in[i_activation]
+
+    return map_act
+
+
+def calc_map_stats(map_in):
+    """Calculate summary statistics of a map's values, ignoring NaNs
+
+        Parameters
+        ----------
+        map_in : ndarray
+            A 2-D array of analysis values, dtype : uint16 or float
+
+        Returns
+        -------
+        stats : dict
+            n (count of values), min, max, mean, sd (population), and median,
+            with NaN statistics if the map has no values
+        """
+    # Check parameters
+    if type(map_in) is not np.ndarray:
+        raise TypeError('Map data type must be an "ndarray"')
+
+    values = map_in[~np.isnan(map_in)]
+    if len(values) == 0:
+        return {'n': 0, 'min': np.nan, 'max': np.nan, 'mean': np.nan, 'sd': np.nan, 'median': np.nan}
+
+    return {'n': len(values), 'min': values.min(), 'max': values.max(), 'mean': values.mean(),
+            'sd': values.std(), 'median': np.median(values)}
@@ -706,6 +706,35 @@ def model_stack_heart(size=(100, 100), velocity=20, d_noise=0, **kwargs):
 
 
 # Code for example tests
+def model_noise(model_data, noise=2, seed=0):
+    """Add gaussian noise to model data, drawn from a local random number generator
+    instead of numpy's global one (seeded once above).
+
+       Parameters
+       ----------
+       model_data : ndarray
+            An array of model data, dtype : uint16 or float
+       noise : int, float
+            Standard deviation of the gaussian noise, default is 2
+       seed : int
+            Seed of the local random number generator, default is 0
+
+       Returns
+       -------
+       model_noisy : ndarray
+            The model data with noise added, rounded and clipped to 16-bit values if uint16,
+            dtype : model_data.dtype
+       """
+    # Check parameters
+    if type(model_data) is not np.ndarray:
+        raise TypeError('Model data type must be an "ndarray"')
+
+    model_noisy = model_data + np.random.default_rng(seed).normal(0, noise, model_data.shape)
+    if model_data.dtype == np.uint16:
+        return np.clip(np.round(model_noisy), 0, FL_16BIT_MAX).astype(np.uint16)
+    return model_noisy.astype(model_data.dtype)
+
+
 def circle_area(r):
     if r < 0:
         raise ValueError('The radius cannot be negative')
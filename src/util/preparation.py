@@ -1,10 +1,14 @@
 import os
 import time
+import json
+import hashlib
 # from memory_profiler import profile
 from math import floor
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from pathlib import Path, PurePath
 from imageio import volread, volwrite, get_reader
+import tifffile
 from skimage.util import img_as_uint, img_as_float
 from skimage.transform import rescale
 from skimage.filters import sobel, threshold_otsu, threshold_mean
@@ -19,10 +23,42 @@ import cv2
 FL_16BIT_MAX = 2 ** 16 - 1  # Maximum intensity value of a 16-bit pixel: 65535
 MASK_TYPES = ['Otsu_global', 'Mean', 'Random_walk', 'best_ever']
 MASK_STRICT_MAX = 9
+# Container format of every supported stack file, as .pcoraw files are PCO's (Big)TIFF files
+STACK_FORMAT = 'tiff'
+# Floating point dtypes of processed stacks (see set_precision), float32 by default to halve their memory
+PRECISIONS = [np.float32, np.float64]
+_precision = np.float32
+# Suffix of the folders that store stage outputs (see save_stage) within a project folder
+STAGE_SUFFIX = '.ks_stage'
+STAGE_CHUNK_BYTES = 2 ** 26  # Maximum bytes of stack data within each compressed chunk of a stored stage
 
 # TODO move "reduce_stack" from test_Map setUps to a preparation as a new function
 
 
+def set_precision(dtype):
+    """Set the floating point dtype of the processed stacks (e.g. normalized or ensembled) that util functions create.
+
+        Parameters
+        ----------
+        dtype : type
+            np.float32 (default) or np.float64 (aka float)
+
+        Notes
+        -----
+            Stacks passed in keep their dtype. Values calculated within functions
+            (e.g. splines, fits, filters and maps) remain float64.
+        """
+    global _precision
+    if dtype not in PRECISIONS + [float]:
+        raise TypeError('Precision must either be "np.float32" or "np.float64"')
+    _precision = np.dtype(dtype).type
+
+
+def get_precision():
+    """The floating point dtype of the processed stacks that util functions create (see set_precision)"""
+    return _precision
+
+
 def open_signal(source, fps=500):
     """Open an array of optical data from a text file (.csv)
     as a calculated time array and an array of 16-bit arbitrary fluorescent data
@@ -75,7 +111,7 @@ def open_signal(source, fps=500):
     return signal_time, signal_data
 
 
-def open_stack(source, meta=None):
+def open_stack(source, meta=None, lazy=False, frames=None, roi=None):
     """Open a stack of images (.tif, .tiff, .pcoraw) from a file.
 
        Parameters
@@ -84,24 +120,42 @@ def open_stack(source, meta=None):
             The full path to the file
        meta : str, optional
             The full path to a file containing metadata
+       lazy : bool, optional
+            Whether to leave pixel data on disk until it is indexed, default is False
+       frames : tuple, optional
+            The first and after-last frames to read (start, end), default is all frames
+       roi : tuple, optional
+            The first and after-last rows and columns to read (y0, y1, x0, x1), default is whole frames
 
        Returns
        -------
-       stack : ndarray
+       stack : ndarray or TiffStack
             A 3-D array (T, Y, X) of optical data, 16-bit
+            If lazy, a read-only memory-mapped ndarray of uncompressed 16-bit data,
+            or a TiffStack decoding frames on demand
        meta : dict
             A dict of metadata
 
         Notes
         -----
-            Files with .pcoraw extension are converted and saved as .tif.
+            Files with .pcoraw extension are read in place (read-only), as TIFF files.
             Expecting volume dimension order XYCZT
+            Metadata is read without reading pixel data.
+            With frames or roi, only the requested pages are decoded (and only the requested rows are
+            paged in from uncompressed data), and the stack is cropped, e.g. stack[start:end, y0:y1, x0:x1].
        """
     # Check parameter types
     if type(source) not in [str]:
         raise TypeError('Required "source" ' + source + ' parameter must be a string')
     if meta and (type(meta) not in [str]):
         raise TypeError('Optional "meta" ' + meta + ' parameter must be a string')
+    if type(lazy) not in [bool]:
+        raise TypeError('Optional "lazy" parameter must be a bool')
+    if frames is not None and (type(frames) not in [tuple] or len(frames) != 2
+                               or any(type(i) not in [int] for i in frames)):
+        raise TypeError('Optional "frames" parameter must be a tuple of 2 ints (start, end)')
+    if roi is not None and (type(roi) not in [tuple] or len(roi) != 4 or any(type(i) not in [int] for i in roi)):
+        raise TypeError('Optional "roi" parameter must be a tuple of 4 ints (y0, y1, x0, x1)')
 
     # Check validity
     # Make sure the directory, source file, and optional meta file exists
@@ -114,23 +168,36 @@ def open_stack(source, meta=None):
     if meta and not os.path.isfile(meta):
         raise FileNotFoundError('Optional "meta" ' + meta + ' is not a file or does not exist.')
 
-    # If a .pcoraw file, convert to .tiff
-    f_purepath = PurePath(source)
-    f_extension = f_purepath.suffix
-    if f_extension == '.pcoraw':
-        p = Path(source)
-        p.rename(p.with_suffix('.tif'))
-        source = os.path.splitext(source)[0] + '.tif'
-        print('* .pcoraw covnerted to a .tif')
-
     # Open the metadata, if provided
-    stack_meta = get_reader(source, mode='v').get_meta_data()
+    # files are read in place as TIFF containers, whatever their extension (e.g. .pcoraw)
+    with get_reader(source, format=STACK_FORMAT, mode='v') as reader:
+        stack_meta = reader.get_meta_data()
 
     # Open the file
     # file_source = open(source, 'rb')
     # tags = exifread.process_file(file)  # Read EXIF data
-    stack = volread(source)  # Read image data, closes the file after reading
-    stack = img_as_uint(stack)  # Read image data, closes the file after reading
+    stack = None
+    if lazy or frames or roi:
+        stack = _open_stack_lazy(source)
+    if stack is None:
+        stack = volread(source, format=STACK_FORMAT)  # Read image data, closes the file after reading
+        stack = img_as_uint(stack)  # Read image data, closes the file after reading
+    if frames or roi:
+        # Crop before reading, only the requested data is decoded
+        frames = frames if frames else (0, stack.shape[0])
+        roi = roi if roi else (0, stack.shape[1], 0, stack.shape[2])
+        stack_source = stack
+        try:
+            if not 0 <= frames[0] < frames[1] <= stack.shape[0]:
+                raise ValueError('Frames {} must be within the stack\'s {} frames'.format(frames, stack.shape[0]))
+            if not (0 <= roi[0] < roi[1] <= stack.shape[1]) or not (0 <= roi[2] < roi[3] <= stack.shape[2]):
+                raise ValueError('ROI {} must be within the stack\'s frames {}'.format(roi, stack.shape[1:]))
+            stack = stack[frames[0]:frames[1], roi[0]:roi[1], roi[2]:roi[3]]
+        finally:
+            if type(stack_source) is TiffStack:
+                stack_source.close()  # the crop is decoded into an ndarray, release the file
+        if not lazy and not stack.flags.owndata:
+            stack = stack.copy()  # release the memory map, or the rest of the stack
 
     if meta:
         file_meta = open(meta)
@@ -141,6 +208,282 @@ def open_stack(source, meta=None):
     return stack, meta
 
 
+def _open_stack_lazy(source):
+    # A memory-mapped array or a TiffStack of a TIFF stack (T, Y, X), or None if it must be read entirely
+    try:
+        stack = TiffStack(source)
+    except ValueError:  # not a 3-D TIFF volume
+        return None
+    if stack.dtype_source != np.uint16:
+        return stack
+    try:
+        # uncompressed, contiguous 16-bit data are paged in by the OS as they are indexed
+        stack_memmap = np.asarray(tifffile.memmap(source, mode='r'))
+    except ValueError:
+        return stack
+    stack.close()
+    return stack_memmap
+
+
+class TiffStack:
+    """A read-only stack (T, Y, X) of the frames of a TIFF file, each decoded only when it is indexed
+    (e.g. stack[100:200] decodes 100 frames)
+
+        Parameters
+        ----------
+        source : str
+            The full path to the file
+
+        Attributes
+        ----------
+        shape : tuple
+            The shape of the stack (T, Y, X)
+        dtype : numpy.dtype
+            The dtype of indexed data, uint16
+        dtype_source : numpy.dtype
+            The dtype of the file's data, converted with img_as_uint when indexed
+        ndim : int
+            The number of dimensions, 3
+
+        Notes
+        -----
+            Indexing returns an ndarray, np.asarray(stack) decodes every frame.
+            The file stays open until close() is called or the stack is garbage collected.
+        """
+
+    def __init__(self, source):
+        self._tif = tifffile.TiffFile(source)
+        series = self._tif.series[0]
+        if len(series.shape) != 3:
+            self._tif.close()
+            raise ValueError('TIFF series must be a 3-D volume (T, Y, X), not {}'.format(series.shape))
+        self.shape = tuple(series.shape)
+        self.dtype_source = np.dtype(series.dtype)
+        self.dtype = np.dtype(np.uint16)
+        self.ndim = 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        key = key if type(key) is tuple else (key,)
+        frames = np.arange(self.shape[0])[key[0]]
+        if np.ndim(frames) == 0:
+            stack = self._tif.asarray(key=int(frames), series=0)
+            key_frame = key[1:]
+        elif len(frames) == 0:
+            stack = np.empty((0,) + self.shape[1:], dtype=self.dtype_source)
+            key_frame = (slice(None),) + key[1:]
+        else:
+            stack = self._tif.asarray(key=frames.tolist(), series=0).reshape((len(frames),) + self.shape[1:])
+            key_frame = (slice(None),) + key[1:]
+        return img_as_uint(stack[key_frame])
+
+    def __array__(self, dtype=None):
+        stack = self[:]
+        return stack if dtype is None else stack.astype(dtype)
+
+    def close(self):
+        self._tif.close()
+
+
+def stack_key(parent, stage=None, params=None):
+    """Hash key of a stack's data, or of a stage output calculated from its input and the stage's parameters
+
+        Parameters
+        ----------
+        parent : ndarray or str
+            The input stack of the stage, or the key of the stage that output it
+        stage : str, optional
+            The name of the stage (e.g. 'Bin'), default is None for the key of the parent itself
+        params : dict, optional
+            The parameters of the stage, must be JSON serializable
+
+        Returns
+        -------
+        key : str
+            A hexadecimal hash, the same for the same input, stage and parameters
+        """
+    # Check parameter types
+    if type(parent) not in [np.ndarray, str]:
+        raise TypeError('Parent must be an "ndarray" or a "str" key')
+    if stage is not None and type(stage) not in [str]:
+        raise TypeError('Stage must be a "str"')
+
+    if type(parent) is np.ndarray:
+        key_hash = hashlib.blake2b(digest_size=20)
+        key_hash.update(json.dumps([parent.shape, parent.dtype.str]).encode())
+        # hash frame by frame to avoid copying the whole stack
+        for frame in parent.reshape((-1,) + parent.shape[-2:]) if parent.ndim > 2 else [parent]:
+            key_hash.update(np.ascontiguousarray(frame).data)
+        parent = key_hash.hexdigest()
+    if stage is None:
+        return parent
+    key_hash = hashlib.blake2b(digest_size=20)
+    key_hash.update(json.dumps([parent, stage, params], sort_keys=True).encode())
+    return key_hash.hexdigest()
+
+
+def save_stage(project, stack_in, stage, parent, params=None, extras=None,
+               chunk_bytes=STAGE_CHUNK_BYTES, progress=None):
+    """Save the output of a stage to a project folder, as compressed chunks of frames,
+    keyed by its input and the stage's parameters (see stack_key)
+
+        Parameters
+        ----------
+        project : str
+            The full path to the project folder
+        stack_in : ndarray
+            The output of the stage, e.g. a 3-D array (T, Y, X) of optical data
+        stage : str
+            The name of the stage (e.g. 'Bin')
+        parent : ndarray or str
+            The input stack of the stage, or the key of the stage that output it
+        params : dict, optional
+            The parameters of the stage, must be JSON serializable
+        extras : dict, optional
+            Other arrays to store with the stage (e.g. {'mask': mask})
+        chunk_bytes : int
+            The maximum bytes of stack data within each chunk, default is STAGE_CHUNK_BYTES
+        progress : function, optional
+            Called as progress(done, total) after each chunk is written
+
+        Returns
+        -------
+        key : str
+            The key of the stored stage, to load it with load_stage or to use as the parent of the next stage
+
+        Notes
+        -----
+            The stage's metadata is written last, so an interrupted save is never loaded.
+        """
+    # Check parameter types
+    if type(stack_in) is not np.ndarray:
+        raise TypeError('Stack type must be an "ndarray"')
+    if type(chunk_bytes) is not int:
+        raise TypeError('Chunk bytes must be an "int"')
+    # Check parameter validity
+    if not os.path.isdir(project):
+        raise FileNotFoundError('Project folder ' + str(project) + ' is not a folder or does not exist.')
+    if chunk_bytes < 1:
+        raise ValueError('Chunk bytes must be > 0')
+
+    parent_key = stack_key(parent)
+    key = stack_key(parent_key, stage, params)
+    stage_path = Path(project, key + STAGE_SUFFIX)
+    stage_path.mkdir(exist_ok=True)
+    meta_path = stage_path / 'meta.json'
+    if meta_path.exists():
+        meta_path.unlink()
+
+    frame_bytes = max(stack_in[:1].nbytes, 1)
+    chunk_frames = max(chunk_bytes // frame_bytes, 1)
+    chunk_n = max(-(-len(stack_in) // chunk_frames), 1)
+    for chunk in range(chunk_n):
+        np.savez_compressed(str(stage_path / 'chunk_{:05d}.npz'.format(chunk)),
+                            data=stack_in[chunk * chunk_frames:(chunk + 1) * chunk_frames])
+        if progress is not None:
+            progress(chunk + 1, chunk_n)
+    if extras:
+        np.savez_compressed(str(stage_path / 'extras.npz'), **extras)
+
+    meta = {'key': key, 'parent': parent_key, 'stage': stage, 'params': params,
+            'shape': list(stack_in.shape), 'dtype': stack_in.dtype.str, 'chunks': chunk_n,
+            'extras': sorted(extras) if extras else [], 'time': time.time()}
+    meta_temp = stage_path / 'meta.json.tmp'
+    with open(str(meta_temp), 'w') as meta_file:
+        json.dump(meta, meta_file)
+    os.replace(str(meta_temp), str(meta_path))
+    return key
+
+
+def load_stage(project, key):
+    """Load the output of a stage saved with save_stage
+
+        Parameters
+        ----------
+        project : str
+            The full path to the project folder
+        key : str
+            The key of the stage (see stack_key)
+
+        Returns
+        -------
+        stack : ndarray
+            The output of the stage, or None if it is missing or incomplete
+        meta : dict
+            The stage's key, parent key, name, parameters, shape, dtype and save time
+        extras : dict
+            Other arrays stored with the stage
+        """
+    stage_path = Path(project, key + STAGE_SUFFIX)
+    meta = _stage_meta(stage_path)
+    if meta is None:
+        return None, None, {}
+    stack = np.empty(meta['shape'], dtype=np.dtype(meta['dtype']))
+    frame = 0
+    for chunk in range(meta['chunks']):
+        with np.load(str(stage_path / 'chunk_{:05d}.npz'.format(chunk))) as chunk_file:
+            data = chunk_file['data']
+        stack[frame:frame + len(data)] = data
+        frame += len(data)
+    extras = {}
+    if meta['extras']:
+        with np.load(str(stage_path / 'extras.npz')) as extras_file:
+            extras = {name: extras_file[name] for name in meta['extras']}
+    return stack, meta, extras
+
+
+def latest_stage(project, root):
+    """Find the most recently saved stage of a project that descends from an input,
+    e.g. to resume a project where it was left
+
+        Parameters
+        ----------
+        project : str
+            The full path to the project folder
+        root : ndarray or str
+            The input stack (e.g. the raw stack), or its key (see stack_key)
+
+        Returns
+        -------
+        key : str
+            The key of the stage (see load_stage), or None if no stage descends from root
+        """
+    root = stack_key(root)
+    metas = {}
+    for stage_path in Path(project).glob('*' + STAGE_SUFFIX):
+        meta = _stage_meta(stage_path)
+        if meta is not None:
+            metas[meta['key']] = meta
+
+    key_latest, time_latest = None, None
+    for key, meta in metas.items():
+        # follow the parents back to the root, stages of other inputs or of missing parents are skipped
+        parent, visited = meta['parent'], {key}
+        while parent in metas and parent not in visited:
+            visited.add(parent)
+            parent = metas[parent]['parent']
+        if parent == root and (time_latest is None or meta['time'] > time_latest):
+            key_latest, time_latest = key, meta['time']
+    return key_latest
+
+
+def _stage_meta(stage_path):
+    # The metadata of a stored stage, or None if it is missing or incomplete
+    try:
+        with open(str(Path(stage_path, 'meta.json')), 'r') as meta_file:
+            meta = json.load(meta_file)
+    except (FileNotFoundError, ValueError):
+        return None
+    chunks = [Path(stage_path, 'chunk_{:05d}.npz'.format(chunk)) for chunk in range(meta['chunks'])]
+    if meta['extras']:
+        chunks.append(Path(stage_path, 'extras.npz'))
+    if not all(chunk.is_file() for chunk in chunks):
+        return None
+    return meta
+
+
 # def crop_frame(frame_in, d_x, d_y):
 #     frame_out = frame_in.copy()
 #
@@ -180,8 +523,8 @@ def crop_stack(stack_in, d_x=False, d_y=False):
         raise TypeError('Stack type must be an "ndarray"')
     if len(stack_in.shape) is not 3:
         raise TypeError('Stack must be a 3-D ndarray (T, Y, X)')
-    if stack_in.dtype not in [np.uint16, float]:
-        raise TypeError('Stack values must either be "np.uint16" or "float"')
+    if stack_in.dtype not in [np.uint16, np.float32, float]:
+        raise TypeError('Stack values must either be "np.uint16", "np.float32" or "float"')
     # if type(d_x) is not int:
     #     raise TypeError('X pixels to crop must be an "int"')
     # if type(d_y) is not int:
@@ -212,9 +555,10 @@ def crop_stack(stack_in, d_x=False, d_y=False):
     return stack_out
 
 
-def reduce_stack(stack_in, reduction=1):
-    """Rescale the X,Y dimensions of a stack (3-D array, TYX) of optical data,
-    using linear interpolation and gaussian anti-aliasing to effectively bin pixels together.
+def reduce_stack(stack_in, reduction=1, workers=None):
+    """Rescale the X,Y dimensions of a stack (3-D array, TYX) of optical data to effectively bin pixels together.
+    Integer reductions average each block of reduction X reduction pixels (binning),
+    other reductions use linear interpolation and gaussian anti-aliasing.
 
        Parameters
        ----------
@@ -222,25 +566,75 @@ def reduce_stack(stack_in, reduction=1):
             A 3-D array (T, Y, X) of optical data, dtype : uint16 or float
        reduction : int, float
             Factor by which to reduce both dimensions, typically in the range 2-10
+       workers : int, optional
+            The number of threads rescaling frames at once when reduction is not an integer,
+            default is None (no threads)
 
        Returns
        -------
        stack_out : ndarray
             A reduced 3-D array (T, Y, X) of optical data, dtype : stack_in.dtype
+
+       Notes
+       -----
+            Binning drops the last rows and columns that do not fill a whole block.
+            16-bit blocks are summed as uint32 and their means rounded back to uint16.
        """
+    # Check parameters
+    if type(stack_in) is not np.ndarray:
+        raise TypeError('Stack type must be an "ndarray"')
+    if len(stack_in.shape) != 3:
+        raise TypeError('Stack must be a 3-D ndarray (T, Y, X)')
+    if type(reduction) not in [int, float]:
+        raise TypeError('Reduction must be an "int" or a "float"')
+    if reduction < 1:
+        raise ValueError('Reduction must be >= 1')
+
+    if float(reduction).is_integer():
+        block = int(reduction)
+        height, width = stack_in.shape[1] // block, stack_in.shape[2] // block
+        if height < 1 or width < 1:
+            raise ValueError('Reduction {} must be <= the stack\'s frame dimensions {}'
+                             .format(reduction, stack_in.shape[1:]))
+        print('Binning stack dimensions by {} from W {} X H {} ... to size W {} X H {} ...'
+              .format(reduction, stack_in.shape[2], stack_in.shape[1], width, height))
+        # Sum each block within a (T, H, block, W * block) view of the stack,
+        # adding its rows as whole frames, then the columns of each row
+        stack_blocks = stack_in[:, :height * block, :width * block].reshape(
+            (stack_in.shape[0], height, block, width * block))
+        stack_sum = stack_blocks[:, :, 0].astype(np.uint32 if stack_in.dtype == np.uint16 else stack_in.dtype)
+        for row in range(1, block):
+            stack_sum += stack_blocks[:, :, row]
+        stack_sum = stack_sum.reshape((stack_in.shape[0], height, width, block)).sum(axis=3, dtype=stack_sum.dtype)
+        if stack_in.dtype == np.uint16:
+            stack_sum += block * block // 2  # round the means
+            stack_sum //= block * block
+            return stack_sum.astype(np.uint16)
+        stack_sum /= block * block
+        return stack_sum
+
     reduction_factor = 1 / reduction
-    test_frame_reduced = rescale(stack_in[0], reduction_factor, multichannel=False)
+    test_frame_reduced = rescale(stack_in[0], reduction_factor)
     stack_reduced_shape = (stack_in.shape[0], test_frame_reduced.shape[0], test_frame_reduced.shape[1])
     stack_out = np.empty(stack_reduced_shape, dtype=stack_in.dtype)  # empty stack
     print('Reducing stack dimensions by {} from W {} X H {} ... to size W {} X H {} ...'
           .format(reduction,
                   stack_in.shape[2], stack_in.shape[1],
                   test_frame_reduced.shape[1], test_frame_reduced.shape[0]))
-    for idx, frame in enumerate(stack_in):
-        # print('\r\tFrame:\t{}\t/ {}'.format(idx + 1, stack_in.shape[0]), end='', flush=True)
-        #     f_filtered = filter_spatial(frame, kernel=self.kernel)
-        frame_reduced = img_as_uint(rescale(frame, reduction_factor, anti_aliasing=True, multichannel=False))
-        stack_out[idx, :, :] = frame_reduced
+
+    def reduce_frame(idx):
+        if stack_in.dtype == np.uint16:
+            stack_out[idx] = img_as_uint(rescale(stack_in[idx], reduction_factor, anti_aliasing=True))
+        else:
+            stack_out[idx] = rescale(stack_in[idx], reduction_factor, anti_aliasing=True, preserve_range=True)
+
+    if workers is None:
+        for idx in range(stack_in.shape[0]):
+            reduce_frame(idx)
+    else:
+        # scipy.ndimage's filters and interpolation, used by rescale, release the GIL
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(reduce_frame, range(stack_in.shape[0])))
 
     return stack_out
 
@@ -274,8 +668,8 @@ def mask_generate(frame_in, mask_type='Otsu_global', strict=(3, 5)):
         raise TypeError('Frame type must be an "ndarray"')
     if len(frame_in.shape) is not 2:
         raise TypeError('Frame must be a 2-D ndarray (Y, X)')
-    if frame_in.dtype not in [np.uint16, float]:
-        raise TypeError('Frame values must either be "np.uint16" or "float"')
+    if frame_in.dtype not in [np.uint16, np.float32, float]:
+        raise TypeError('Frame values must either be "np.uint16", "np.float32" or "float"')
     if type(mask_type) is not str:
         raise TypeError('Filter type must be a "str"')
     if type(strict) is not tuple:
@@ -387,8 +781,8 @@ def mask_apply(stack_in, mask):
         raise TypeError('Stack type must be an "ndarray"')
     if len(stack_in.shape) is not 3:
         raise TypeError('Stack must be a 3-D ndarray (T, Y, X)')
-    if stack_in.dtype not in [np.uint16, float]:
-        raise TypeError('Stack values must either be "np.uint16" or "float"')
+    if stack_in.dtype not in [np.uint16, np.float32, float]:
+        raise TypeError('Stack values must either be "np.uint16", "np.float32" or "float"')
 
     if type(mask) is not np.ndarray:
         raise TypeError('Mask type must be an "ndarray"')
@@ -2,9 +2,18 @@ from util.preparation import *
 
 import statistics
 import sys
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from functools import lru_cache
+from multiprocessing import Pool
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
 
 import numpy as np
-from scipy.interpolate import LSQUnivariateSpline
+from scipy import ndimage
+from scipy.interpolate import BSpline
+from scipy.fftpack import next_fast_len
 from scipy.signal import find_peaks, correlate, filtfilt, kaiserord, firwin, butter
 from scipy.optimize import curve_fit
 from skimage.morphology import square
@@ -14,12 +23,49 @@ from skimage.filters.rank import median, mean, mean_bilateral
 # Constants
 # LSQ Spline fidelity
 SPLINE_FIDELITY = 3
+# LSQ Spline knots (evenly spaced, including the discarded edge knots) and degree
+SPLINE_KNOTS = 35
+SPLINE_DEGREE = 3
+# LSQ Spline operator sets to keep cached (one per signal length)
+SPLINE_CACHE_MAX = 16
+# Minimum number of distinct values in a signal with a valid peak
+UNIQUE_MIN = 10
+UNIQUE_FRAMES = 4 * UNIQUE_MIN  # frames searched for distinct values before whole signals
+# Samples checked at once when walking from peaks to find their prominence
+PEAK_WALK_BLOCK = 64
 # Baseline sample number limits
 BASELINES_MIN = 5
 BASELINES_MAX = 20
 # Transient Signal-to-Noise limit
 SNR_MIN = 5.0
 SNR_MAX = 100
+# Maps stacked by map_snr with components, in order
+SNR_COMPONENTS = ['snr', 'rms_noise', 'rms_peak', 'peak_peak', 'sd_noise']
+# Minimum distance (indexes) between transient peaks when ensembling, and the part of a cycle before activations
+ENSEMBLE_DISTANCE_MIN = 10
+ENSEMBLE_LEAD = 0.25
+# Landmarks of every beat in a BeatTable, in order, and the index stored for those that are incalculable
+BEAT_LANDMARKS = ['start', 'activation', 'peak', 'end']
+BEAT_NONE = -1
+# Cross-correlation lag indexes to keep cached when aligning signals (one per template and signal length)
+ALIGN_CACHE_MAX = 16
+# Memory budget (bytes) of a tile's float64 pixel data when mapping a stack
+TILE_BYTES = 2 ** 26
+# Minimum number of tiles handed out per worker process when mapping in parallel
+TILES_PER_WORKER = 4
+# Temporal filter designs to keep cached (one per sample rate, cutoff and order)
+FILTER_CACHE_MAX = 16
+# Kaiser FIR lowpass design, stopband attenuation (dB) and transition width (Hz)
+FILTER_RIPPLE_DB = 30.0
+FILTER_WIDTH = 20
+FILTERS_TEMPORAL = ['filtfilt', 'fft']
+# Minimum range of a signal to remove drift from
+DRIFT_RANGE_MIN = 5
+# Assumed bounds of the B constant for a decaying exponential drift fit
+DRIFT_EXP_B = (0.01, 0.1)
+# Iteration limit and relative cost tolerance of batched exponential drift fits
+DRIFT_ITERATIONS = 100
+DRIFT_TOLERANCE = 1e-8
 # Baseline sample number limits
 FILTERS_SPATIAL = ['median', 'mean', 'bilateral', 'gaussian', 'best_ever']
 
@@ -27,40 +73,306 @@ FILTERS_SPATIAL = ['median', 'mean', 'bilateral', 'gaussian', 'best_ever']
 # TODO add TV, a non-local, and a weird filter
 
 
+@lru_cache(maxsize=SPLINE_CACHE_MAX)
+def spline_operators(length, n_knots=SPLINE_KNOTS, degree=SPLINE_DEGREE, fidelity=SPLINE_FIDELITY):
+    """Build (or reuse) the LSQ spline operators shared by every signal of the same length.
+    Operators are cached with LRU eviction, keyed by (length, n_knots, degree, fidelity).
+
+        Parameters
+        ----------
+        length : int
+            The length of the signal arrays to fit
+        n_knots : int
+            The number of evenly spaced knots, including the 2 discarded at each edge
+        degree : int
+            The degree of the B-spline
+        fidelity : int
+            The number of spline positions per signal index
+
+        Returns
+        -------
+        x_spline : ndarray
+            The array of spline positions (length * fidelity), in indexes of the signal arrays
+        t_full : ndarray
+            The full knot vector, including boundary knots
+        basis_fit : ndarray
+            A 2-D array (C, length) fit matrix (basis pseudo-inverse), signal -> spline coefficients
+        basis_eval : ndarray
+            A 3-D array (3, length * fidelity, C) of evaluation matrices, spline coefficients ->
+            spline values, 1st derivative values and 2nd derivative values
+
+        Notes
+        -----
+            Arrays are read-only, as they are shared between callers.
+        """
+    xx_signal = np.arange(0, length)
+    x_spline = np.linspace(xx_signal[0], xx_signal[-1], length * fidelity)
+    t_knots = np.linspace(xx_signal[0], xx_signal[-1], n_knots)[2:-2]  # discard edge knots
+    t_full = np.concatenate(([xx_signal[0]] * (degree + 1), t_knots, [xx_signal[-1]] * (degree + 1)))
+    n_coeffs = len(t_full) - degree - 1
+    bspline = BSpline(t_full, np.eye(n_coeffs), degree)
+
+    # Least squares coefficients of any signal are its product with the basis' pseudo-inverse
+    basis_fit = np.linalg.pinv(bspline(xx_signal))
+    basis_eval = np.stack([bspline(x_spline), bspline.derivative(1)(x_spline), bspline.derivative(2)(x_spline)])
+
+    for operator in [x_spline, t_full, basis_fit, basis_eval]:
+        operator.flags.writeable = False
+    return x_spline, t_full, basis_fit, basis_eval
+
+
 def spline_signal(signal_in):
-    xx_signal = np.arange(0, (len(signal_in)))
-    # Lease Square approximation
-    # Computing the inner knots and using them:
-    x_spline = np.linspace(xx_signal[0], xx_signal[-1], len(xx_signal) * SPLINE_FIDELITY)
-    n_knots = 35  # number of knots to use in LSQ spline
-    t_knots = np.linspace(xx_signal[0], xx_signal[-1], n_knots)  # equally spaced knots in the interval
-    t_knots = t_knots[2:-2]  # discard edge knots
-    # t_knots = [0, 1, 2, 3]
-    bspline_degree = 3
-    # sql = make_lsq_spline(xx_signal, signal_in, t_knots)
-    spline = LSQUnivariateSpline(xx_signal, signal_in, t_knots, k=bspline_degree)
-    # x_signal = np.arange(len(signal_in))
-    # x_spline = np.linspace(x_signal[0], x_signal[-1], len(x_signal) * SPLINE_FIDELITY)
-    # # n_segments = int(len(x_signal) / 5)
-    # n_segments = 25
-    # n_knots = n_segments
-    # knots = np.linspace(x_signal[0], x_signal[-1], n_knots + 2)[1:-2]
-    # bspline_degree = 3
-    # spline = LSQUnivariateSpline(x_signal, signal_in, knots, k=bspline_degree)
-    return x_spline, spline
+    """Fit a LSQ spline to a signal array, using evenly spaced knots
 
-    # return xs, sql
+        Parameters
+        ----------
+        signal_in : ndarray
+            The array of data to be evaluated, dtype : uint16 or float
+
+        Returns
+        -------
+        x_spline : ndarray
+            The array of spline positions (len(signal_in) * SPLINE_FIDELITY), in indexes of signal_in
+        spline : BSpline
+            The fitted LSQ spline, callable and differentiable
+        """
+    x_spline, t_full, basis_fit, basis_eval = \
+        spline_operators(len(signal_in), SPLINE_KNOTS, SPLINE_DEGREE, SPLINE_FIDELITY)
+    # Least Square approximation, with coefficients from the cached basis' pseudo-inverse
+    spline = BSpline(t_full, basis_fit @ signal_in, SPLINE_DEGREE)
+    return x_spline, spline
 
 
 def spline_deriv(signal_in):
-    xs, sql = spline_signal(signal_in)
+    x_spline, t_full, basis_fit, basis_eval = \
+        spline_operators(len(signal_in), SPLINE_KNOTS, SPLINE_DEGREE, SPLINE_FIDELITY)
 
-    x_df = xs
-    df_spline = sql.derivative()(xs)
+    x_df = x_spline
+    df_spline = basis_eval[1] @ (basis_fit @ signal_in)
 
     return x_df, df_spline
 
 
+def spline_signals(signals_in):
+    """Fit LSQ splines to many signal arrays at once, using a single basis shared by all of them.
+    Equivalent to calling spline_signal (and evaluating its spline and derivatives) for every signal.
+
+        Parameters
+        ----------
+        signals_in : ndarray
+            A 2-D array (N, T) of N signal arrays, dtype : uint16 or float
+            A 1-D array is treated as a single signal
+
+        Returns
+        -------
+        x_spline : ndarray
+            The array of spline positions (T * SPLINE_FIDELITY), in indexes of the signal arrays
+        signals_spline : ndarray
+            A 2-D array (N, T * SPLINE_FIDELITY) of spline values, dtype : float
+        signals_df : ndarray
+            A 2-D array (N, T * SPLINE_FIDELITY) of the splines' 1st derivative values, dtype : float
+        signals_df2 : ndarray
+            A 2-D array (N, T * SPLINE_FIDELITY) of the splines' 2nd derivative values, dtype : float
+
+        Notes
+        -----
+            The basis (and its pseudo-inverse) is cached by spline_operators,
+            so a stack's pixels (stack.reshape(T, -1).T) can be fit with a single matrix product.
+        """
+    # Check parameters
+    if type(signals_in) is not np.ndarray:
+        raise TypeError('Signals data type must be an "ndarray"')
+    if signals_in.dtype not in [np.uint16, np.float32, np.float64]:
+        raise TypeError('Signals values must either be "uint16" or "float"')
+    if len(signals_in.shape) not in [1, 2]:
+        raise TypeError('Signals must be a 1-D or 2-D ndarray (N, T)')
+    if signals_in.shape[-1] <= SPLINE_KNOTS:
+        raise ValueError('Signals must be longer than {} samples'.format(SPLINE_KNOTS))
+
+    signals = np.atleast_2d(signals_in).astype(float, copy=False)
+    x_spline, t_full, basis_fit, basis_eval = \
+        spline_operators(signals.shape[1], SPLINE_KNOTS, SPLINE_DEGREE, SPLINE_FIDELITY)
+
+    coeffs = signals @ basis_fit.T
+    signals_spline, signals_df, signals_df2 = coeffs @ basis_eval.transpose(0, 2, 1)
+
+    return x_spline, signals_spline, signals_df, signals_df2
+
+
+def find_peaks_signals(signals_in, height=None, prominence=None, distance=None):
+    """Find the peaks of many signal arrays at once,
+    with the same height, distance and prominence criteria as scipy.signal.find_peaks
+
+        Parameters
+        ----------
+        signals_in : ndarray
+            A 2-D array (N, T) of N signal arrays, dtype : uint16 or float
+            A 1-D array is treated as a single signal
+        height : float or ndarray, optional
+            The minimum height of peaks, for all signals or for each signal (N)
+        prominence : float or ndarray, optional
+            The minimum prominence of peaks, for all signals or for each signal (N)
+        distance : int, optional
+            The minimum distance (>= 1) in samples between neighbouring peaks, the highest peaks are kept
+
+        Returns
+        -------
+        i_ptr : ndarray
+            The offsets (N + 1) of each signal's peaks in i_peaks and prominences,
+            i.e. the peaks of signal n are i_peaks[i_ptr[n]:i_ptr[n + 1]]
+        i_peaks : ndarray
+            The indexes of the peaks of all signals, in order, dtype : int
+        prominences : ndarray
+            The prominence of each peak in i_peaks, dtype : float
+
+        Notes
+        -----
+            Flat peaks (plateaus) are found at their midpoint, rounded down.
+            Criteria are applied in the same order as find_peaks: height, distance, and then prominence
+        """
+    # Check parameters
+    if type(signals_in) is not np.ndarray:
+        raise TypeError('Signals data type must be an "ndarray"')
+    if signals_in.dtype not in [np.uint16, np.float32, np.float64]:
+        raise TypeError('Signals values must either be "uint16" or "float"')
+    if len(signals_in.shape) not in [1, 2]:
+        raise TypeError('Signals must be a 1-D or 2-D ndarray (N, T)')
+    if distance is not None and distance < 1:
+        raise ValueError('Distance must be >= 1')
+
+    signals = np.atleast_2d(signals_in).astype(float, copy=False)
+    n_signals, length = signals.shape
+
+    # Find local maxima as runs of equal values higher than both neighbouring runs
+    run_start = np.ones(signals.shape, dtype=bool)
+    run_start[:, 1:] = signals[:, 1:] != signals[:, :-1]
+    run_rows, run_starts = np.nonzero(run_start)
+    run_values = signals[run_rows, run_starts]
+    run_ends = np.append(run_starts[1:] - 1, length - 1)
+    run_ends[np.append(run_rows[1:] != run_rows[:-1], True)] = length - 1
+    rise = np.append(False, (run_rows[1:] == run_rows[:-1]) & (run_values[1:] > run_values[:-1]))
+    fall = np.append((run_rows[1:] == run_rows[:-1]) & (run_values[1:] < run_values[:-1]), False)
+    is_peak = rise & fall
+    peak_rows = run_rows[is_peak]
+    i_peaks = (run_starts[is_peak] + run_ends[is_peak]) // 2
+    del run_start, run_rows, run_starts, run_values, run_ends, rise, fall, is_peak
+
+    # Height
+    if height is not None:
+        heights_min = np.broadcast_to(np.asarray(height, dtype=float), (n_signals,))
+        is_high = signals[peak_rows, i_peaks] >= heights_min[peak_rows]
+        peak_rows, i_peaks = peak_rows[is_high], i_peaks[is_high]
+
+    # Distance, keeping peaks that are the highest remaining within their distance in rounds
+    if distance is not None and len(i_peaks) > 1:
+        distance = int(np.ceil(distance))
+        # rank peaks within each signal by height, breaking ties exactly as find_peaks does (np.argsort)
+        peak_heights = signals[peak_rows, i_peaks]
+        peak_rank = np.empty(len(i_peaks), dtype=int)
+        i_ptr = np.searchsorted(peak_rows, np.arange(n_signals + 1))
+        for i_lo, i_hi in zip(i_ptr[:-1], i_ptr[1:]):
+            if i_hi - i_lo > 1:
+                peak_rank[i_lo + np.argsort(peak_heights[i_lo:i_hi])] = np.arange(i_hi - i_lo)
+        # positions of peaks in different signals are always further apart than distance
+        peak_keys = peak_rows * (length + distance) + i_peaks
+        windows = np.empty(2 * len(i_peaks), dtype=int)
+        windows[0::2] = np.searchsorted(peak_keys, peak_keys - distance, side='right')
+        windows[1::2] = np.searchsorted(peak_keys, peak_keys + distance, side='left')
+
+        is_kept = np.zeros(len(i_peaks), dtype=bool)
+        is_undecided = np.ones(len(i_peaks), dtype=bool)
+        while is_undecided.any():
+            rank_undecided = np.append(np.where(is_undecided, peak_rank, -1), -1)
+            is_kept_new = is_undecided & (np.maximum.reduceat(rank_undecided, windows)[0::2] == peak_rank)
+            is_kept |= is_kept_new
+            is_near_kept = np.logical_or.reduceat(np.append(is_kept_new, False), windows)[0::2]
+            is_undecided &= ~is_near_kept
+        peak_rows, i_peaks = peak_rows[is_kept], i_peaks[is_kept]
+
+    # Prominence, from the higher of the lowest values before reaching a higher sample on either side
+    peak_heights = signals[peak_rows, i_peaks]
+    bases_left = _peaks_walk_min(signals, peak_rows, i_peaks, peak_heights, -1)
+    bases_right = _peaks_walk_min(signals, peak_rows, i_peaks, peak_heights, 1)
+    prominences = peak_heights - np.maximum(bases_left, bases_right)
+    if prominence is not None:
+        prominences_min = np.broadcast_to(np.asarray(prominence, dtype=float), (n_signals,))
+        is_prominent = prominences >= prominences_min[peak_rows]
+        peak_rows, i_peaks, prominences = peak_rows[is_prominent], i_peaks[is_prominent], prominences[is_prominent]
+
+    i_ptr = np.zeros(n_signals + 1, dtype=int)
+    i_ptr[1:] = np.cumsum(np.bincount(peak_rows, minlength=n_signals))
+
+    return i_ptr, i_peaks, prominences
+
+
+def _peaks_walk_min(signals, peak_rows, i_peaks, peak_heights, direction):
+    """Find the lowest value from each peak until a higher sample or the end of its signal,
+    walking in blocks of PEAK_WALK_BLOCK samples in the given direction (-1 or 1)"""
+    length = signals.shape[1]
+    mins = peak_heights.copy()
+    active = np.arange(len(i_peaks))
+    steps = np.arange(PEAK_WALK_BLOCK)
+    offset = 1
+    while len(active) > 0:
+        i_walk = i_peaks[active, np.newaxis] + direction * (offset + steps)
+        is_inside = (i_walk >= 0) & (i_walk < length)
+        values = signals[peak_rows[active, np.newaxis], np.clip(i_walk, 0, length - 1)]
+        is_stop = (values > peak_heights[active, np.newaxis]) | ~is_inside
+        stops = np.where(is_stop.any(axis=1), is_stop.argmax(axis=1), PEAK_WALK_BLOCK)
+        values[steps >= stops[:, np.newaxis]] = np.inf
+        mins[active] = np.minimum(mins[active], values.min(axis=1))
+        active = active[stops == PEAK_WALK_BLOCK]
+        offset += PEAK_WALK_BLOCK
+
+    return mins
+
+
+def find_tran_peaks(signals_in):
+    """Find the index of the peak of the transient in many signal arrays at once,
+    equivalent to calling find_tran_peak for every signal
+
+        Parameters
+        ----------
+        signals_in : ndarray
+            A 2-D array (N, T) of N signal arrays, dtype : uint16 or float
+
+        Returns
+        -------
+        i_peaks : ndarray
+            The index of each signal's peak, or NaN if no peak was detected, dtype : float
+        """
+    # Check parameters
+    if type(signals_in) is not np.ndarray:
+        raise TypeError('Signals data type must be an "ndarray"')
+    if len(signals_in.shape) != 2:
+        raise TypeError('Signals must be a 2-D ndarray (N, T)')
+
+    i_peaks = np.full(signals_in.shape[0], np.nan)
+    # Signals too flat to have a valid peak are skipped (see map_valid)
+    valid = _map_valid_tile(signals_in.T[:, :, np.newaxis])[:, 0]
+    if not valid.any():
+        return i_peaks
+
+    signals = signals_in[valid].astype(float)
+    signals_mean = np.nanmean(signals, axis=1)
+    signals_range = signals.max(axis=1) - signals_mean
+    i_ptr, i_peaks_found, prominences = find_peaks_signals(signals, height=signals_mean,
+                                                           prominence=signals_range * 0.8,
+                                                           distance=int(signals.shape[1] / 2))
+    # Use each signal's peak with the max prominence (in case of a tie, first is chosen)
+    peak_rows = np.repeat(np.arange(len(signals)), np.diff(i_ptr))
+    order = np.lexsort((np.arange(len(i_peaks_found)), -prominences, peak_rows))
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = peak_rows[order][1:] != peak_rows[order][:-1]
+    i_best = order[is_first]
+
+    i_peaks_valid = np.full(len(signals), np.nan)
+    i_peaks_valid[peak_rows[i_best]] = i_peaks_found[i_best]
+    i_peaks[valid] = i_peaks_valid
+
+    return i_peaks
+
+
 def find_tran_peak(signal_in, props=False):
     """Find the index of the peak of a transient,
     defined as the maximum value
@@ -89,12 +401,17 @@ def find_tran_peak(signal_in, props=False):
 
     # Characterize the signal
     unique, counts = np.unique(signal_in, return_counts=True)
-    if len(unique) < 10:  # signal is too flat to have a valid peak
+    if len(unique) < UNIQUE_MIN:  # signal is too flat to have a valid peak
         if props:
             return np.nan, np.nan
         else:
             return np.nan
 
+    return _tran_peak(signal_in, props)
+
+
+def _tran_peak(signal_in, props=False):
+    # find_tran_peak of a signal known to be analyzable (see map_valid)
     # Replace NaNs with 0
     # signal_in = np.nan_to_num(signal_in, copy=False, nan=0)
 
@@ -136,23 +453,29 @@ def find_tran_peak(signal_in, props=False):
 
 
 def find_tran_baselines(signal_in, peak_side='left'):
-    # Characterize the signal
-    # signal_bounds = (signal_in.min(), signal_in.max())
-    # signal_range = signal_bounds[1] - signal_bounds[0]
     # find the peak (roughly)
-    signal_range = signal_in.max() - signal_in.min()
     i_peak = find_tran_peak(signal_in)
     if i_peak is np.nan:
         return np.nan
+
+    # use the derivative spline to find relatively quiescent baseline period
+    xdf, df_spline = spline_deriv(signal_in)
+
+    return _tran_baselines(signal_in, i_peak, df_spline)
+
+
+def _tran_baselines(signal_in, i_peak, df_spline):
+    # Baseline indexes of a signal, given its peak index and LSQ derivative spline
+    # Characterize the signal
+    # signal_bounds = (signal_in.min(), signal_in.max())
+    # signal_range = signal_bounds[1] - signal_bounds[0]
+    signal_range = signal_in.max() - signal_in.min()
     signal_cutoff = signal_in.min() + (signal_range / 2)
     # i_signal_cutoff_left = np.where(signal_in[:i_peak] <= signal_cutoff)[0][0]
     i_signal_cutoff_right = np.where(signal_in[:i_peak] <= signal_cutoff)[0][-1]
 
     # Exclude signals without a prominent peak
 
-    # use the derivative spline to find relatively quiescent baseline period
-    xdf, df_spline = spline_deriv(signal_in)
-
     # TODO catch atrial-type signals and limit to the plataea before the peak
     # find the df max before the signal's peak (~ large rise time)
     df_search_left = SPLINE_FIDELITY * SPLINE_FIDELITY
@@ -221,6 +544,98 @@ def find_tran_baselines(signal_in, peak_side='left'):
     return i_baselines
 
 
+def find_tran_baselines_signals(signals_in, i_peaks=None, signals_df=None):
+    """Find the pre-upstroke baselines of many signal arrays at once,
+    equivalent to calling find_tran_baselines for every signal
+
+        Parameters
+        ----------
+        signals_in : ndarray
+            A 2-D array (N, T) of N signal arrays, dtype : uint16 or float
+        i_peaks : ndarray, optional
+            The index of each signal's peak, or NaN (see find_tran_peaks), found if not provided
+        signals_df : ndarray, optional
+            A 2-D array (N, T * SPLINE_FIDELITY) of each signal's LSQ spline 1st derivative
+            (see spline_signals), calculated if not provided
+
+        Returns
+        -------
+        i_starts : ndarray
+            The first baseline index of each signal, or NaN if incalculable, dtype : float
+        i_ends : ndarray
+            The index after each signal's last baseline index, or NaN if incalculable, dtype : float
+            i.e. the baselines of signal n are np.arange(i_starts[n], i_ends[n])
+
+        Notes
+        -----
+            Signals without samples at or below half of their range before their peak,
+            which find_tran_baselines cannot search, are assigned NaN
+        """
+    # Check parameters
+    if type(signals_in) is not np.ndarray:
+        raise TypeError('Signals data type must be an "ndarray"')
+    if len(signals_in.shape) != 2:
+        raise TypeError('Signals must be a 2-D ndarray (N, T)')
+
+    signals = signals_in.astype(float)
+    if i_peaks is None:
+        i_peaks = find_tran_peaks(signals_in)
+    if signals_df is None:
+        x_spline, signals_spline, signals_df, signals_df2 = spline_signals(signals_in)
+    n_signals, length = signals.shape
+    i_starts, i_ends = np.full(n_signals, np.nan), np.full(n_signals, np.nan)
+
+    is_found = ~np.isnan(i_peaks)
+    signals, signals_df = signals[is_found], signals_df[is_found]
+    i_peak = i_peaks[is_found].astype(int)[:, np.newaxis]
+    i_signal = np.arange(length)
+    i_df = np.arange(signals_df.shape[1])
+    df_search_left = SPLINE_FIDELITY * SPLINE_FIDELITY
+
+    # the last sample before the peak within the lower half of the signal's range
+    signals_min = signals.min(axis=1, keepdims=True)
+    signal_cutoff = signals_min + (signals.max(axis=1, keepdims=True) - signals_min) / 2
+    is_low = (signals <= signal_cutoff) & (i_signal < i_peak)
+    i_signal_cutoff_right = length - 1 - np.argmax(is_low[:, ::-1], axis=1)
+    df_max_search_right = i_signal_cutoff_right * SPLINE_FIDELITY
+    is_searchable = is_low.any(axis=1) & (df_max_search_right > df_search_left)
+
+    # include indexes within the standard deviation of the local area of the derivative
+    df_sd = np.std(signals_df[:, df_search_left:-df_search_left], axis=1, ddof=1)
+    is_quiet = np.abs(signals_df) < (df_sd * 2)[:, np.newaxis]
+
+    # find the df max before the signal's peak (~ large rise time)
+    in_search = (i_df >= df_search_left) & (i_df < df_max_search_right[:, np.newaxis])
+    i_peak_df = np.argmax(np.where(in_search, signals_df, -np.inf), axis=1)
+
+    # find first quiet value at or before the df max
+    is_start = is_quiet & (i_df <= i_peak_df[:, np.newaxis])
+    i_start_df = np.where(is_start.any(axis=1), i_df[-1] - np.argmax(is_start[:, ::-1], axis=1), i_peak_df)
+
+    # look left, then right, of the start while values are quiet
+    is_loud_left = ~is_quiet & (i_df >= df_search_left) & (i_df < i_start_df[:, np.newaxis])
+    i_loud_left = np.where(is_loud_left.any(axis=1), i_df[-1] - np.argmax(is_loud_left[:, ::-1], axis=1),
+                           df_search_left - 1)
+    i_left_df = np.minimum(i_start_df, i_loud_left + 1)
+    is_loud_right = ~is_quiet & (i_df >= i_start_df[:, np.newaxis]) & (i_df < i_peak_df[:, np.newaxis])
+    i_right_df = np.where(is_loud_right.any(axis=1), np.argmax(is_loud_right, axis=1), i_peak_df)
+
+    # use all detected indexes, only the last BASELINES_MAX of them
+    i_start = i_left_df // SPLINE_FIDELITY
+    i_end = (i_right_df - 1) // SPLINE_FIDELITY
+    i_start = np.maximum(i_start, i_end - BASELINES_MAX)
+    # or arbitrary backup baselines: the BASELINES_MIN signal samples before the df search start
+    is_short = (i_right_df - i_left_df) < (BASELINES_MIN * SPLINE_FIDELITY)
+    i_backup_end = np.maximum(i_right_df // SPLINE_FIDELITY, BASELINES_MIN)
+    i_start = np.where(is_short, i_backup_end - BASELINES_MIN, i_start)
+    i_end = np.where(is_short, i_backup_end, i_end)
+
+    i_starts[np.flatnonzero(is_found)[is_searchable]] = i_start[is_searchable]
+    i_ends[np.flatnonzero(is_found)[is_searchable]] = i_end[is_searchable]
+
+    return i_starts, i_ends
+
+
 def find_tran_act(signal_in):
     """Find the time of the activation of a transient,
     defined as the the maximum of the 1st derivative OR
@@ -246,11 +661,18 @@ def find_tran_act(signal_in):
     i_peak = find_tran_peak(signal_in)
     if i_peak is np.nan:
         return np.nan
-    i_baselines = find_tran_baselines(signal_in)
+    # use a LSQ derivative spline of entire signal
+    x_df, signal_df = spline_deriv(signal_in)
+    i_baselines = _tran_baselines(signal_in, i_peak, signal_df)
     # i_baseline = int(np.median(i_baselines))
     if i_baselines is np.nan:
         return np.nan
 
+    return _tran_act(signal_in, i_peak, i_baselines, signal_df)
+
+
+def _tran_act(signal_in, i_peak, i_baselines, signal_df):
+    # Activation index of a signal, given its peak index, baseline indexes and LSQ derivative spline
     baselines_rms = np.sqrt(np.mean(signal_in[i_baselines]) ** 2)
     peak_peak = signal_in[i_peak] - baselines_rms
     data_noise = signal_in[i_baselines]
@@ -263,9 +685,6 @@ def find_tran_act(signal_in):
     search_min = i_baselines[-1]  # TODO try the last baseline index
     search_max = i_peak
 
-    # use a LSQ derivative spline of entire signal
-    x_df, signal_df = spline_deriv(signal_in)
-
     # find the 1st derivative max within the search area (first few are likely to be extreme)
     i_act_search_df = np.argmax(signal_df[search_min * SPLINE_FIDELITY:search_max * SPLINE_FIDELITY])
     i_act_search = int(np.floor(i_act_search_df / SPLINE_FIDELITY))
@@ -279,7 +698,7 @@ def find_tran_act(signal_in):
 
 
 def align_signals(signal1, signal2):
-    """Aligns two signal arrays using signal.correlate.
+    """Aligns two signal arrays using cross-correlation (see align_signals_fft).
     https://stackoverflow.com/questions/19642443/use-of-pandas-shift-to-align-datasets-based-on-scipy-signal-correlate
 
         Parameters
@@ -306,13 +725,8 @@ def align_signals(signal1, signal2):
     sig1 = np.float32(signal1)
     sig2 = np.float32(signal2)
 
-    # Find the length of the signal
-    # sig_length = len(sig1)
-    # print('sig1 min, max: ', np.nanmin(sig1), ' , ', np.nanmax(sig1))
-    # print('sig2 min, max: ', np.nanmin(sig2), ' , ', np.nanmax(sig2))
-
-    # dx = np.mean(np.diff(sig1.x.values))
-    shift = (np.argmax(correlate(sig1, sig2)) - len(sig2))
+    _, lags = align_signals_fft(sig1, sig2[np.newaxis])
+    shift = int(lags[0]) - 1
 
     signal2_aligned = np.roll(sig2, shift=shift+1)
     if shift > 0:
@@ -323,6 +737,114 @@ def align_signals(signal1, signal2):
     return signal2_aligned, shift
 
 
+@lru_cache(maxsize=ALIGN_CACHE_MAX)
+def _align_lags(length_ref, length):
+    # The FFT length, and the circular indexes of every overlapping lag (in increasing order) of a cross-correlation
+    n_fft = next_fast_len(length_ref + length - 1)
+    lags = np.arange(-(length - 1), length_ref)
+    i_lags = lags % n_fft
+    for lag_array in [lags, i_lags]:
+        lag_array.flags.writeable = False
+    return n_fft, lags, i_lags
+
+
+def align_signals_fft(signal_ref, signals_in, subsample=False, out=None):
+    """Align many signal arrays to a template signal at once, using FFT cross-correlation.
+
+        Parameters
+        ----------
+        signal_ref : ndarray
+            The template signal array (R), or an array (..., R) of templates broadcast against signals_in,
+            dtype : uint16 or float
+        signals_in : ndarray
+            An array (..., T) of signals, time along the last axis, will be aligned to signal_ref,
+            dtype : uint16 or float
+        subsample : bool, optional
+            Refine each lag to sub-sample precision with parabolic interpolation of the correlation peak,
+            default is False
+        out : ndarray, optional
+            A float array (..., T) to write the aligned signals into, may be signals_in itself
+
+        Returns
+        -------
+        signals_aligned : ndarray
+            Aligned versions of signals_in, dtype : float
+        shifts : ndarray
+            Number of indexes each signal was shifted (delayed) during alignment, dtype : int,
+            or float if subsample is True
+
+        Notes
+        -----
+            Signals are correlated as they are, so offsets (e.g. baselines) should be removed first.
+            Lags are limited to those where a signal overlaps the template, -(T - 1) to (R - 1).
+            Fills empty values with np.NaN, sub-sample shifts are linearly interpolated
+    """
+    # Check parameters
+    if type(signal_ref) is not np.ndarray:
+        raise TypeError('Template data type must be an "ndarray"')
+    if type(signals_in) is not np.ndarray:
+        raise TypeError('Signals data type must be an "ndarray"')
+    if signal_ref.ndim < 1 or signals_in.ndim < 1:
+        raise TypeError('Template and signals must have a time axis')
+    if type(subsample) not in [bool]:
+        raise TypeError('Subsample must be a "bool"')
+
+    length_ref, length = signal_ref.shape[-1], signals_in.shape[-1]
+    if length_ref < 1 or length < 1:
+        raise ValueError('Template and signals must not be empty')
+    try:
+        shape_out = np.broadcast(signal_ref[..., :1], signals_in[..., :1]).shape[:-1] + (length,)
+    except ValueError:
+        raise ValueError('Template must broadcast against the signals:'
+                         '\nTemplate:\t{}\nSignals:\t{}'.format(signal_ref.shape, signals_in.shape))
+    if out is None:
+        out = np.empty(shape_out)
+    else:
+        if type(out) is not np.ndarray:
+            raise TypeError('Output data type must be an "ndarray"')
+        if out.dtype != float:
+            raise TypeError('Output values must be "float"')
+        if out.shape != shape_out:
+            raise ValueError('Output shape must be the same as the aligned signals:'
+                             '\nOutput:\t{}\nAligned:\t{}'.format(out.shape, shape_out))
+
+    # Cross-correlate every signal with its template in one transform
+    n_fft, lags, i_lags = _align_lags(length_ref, length)
+    ref_fft = np.fft.rfft(signal_ref.astype(float), n_fft, axis=-1)
+    signals_fft = np.fft.rfft(signals_in.astype(float), n_fft, axis=-1)
+    correlation = np.fft.irfft(ref_fft * np.conj(signals_fft), n_fft, axis=-1)[..., i_lags]
+    i_max = np.argmax(correlation, axis=-1)
+    shifts = lags[i_max]
+
+    if subsample:
+        # Fit a parabola to the correlation peak and its neighbors, except at the edges of the lags
+        i_max = np.clip(i_max, 1, len(lags) - 2)[..., np.newaxis]
+        corr_left, corr_peak, corr_right = [np.take_along_axis(correlation, i_max + offset, axis=-1)[..., 0]
+                                            for offset in [-1, 0, 1]]
+        curvature = corr_left - 2 * corr_peak + corr_right
+        is_peak = (curvature < 0) & (shifts > lags[0]) & (shifts < lags[-1])
+        refinement = np.divide(0.5 * (corr_left - corr_right), curvature,
+                               out=np.zeros(shifts.shape), where=is_peak)
+        shifts = shifts + np.clip(refinement, -0.5, 0.5)
+
+    # Each aligned value is taken from an index before it by the shift
+    signals = np.broadcast_to(signals_in, shape_out)
+    i_source = np.arange(length) - shifts[..., np.newaxis]
+    is_aligned = (i_source >= 0) & (i_source <= length - 1)
+    if subsample:
+        i_floor = np.clip(np.floor(i_source).astype(int), 0, length - 1)
+        weight = np.clip(i_source - i_floor, 0, 1)
+        i_ceil = np.clip(i_floor + 1, 0, length - 1)
+        signals_aligned = (1 - weight) * np.take_along_axis(signals, i_floor, axis=-1) \
+            + weight * np.take_along_axis(signals, i_ceil, axis=-1)
+    else:
+        signals_aligned = np.take_along_axis(signals, np.clip(i_source, 0, length - 1), axis=-1)
+    out[...] = signals_aligned
+    out[~is_aligned] = np.nan
+
+    return out, shifts
+
+
 def isolate_spatial(stack_in, roi):
     """Isolate a spatial region of a stack (3-D array, TYX) of grayscale optical data.
 
@@ -382,7 +904,7 @@ def isolate_transients(signal_in, i_start=0, i_end=None):
         """
     if type(signal_in) is not np.ndarray:
         raise TypeError('Signal data type must be an "ndarray"')
-    if signal_in.dtype not in [np.uint16, float]:
+    if signal_in.dtype not in [np.uint16, np.float32, float]:
         raise TypeError('Signal values must either be "uint16" or "float"')
 
     # Calculate the number of transients in the signal
@@ -391,7 +913,7 @@ def isolate_transients(signal_in, i_start=0, i_end=None):
     # Characterize the signal
     unique, counts = np.unique(signal_in, return_counts=True)
 
-    if len(unique) < 10:  # signal is too flat to have a valid peak
+    if len(unique) < UNIQUE_MIN:  # signal is too flat to have a valid peak
         return np.zeros_like(signal_in)
 
     # Find the peaks
@@ -442,7 +964,6 @@ def isolate_transients(signal_in, i_start=0, i_end=None):
     # TODO exclude those with: abnormal rise times, low OWS ...
 
     # With that peak detection, find activation times and align transient
-    shift_max = 0
     for act_num, i_act_full in enumerate(i_acts_full):
         # if crop is 'center':
         # center : crop transients using the cycle length
@@ -455,18 +976,25 @@ def isolate_transients(signal_in, i_start=0, i_end=None):
         signal_align = signal_in[i_t_start:i_t_end]
 
         signal_align = normalize_signal(signal_align)
-        # Use correlation to align the transients
-        shift_max = 0
-        if act_num > 0:
-            signal_align, shift = align_signals(signals_trans_act[0], signal_align)
-            shift_max = np.nanmax([shift_max, abs(shift)])
         signals_trans_act.append(signal_align)
 
-    transients = [sig[:-shift_max] for sig in signals_trans_act]
+    # Use correlation to align the transients to the first, all at once
+    signals_trans_act = _align_transients(signals_trans_act)
+    transients = list(signals_trans_act)
 
     return transients, cycle
 
 
+def _align_transients(signals_trans):
+    """Align isolated transients to the first one, cropped to the shortest and
+    to exclude the values emptied by the largest shift"""
+    length = min(len(signal) for signal in signals_trans)
+    signals_aligned = np.array([signal[:length] for signal in signals_trans], dtype=float)
+    _, shifts = align_signals_fft(signals_aligned[0], signals_aligned[1:], out=signals_aligned[1:])
+    shift_max = int(np.max(np.abs(shifts), initial=0))
+    return signals_aligned[:, :length - shift_max]
+
+
 def filter_spatial(frame_in, filter_type='gaussian', kernel=3):
     """Spatially filter a frame (2-D array, YX) of grayscale optical data.
 
@@ -489,8 +1017,8 @@ def filter_spatial(frame_in, filter_type='gaussian', kernel=3):
         raise TypeError('Frame type must be an "ndarray"')
     if len(frame_in.shape) is not 2:
         raise TypeError('Frame must be a 2-D ndarray (Y, X)')
-    if frame_in.dtype not in [np.uint16, float]:
-        raise TypeError('Frame values must either be "np.uint16" or "float"')
+    if frame_in.dtype not in [np.uint16, np.float32, float]:
+        raise TypeError('Frame values must either be "np.uint16", "np.float32" or "float"')
     if type(filter_type) is not str:
         raise TypeError('Filter type must be a "str"')
     if type(kernel) is not int:
@@ -524,6 +1052,142 @@ def filter_spatial(frame_in, filter_type='gaussian', kernel=3):
     return frame_out.astype(frame_in.dtype)
 
 
+def filter_spatial_stack(stack_in, filter_type='gaussian', kernel=3, out=None, workers=None,
+                         tile_bytes=TILE_BYTES):
+    """Spatially filter each frame of an image stack (3-D array, TYX) of grayscale optical data,
+    equivalent to calling filter_spatial for every frame.
+
+        Parameters
+        ----------
+        stack_in : ndarray
+            A 3-D array (T, Y, X) of optical data, dtype : uint16 or float
+        filter_type : str
+            The type of filter algorithm to use, default is gaussian
+        kernel : int
+            The width and height of the kernel used, must be positive and odd, default is 3
+        out : ndarray, optional
+            An array (T, Y, X) to write the filtered stack into (e.g. stack_in itself for in-place filtering),
+            dtype : stack_in.dtype
+        workers : int, optional
+            The number of threads filtering batches of frames at once, default is None (no threads)
+        tile_bytes : int
+            The memory budget (bytes) of each batch's float64 frames, default is TILE_BYTES
+
+        Returns
+        -------
+        stack_out : ndarray
+            A spatially filtered 3-D array (T, Y, X) of optical data, dtype : stack_in.dtype
+
+        Notes
+        -----
+            Gaussian filters are applied to each batch along its frame axes (1, 2) in one separable pass
+        """
+    # Check parameters
+    if type(stack_in) is not np.ndarray:
+        raise TypeError('Stack type must be an "ndarray"')
+    if stack_in.ndim != 3:
+        raise TypeError('Stack must be a 3-D ndarray (T, Y, X)')
+    if stack_in.dtype not in [np.uint16, np.float32, float]:
+        raise TypeError('Stack values must either be "np.uint16", "np.float32" or "float"')
+    if type(filter_type) is not str:
+        raise TypeError('Filter type must be a "str"')
+    if type(kernel) is not int:
+        raise TypeError('Kernel size must be an "int"')
+    if out is None:
+        out = np.empty_like(stack_in)
+    else:
+        if type(out) is not np.ndarray:
+            raise TypeError('Output stack type must be an "ndarray"')
+        if out.dtype != stack_in.dtype:
+            raise TypeError('Output stack values must be the same dtype as the stack: {}'.format(stack_in.dtype))
+        if out.shape != stack_in.shape:
+            raise ValueError('Output stack shape must be the same as the stack:'
+                             '\nOutput:\t{}\nStack:\t{}'.format(out.shape, stack_in.shape))
+
+    if filter_type not in FILTERS_SPATIAL:
+        raise ValueError('Filter type must be one of the following: {}'.format(FILTERS_SPATIAL))
+    if kernel < 3 or (kernel % 2) == 0:
+        raise ValueError('Kernel size {} px must be >= 3 and odd'.format(kernel))
+    if filter_type == 'best_ever':
+        raise NotImplementedError('Filter type "{}" not implemented'.format(filter_type))
+
+    # Split the frames into batches within the memory budget, enough to keep each thread busy
+    frames = stack_in.shape[0]
+    batches = -(-frames * stack_in[0].size * 8 // tile_bytes)
+    if workers is not None:
+        batches = max(batches, workers * TILES_PER_WORKER)
+    batch_bounds = np.linspace(0, frames, min(batches, frames) + 1).astype(int)
+    batches = [slice(i_start, i_end) for i_start, i_end in zip(batch_bounds[:-1], batch_bounds[1:])]
+
+    def filter_batch(i_batch):
+        if filter_type == 'gaussian':
+            sigma = kernel  # standard deviation of the gaussian kernel
+            batch_out = np.empty(stack_in[i_batch].shape, dtype=float)
+            ndimage.gaussian_filter(stack_in[i_batch], sigma=(0, sigma, sigma), output=batch_out, mode='mirror')
+            out[i_batch] = batch_out
+        else:
+            for i_frame in range(i_batch.start, i_batch.stop):
+                out[i_frame] = filter_spatial(stack_in[i_frame], filter_type=filter_type, kernel=kernel)
+
+    if workers is None:
+        for i_batch in batches:
+            filter_batch(i_batch)
+    else:
+        # Both scipy.ndimage and skimage's rank filters release the GIL
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(filter_batch, batches))
+
+    return out
+
+
+@lru_cache(maxsize=FILTER_CACHE_MAX)
+def filter_temporal_design(sample_rate, freq_cutoff=100.0, filter_order='auto'):
+    """Design (or reuse) the coefficients of a lowpass filter.
+    Designs are cached with LRU eviction, keyed by (sample_rate, freq_cutoff, filter_order).
+
+        Parameters
+        ----------
+        sample_rate : float
+            Sample rate (Hz) of the signals to filter
+        freq_cutoff : float
+            Cutoff frequency (Hz) of the lowpass filter, default is 100
+        filter_order : int or str
+            The order of the filter, default is 'auto'
+            If an int, a Butterworth filter of that order is designed
+            If 'auto', a Kaiser window FIR filter is designed, its order calculated using scipy.signal.kaiserord
+
+        Returns
+        -------
+        b : ndarray
+            The numerator coefficients of the filter
+        a : ndarray
+            The denominator coefficients of the filter, [1.0] for an FIR filter
+
+        Notes
+        -----
+            Arrays are read-only, as they are shared between callers.
+        """
+    nyq_rate = sample_rate / 2.0
+
+    if type(filter_order) is int:
+        # Butterworth (from old code)
+        Wn = freq_cutoff / nyq_rate
+        b, a = butter(filter_order, Wn)
+    else:
+        # FIR 4 design  -
+        # https://www.programcreek.com/python/example/100540/scipy.signal.firwin
+        # Compute the order and Kaiser parameter for the FIR filter.
+        window = 'kaiser'
+        n_order, beta = kaiserord(FILTER_RIPPLE_DB, FILTER_WIDTH / nyq_rate)
+        # Use firwin with a Kaiser window to create a lowpass FIR filter.
+        b = firwin(numtaps=n_order + 1, cutoff=freq_cutoff, window=(window, beta), fs=sample_rate)
+        a = np.array([1.0])
+
+    for coefficients in [b, a]:
+        coefficients.flags.writeable = False
+    return b, a
+
+
 def filter_temporal(signal_in, sample_rate, freq_cutoff=100.0, filter_order='auto'):
     """Apply a lowpass filter to an array of optical data.
 
@@ -547,7 +1211,7 @@ def filter_temporal(signal_in, sample_rate, freq_cutoff=100.0, filter_order='aut
     # Check parameters
     if type(signal_in) is not np.ndarray:
         raise TypeError('Signal data type must be an "ndarray"')
-    if signal_in.dtype not in [np.uint16, float]:
+    if signal_in.dtype not in [np.uint16, np.float32, float]:
         raise TypeError('Signal values must either be "uint16" or "float"')
     if type(sample_rate) is not float:
         raise TypeError('Sample rate must be a "float"')
@@ -556,69 +1220,17 @@ def filter_temporal(signal_in, sample_rate, freq_cutoff=100.0, filter_order='aut
     if type(filter_order) not in [int, str]:
         raise TypeError('Filter type must be an int or str')
 
-    nyq_rate = sample_rate / 2.0
-    n_order = 0
+    if type(filter_order) is str and filter_order != 'auto':
+        raise ValueError('Filter order "{}" not implemented'.format(filter_order))
 
+    b, a = filter_temporal_design(sample_rate, freq_cutoff, filter_order)
     if type(filter_order) is int:
         # Good for ___, but ___
         # Butterworth (from old code)
-        Wn = freq_cutoff / nyq_rate
-        n_order = filter_order
-        [b, a] = butter(n_order, Wn)
         signal_out = filtfilt(b, a, signal_in)
-
-        # # FIR design arguements
-        # Fs = sample_rate           # sample-rate, down-sampled
-        # Norder = filter_order
-        # Ntaps = Norder + 1   # The desired number of taps in the filter
-        # Fpass = 95       # passband edge
-        # Fstop = 105     # stopband edge, transition band 100kHz
-        # Wp = Fpass/Fs    # pass normalized frequency
-        # Ws = Fstop/Fs    # stop normalized frequency
-        # taps = ffd.remez(Ntaps, [0, Wp, Ws, .5], [1, 0], maxiter=10000)
-        # # FIR design arguements
-        # Fpass = 100  # passband edge
-        # Fstop = 105  # stopband edge, transition band __ Hz
-        # R = 25  # how much to down sample by
-        # Fsr = Fs / 25.  # down-sampled sample rate
-        # xs = resample(signal_in, int(len(signal_in) / 25.))
-        # # Down sampled version, create new filter and plot spectrum
-        # R = 4.             # how much to down sample by
-        # Fsr = Fs/R          # down-sampled sample rate
-        # Wp = Fpass / Fsr  # pass normalized frequency
-        # Ws = Fstop / Fsr  # stop normalized frequency
-
-        # signal_filt = lfilter(taps, 1, signal_in)
-        # # signal_filt = filtfilt(taps, 1, signal_in, method="gust")
-        # # signal_filt = minimum_phase(signal_filt, method='hilbert')
-        # signal_out = signal_filt[Norder-1:]
-
-        # ############
-
-    elif filter_order is 'auto':
-        # # FIR 4 design  -
-        # https://www.programcreek.com/python/example/100540/scipy.signal.firwin
-        # https://docs.scipy.org/doc/scipy/reference/generated/scipy.signal.filtfilt.html
-        # Compute the order and Kaiser parameter for the FIR filter.
-        ripple_db = 30.0
-        width = 20  # The desired width of the transition from pass to stop, Hz
-        window = 'kaiser'
-        n_order, beta = kaiserord(ripple_db, width / nyq_rate)
-        # Use firwin with a Kaiser window to create a lowpass FIR filter.
-        taps = firwin(numtaps=n_order + 1, cutoff=freq_cutoff, window=(window, beta), fs=sample_rate)
-        # signal_out = lfilter(taps, 1.0, signal_in)   # for FIR, a=1
-        signal_out = filtfilt(taps, 1, signal_in, method="gust")  # for FIR, a=1
-        # # Savitzky Golay
-        # window_coef = int(nyq_rate / 50)
-        #
-        # if window_coef % 2 > 0:
-        #     window = window_coef
-        # else:
-        #     window = window_coef + 1
-        #
-        # signal_out = savgol_filter(signal_in, window, 3)
     else:
-        raise ValueError('Filter order "{}" not implemented'.format(filter_order))
+        # https://docs.scipy.org/doc/scipy/reference/generated/scipy.signal.filtfilt.html
+        signal_out = filtfilt(b, a, signal_in, method="gust")  # for FIR, a=1
 
     # # Calculate the phase delay of the filtered signal
     # phase_delay = 0.5 * (filter_order - 1) / sample_rate
@@ -627,6 +1239,109 @@ def filter_temporal(signal_in, sample_rate, freq_cutoff=100.0, filter_order='aut
     return signal_out.astype(signal_in.dtype)
 
 
+def filter_temporal_stack(stack_in, sample_rate, freq_cutoff=100.0, filter_order='auto', method='filtfilt',
+                          out=None, tile_bytes=TILE_BYTES):
+    """Apply a lowpass filter to each pixel's signal in a stack of optical data,
+    equivalent to calling filter_temporal for every pixel.
+
+        Parameters
+        ----------
+        stack_in : ndarray
+            A 3-D array (T, Y, X) of optical data, dtype : uint16 or float
+        sample_rate : float
+            Sample rate (Hz) of stack_in
+        freq_cutoff : float
+            Cutoff frequency (Hz) of the lowpass filter, default is 100
+        filter_order : int or str
+            The order of the filter, default is 'auto' (see filter_temporal_design)
+        method : str
+            How the zero-phase filter is applied, default is 'filtfilt'
+            If 'fft', the filter's squared magnitude response is applied in the frequency domain,
+            faster for long recordings and close to filtfilt away from the edges
+        out : ndarray, optional
+            An array (T, Y, X) to write the filtered stack into (e.g. stack_in itself for in-place filtering),
+            dtype : stack_in.dtype
+        tile_bytes : int
+            The memory budget (bytes) of each chunk of rows filtered at once, default is TILE_BYTES
+
+        Returns
+        -------
+        stack_out : ndarray
+            A temporally filtered 3-D array (T, Y, X) of optical data, dtype : stack_in.dtype
+        """
+    # Check parameters
+    if type(stack_in) is not np.ndarray:
+        raise TypeError('Stack type must be an "ndarray"')
+    if len(stack_in.shape) != 3:
+        raise TypeError('Stack must be a 3-D ndarray (T, Y, X)')
+    if stack_in.dtype not in [np.uint16, np.float32, float]:
+        raise TypeError('Stack values must either be "np.uint16", "np.float32" or "float"')
+    if type(sample_rate) is not float:
+        raise TypeError('Sample rate must be a "float"')
+    if type(freq_cutoff) is not float:
+        raise TypeError('Cutoff frequency must be a "float"')
+    if type(filter_order) not in [int, str]:
+        raise TypeError('Filter type must be an int or str')
+    if type(method) is not str:
+        raise TypeError('Method must be a "str"')
+    if out is None:
+        out = np.empty_like(stack_in)
+    else:
+        if type(out) is not np.ndarray:
+            raise TypeError('Output stack type must be an "ndarray"')
+        if out.dtype != stack_in.dtype:
+            raise TypeError('Output stack values must be the same dtype as the stack: {}'.format(stack_in.dtype))
+        if out.shape != stack_in.shape:
+            raise ValueError('Output stack shape must be the same as the stack:'
+                             '\nOutput:\t{}\nStack:\t{}'.format(out.shape, stack_in.shape))
+
+    if type(filter_order) is str and filter_order != 'auto':
+        raise ValueError('Filter order "{}" not implemented'.format(filter_order))
+    if method not in FILTERS_TEMPORAL:
+        raise ValueError('Method must be one of the following: {}'.format(FILTERS_TEMPORAL))
+
+    b, a = filter_temporal_design(sample_rate, freq_cutoff, filter_order)
+    frames, rows = stack_in.shape[:2]
+    if method == 'fft':
+        response = _filter_temporal_response(sample_rate, freq_cutoff, filter_order, frames)
+
+    # Filter chunks of whole rows along the time axis
+    rows_chunk = max(1, tile_bytes // (frames * stack_in.shape[2] * 8))
+    for i_row in range(0, rows, rows_chunk):
+        i_chunk = slice(i_row, min(i_row + rows_chunk, rows))
+        chunk_in = stack_in[:, i_chunk].astype(float)
+        if method == 'fft':
+            out[:, i_chunk] = _filter_temporal_fft(chunk_in, response)
+        elif type(filter_order) is int:
+            out[:, i_chunk] = filtfilt(b, a, chunk_in, axis=0)
+        else:
+            out[:, i_chunk] = filtfilt(b, a, chunk_in, axis=0, method="gust")
+
+    return out
+
+
+@lru_cache(maxsize=FILTER_CACHE_MAX)
+def _filter_temporal_response(sample_rate, freq_cutoff, filter_order, frames):
+    # The padding and squared magnitude (zero-phase) frequency response used to filter signals of a length
+    b, a = filter_temporal_design(sample_rate, freq_cutoff, filter_order)
+    pad = min(3 * max(len(a), len(b)), frames - 1)  # odd extension, as filtfilt's default padding
+    n_fft = next_fast_len(frames + 2 * pad + len(b))
+    response = np.abs(np.fft.rfft(b, n_fft) / np.fft.rfft(a, n_fft)) ** 2
+    response.flags.writeable = False
+    return pad, n_fft, response
+
+
+def _filter_temporal_fft(signals_in, response):
+    # Apply a zero-phase frequency response to a 2-D or 3-D array of signals along axis 0
+    pad, n_fft, response = response
+    # Odd extension at both ends, reflected about the end values
+    signals_ext = np.concatenate((2 * signals_in[0] - signals_in[pad:0:-1], signals_in,
+                                  2 * signals_in[-1] - signals_in[-2:-pad - 2:-1]))
+    response = response.reshape((-1,) + (1,) * (signals_in.ndim - 1))
+    signals_out = np.fft.irfft(np.fft.rfft(signals_ext, n_fft, axis=0) * response, n_fft, axis=0)
+    return signals_out[pad:pad + len(signals_in)]
+
+
 def filter_drift(signal_in, drift_order=2):
     """Remove drift from an array of optical data using the subtraction of a polynomial fit.
 
@@ -648,7 +1363,7 @@ def filter_drift(signal_in, drift_order=2):
     # Check parameters
     if type(signal_in) is not np.ndarray:
         raise TypeError('Signal data type must be an ndarray')
-    if signal_in.dtype not in [np.uint16, float]:
+    if signal_in.dtype not in [np.uint16, np.float32, float]:
         raise TypeError('Signal values type must either be uint16 or float')
     if type(drift_order) not in [int, str]:
         raise TypeError('Drift order must be a "exp" or an int')
@@ -667,11 +1382,11 @@ def filter_drift(signal_in, drift_order=2):
     drift_range = signal_in.max() - signal_in.min()
     drift_out = np.zeros_like(signal_in)
 
-    if drift_range < 5:  # signal is too flat to remove drift
+    if drift_range < DRIFT_RANGE_MIN:  # signal is too flat to remove drift
         return signal_in, drift_out
 
     drift_x = np.arange(start=0, stop=len(signal_in))
-    exp_b_estimates = (0.01, 0.1)  # assumed bounds of the B constant for a decaying exponential fit
+    exp_b_estimates = DRIFT_EXP_B  # assumed bounds of the B constant for a decaying exponential fit
 
     if type(drift_order) is int:
         # np.polyfit : Least squares polynomial fit
@@ -708,6 +1423,151 @@ def filter_drift(signal_in, drift_order=2):
     return signal_out.astype(signal_in.dtype), drift_out
 
 
+def filter_drift_stack(stack_in, drift_order=2, out=None, tile_bytes=TILE_BYTES):
+    """Remove drift from each pixel's signal in a stack of optical data,
+    like calling filter_drift for every pixel.
+
+        Parameters
+        ----------
+        stack_in : ndarray
+            A 3-D array (T, Y, X) of optical data, dtype : uint16 or float
+        drift_order : int or str
+            The order of the polynomial drift to fit to (1 to 5), default is 2
+            If 'exp', a decaying exponential drift is fit (see filter_drift) with a batched
+            Levenberg-Marquardt fit, projected onto the same bounds
+        out : ndarray, optional
+            An array (T, Y, X) to write the corrected stack into (e.g. stack_in itself for in-place removal),
+            dtype : stack_in.dtype
+        tile_bytes : int
+            The memory budget (bytes) of each chunk of rows fit at once, default is TILE_BYTES
+
+        Returns
+        -------
+        stack_out : ndarray
+            A 3-D array (T, Y, X) with drift removed, dtype : stack_in.dtype
+        map_drift : ndarray
+            A 3-D array (P, Y, X) of each pixel's drift parameters, dtype : float
+            the polynomial coefficients (highest power first, as np.polyfit) or the exponential's (a, b, c),
+            NaN where a signal was too flat or its fit failed, leaving it unchanged
+        """
+    # Check parameters
+    if type(stack_in) is not np.ndarray:
+        raise TypeError('Stack type must be an "ndarray"')
+    if len(stack_in.shape) != 3:
+        raise TypeError('Stack must be a 3-D ndarray (T, Y, X)')
+    if stack_in.dtype not in [np.uint16, np.float32, float]:
+        raise TypeError('Stack values must either be "np.uint16", "np.float32" or "float"')
+    if type(drift_order) not in [int, str]:
+        raise TypeError('Drift order must be a "exp" or an int')
+    if out is None:
+        out = np.empty_like(stack_in)
+    else:
+        if type(out) is not np.ndarray:
+            raise TypeError('Output stack type must be an "ndarray"')
+        if out.dtype != stack_in.dtype:
+            raise TypeError('Output stack values must be the same dtype as the stack: {}'.format(stack_in.dtype))
+        if out.shape != stack_in.shape:
+            raise ValueError('Output stack shape must be the same as the stack:'
+                             '\nOutput:\t{}\nStack:\t{}'.format(out.shape, stack_in.shape))
+
+    if type(drift_order) is int:
+        if (drift_order < 1) or (drift_order > 5):
+            raise ValueError('Drift order must be "exp" or an "int" >= 1 and <= 5')
+    if type(drift_order) is str:
+        if drift_order != 'exp':
+            raise ValueError('Drift order "{}" not implemented'.format(drift_order))
+
+    frames, rows, cols = stack_in.shape
+    drift_x = np.arange(start=0, stop=frames)
+    if type(drift_order) is int:
+        # All signals are fit against the same design (Vandermonde) matrix
+        drift_design = np.vander(drift_x, drift_order + 1)
+        params_count = drift_order + 1
+    else:
+        params_count = 3
+    map_drift = np.full((params_count, rows, cols), np.nan)
+
+    # Fit chunks of whole rows, each pixel's signal as a column
+    rows_chunk = max(1, tile_bytes // (frames * cols * 8 * (params_count + 1)))
+    for i_row in range(0, rows, rows_chunk):
+        i_chunk = slice(i_row, min(i_row + rows_chunk, rows))
+        signals = stack_in[:, i_chunk].reshape(frames, -1).astype(float)
+        signals_min, signals_max = signals.min(axis=0), signals.max(axis=0)
+        is_fit = (signals_max - signals_min) >= DRIFT_RANGE_MIN  # other signals are too flat to remove drift
+
+        params = np.full((params_count, signals.shape[1]), np.nan)
+        if type(drift_order) is int:
+            params[:, is_fit] = np.linalg.lstsq(drift_design, signals[:, is_fit], rcond=None)[0]
+            drift = drift_design @ params
+        else:
+            params[:, is_fit] = _drift_exp_fit(drift_x, signals[:, is_fit].T,
+                                               signals_min[is_fit], signals_max[is_fit]).T
+            drift = params[0] * np.exp(-params[1] * drift_x[:, np.newaxis]) + params[2]
+        is_fit = np.isfinite(drift).all(axis=0)
+        params[:, ~is_fit] = np.nan
+
+        signals[:, is_fit] += drift[:, is_fit].min(axis=0) - drift[:, is_fit]
+        out[:, i_chunk] = signals.reshape((frames,) + out[:, i_chunk].shape[1:])
+        map_drift[:, i_chunk] = params.reshape((params_count,) + map_drift[:, i_chunk].shape[1:])
+
+    return out, map_drift
+
+
+def _drift_exp_fit(drift_x, signals_in, signals_min, signals_max):
+    # Fit a*exp(-b*x) + c to each row of a 2-D array (N, T) with a batched Levenberg-Marquardt,
+    # each step projected onto filter_drift's bounds and started from their midpoints, as curve_fit does
+    bounds_lower = np.stack([np.zeros_like(signals_min), np.full_like(signals_min, DRIFT_EXP_B[0]), signals_min], 1)
+    bounds_upper = np.stack([(signals_max - signals_min) * 2, np.full_like(signals_min, DRIFT_EXP_B[1]),
+                             signals_max], 1)
+    params = (bounds_lower + bounds_upper) / 2
+
+    def residuals_jacobian(params_fit, signals_fit):
+        a, b, c = params_fit[:, 0:1], params_fit[:, 1:2], params_fit[:, 2:3]
+        exp_x = np.exp(-b * drift_x)
+        residuals = a * exp_x + c - signals_fit
+        jacobian = np.stack([exp_x, -a * drift_x * exp_x, np.ones_like(exp_x)], axis=2)
+        return residuals, jacobian
+
+    residuals, jacobian = residuals_jacobian(params, signals_in)
+    cost = np.sum(residuals ** 2, axis=1)
+    damping = np.full(len(params), 1e-3)
+    is_fitting = np.ones(len(params), dtype=bool)
+    for iteration in range(DRIFT_ITERATIONS):
+        if not is_fitting.any():
+            break
+        jacobian_t = jacobian[is_fitting].transpose(0, 2, 1)
+        jtj = jacobian_t @ jacobian[is_fitting]
+        jtr = (jacobian_t @ residuals[is_fitting, :, np.newaxis])[:, :, 0]
+        # Parameters held at a bound by the descent direction are left out of the step (active set)
+        params_fitting = params[is_fitting]
+        is_free = ~(((params_fitting <= bounds_lower[is_fitting]) & (jtr > 0)) |
+                    ((params_fitting >= bounds_upper[is_fitting]) & (jtr < 0)))
+        jtj *= is_free[:, :, np.newaxis] & is_free[:, np.newaxis, :]
+        jtj_diag = np.maximum(np.diagonal(jtj, axis1=1, axis2=2), np.finfo(float).tiny)
+        jtj_damped = jtj + (damping[is_fitting, np.newaxis] * jtj_diag + ~is_free)[:, :, np.newaxis] * np.eye(3)
+        step = np.linalg.solve(jtj_damped, -(jtr * is_free)[:, :, np.newaxis])[:, :, 0]
+        params_step = np.clip(params_fitting + step,
+                              bounds_lower[is_fitting], bounds_upper[is_fitting])
+
+        residuals_step, jacobian_step = residuals_jacobian(params_step, signals_in[is_fitting])
+        cost_step = np.sum(residuals_step ** 2, axis=1)
+        # Accept steps that lower the cost and relax their damping, otherwise increase it
+        i_fitting = np.flatnonzero(is_fitting)
+        is_better = cost_step < cost[is_fitting]
+        i_better = i_fitting[is_better]
+        converged = (cost[i_better] - cost_step[is_better]) <= DRIFT_TOLERANCE * cost[i_better]
+        params[i_better] = params_step[is_better]
+        residuals[i_better], jacobian[i_better] = residuals_step[is_better], jacobian_step[is_better]
+        cost[i_better] = cost_step[is_better]
+        damping[i_better] /= 10
+        damping[i_fitting[~is_better]] *= 10
+        # Stop fitting signals that have converged or can no longer be improved
+        is_fitting[i_better[converged]] = False
+        is_fitting[i_fitting[~is_better & (damping[i_fitting] > 1e10)]] = False
+
+    return params
+
+
 def invert_signal(signal_in):
     """Invert the values of a signal array.
 
@@ -724,7 +1584,7 @@ def invert_signal(signal_in):
     # Check parameters
     if type(signal_in) is not np.ndarray:
         raise TypeError('Signal data type must be an "ndarray"')
-    if signal_in.dtype not in [np.uint16, float]:
+    if signal_in.dtype not in [np.uint16, np.float32, float]:
         raise TypeError('Signal values must either be "uint16" or "float"')
 
     unique, counts = np.unique(signal_in, return_counts=True)
@@ -742,38 +1602,56 @@ def invert_signal(signal_in):
     return signal_out
 
 
-def invert_stack(stack_in):
-    """Invert the values of an image stack (3-D array).
+def invert_stack(stack_in, out=None, tile_bytes=TILE_BYTES, progress=None):
+    """Invert the values of an image stack (3-D array),
+    equivalent to calling invert_signal for every pixel.
 
         Parameters
         ----------
         stack_in : ndarray
-            Image stack with shape (T, Y, X)
+            Image stack with shape (T, Y, X), dtype : uint16 or float
+        out : ndarray, optional
+            An array (T, Y, X) to write the inverted stack into (e.g. stack_in itself for in-place inversion)
+        tile_bytes : int
+            The memory budget (bytes) of each block of frames inverted at once, default is TILE_BYTES
+        progress : function, optional
+            Called as progress(done, total) with the number of frames inverted, once per block of frames
 
         Returns
         -------
         stack_out : ndarray
-            A cropped 3-D array (T, Y, X) of optical data, dtype : float
+            An inverted 3-D array (T, Y, X) of optical data, dtype : stack_in.dtype or out.dtype
         """
     # Check parameters
     if type(stack_in) is not np.ndarray:
         raise TypeError('Stack type must be an "ndarray"')
     if len(stack_in.shape) is not 3:
         raise TypeError('Stack must be a 3-D ndarray (T, Y, X)')
-    if stack_in.dtype not in [np.uint16, float]:
-        raise TypeError('Stack values must either be "np.uint16" or "float"')
+    if stack_in.dtype not in [np.uint16, np.float32, float]:
+        raise TypeError('Stack values must either be "np.uint16", "np.float32" or "float"')
+    if out is None:
+        out = np.empty_like(stack_in)
+    else:
+        if type(out) is not np.ndarray:
+            raise TypeError('Output stack type must be an "ndarray"')
+        if out.shape != stack_in.shape:
+            raise ValueError('Output stack shape must be the same as the stack:'
+                             '\nOutput:\t{}\nStack:\t{}'.format(out.shape, stack_in.shape))
 
-    stack_out = np.empty_like(stack_in)
-    map_shape = stack_in.shape[1:]
-    # Assign a value to each pixel
-    for iy, ix in np.ndindex(map_shape):
-        print('\r\tInversion of Row:\t{}\t/ {}\tx\tCol:\t{}\t/ {}'.format(iy + 1, map_shape[0], ix + 1, map_shape[1]),
-              end='', flush=True)
-        pixel_data = stack_in[:, iy, ix]
-        pixel_data_inv = invert_signal(pixel_data)
-        stack_out[:, iy, ix] = pixel_data_inv
+    # Calculate the axis to rotate each pixel's data around (middle value float), before out is written
+    map_min = stack_in.min(axis=0)
+    map_axis = map_min + ((stack_in.max(axis=0) - map_min) / 2)
 
-    return stack_out
+    # Rotate blocks of frames around their axes, bounding the float intermediate
+    frames = stack_in.shape[0]
+    frames_block = max(1, tile_bytes // (map_axis.size * map_axis.itemsize))
+    for i_frame in range(0, frames, frames_block):
+        i_block = slice(i_frame, min(i_frame + frames_block, frames))
+        out[i_block] = map_axis + (map_axis - stack_in[i_block])
+        if progress is not None:
+            progress(i_block.stop, frames)
+
+    return out
 
 
 def normalize_signal(signal_in):
@@ -800,7 +1678,7 @@ def normalize_signal(signal_in):
 
     unique, counts = np.unique(signal_in, return_counts=True)
 
-    if len(unique) < 10:  # signal is too flat to have a valid peak
+    if len(unique) < UNIQUE_MIN:  # signal is too flat to have a valid peak
         return np.zeros_like(signal_in)
 
     xp = [signal_in.min(), signal_in.max()]
@@ -810,38 +1688,63 @@ def normalize_signal(signal_in):
     return signal_out
 
 
-def normalize_stack(stack_in):
-    """Normalize the values of an image stack (3-D array) to range from 0 to 1..
+def normalize_stack(stack_in, dtype=None, out=None):
+    """Normalize the values of an image stack (3-D array) to range from 0 to 1,
+    equivalent to calling normalize_signal for every pixel.
 
         Parameters
         ----------
         stack_in : ndarray
             Image stack with shape (T, Y, X), dtype : uint16 or float
+        dtype : type, optional
+            The dtype of the normalized stack, np.float32 or float, default is get_precision()
+        out : ndarray, optional
+            An array (T, Y, X) to write the normalized stack into (e.g. stack_in itself for in-place normalization),
+            dtype : float or np.float32, overrides dtype
 
         Returns
         -------
         stack_out : ndarray
-            A normalized image stack (T, Y, X), dtype : float
+            A normalized image stack (T, Y, X), dtype : np.float32 or float
+
+        Notes
+        -----
+            Pixels too flat to have a valid peak (see map_valid) are set to 0
         """
     # Check parameters
     if type(stack_in) is not np.ndarray:
         raise TypeError('Stack type must be an "ndarray"')
     if len(stack_in.shape) is not 3:
         raise TypeError('Stack must be a 3-D ndarray (T, Y, X)')
-    if stack_in.dtype not in [np.uint16, float]:
-        raise TypeError('Stack values must either be "np.uint16" or "float"')
+    if stack_in.dtype not in [np.uint16, float, np.float32]:
+        raise TypeError('Stack values must either be "np.uint16", "np.float32" or "float"')
+    if out is None:
+        if dtype is None:
+            dtype = get_precision()
+        if dtype not in PRECISIONS + [float]:
+            raise TypeError('Normalized stack values must either be "float" or "np.float32"')
+        out = np.empty(stack_in.shape, dtype=dtype)
+    else:
+        if type(out) is not np.ndarray:
+            raise TypeError('Output stack type must be an "ndarray"')
+        if out.dtype not in [float, np.float32]:
+            raise TypeError('Output stack values must either be "float" or "np.float32"')
+        if out.shape != stack_in.shape:
+            raise ValueError('Output stack shape must be the same as the stack:'
+                             '\nOutput:\t{}\nStack:\t{}'.format(out.shape, stack_in.shape))
 
-    stack_out = np.empty_like(stack_in, dtype=float)
-    map_shape = stack_in.shape[1:]
-    # Assign a value to each pixel
-    for iy, ix in np.ndindex(map_shape):
-        # print('\r\tNormalizing Row:\t{}\t/ {}\tx\tCol:\t{}\t/ {}'.format(iy + 1, map_shape[0], ix, map_shape[1]),
-        #       end='', flush=True)
-        pixel_data = stack_in[:, iy, ix]
-        pixel_data_norm = normalize_signal(pixel_data)
-        stack_out[:, iy, ix] = pixel_data_norm
+    # Per-pixel limits are found before out is written, as it may be stack_in
+    map_min = stack_in.min(axis=0)
+    map_range = stack_in.max(axis=0).astype(out.dtype) - map_min
+    map_flat = ~map_valid(stack_in)
+    map_range[map_flat] = 1
 
-    return stack_out
+    # Scale by each pixel's slope (1 / range), as np.interp does
+    np.subtract(stack_in, map_min, out=out, dtype=out.dtype)
+    np.multiply(out, 1 / map_range, out=out)
+    out[:, map_flat] = 0
+
+    return out
 
 
 def calc_ff0(signal_in):
@@ -864,7 +1767,7 @@ def calc_ff0(signal_in):
     # Check parameters
     if type(signal_in) is not np.ndarray:
         raise TypeError('Signal data type must be an "ndarray"')
-    if signal_in.dtype not in [np.uint16, float]:
+    if signal_in.dtype not in [np.uint16, np.float32, float]:
         raise TypeError('Signal values must either be "int" or "float"')
 
     # F / F0: (F_t - F0) / F0
@@ -927,6 +1830,18 @@ def calculate_snr(signal_in, noise_count=10):
         # raise ArithmeticError('No peaks detected'.format(len(i_peaks), i_peaks))
         return np.nan, np.nan, np.nan, np.nan, np.nan, np.nan
 
+    # Find noise values
+    x_df, df_spline = spline_deriv(signal_in)
+    i_noise_calc = _tran_baselines(signal_in, i_peak, df_spline)
+
+    return _tran_snr(signal_in, i_peak, i_noise_calc)
+
+
+def _tran_snr(signal_in, i_peak, i_noise_calc):
+    # SNR results (see calculate_snr) of a signal, given its peak index and baseline (noise) indexes
+    if i_peak is np.nan:
+        return np.nan, np.nan, np.nan, np.nan, np.nan, np.nan
+
     # Characterize the signal
     signal_bounds = (signal_in.min(), signal_in.max())
 
@@ -936,9 +1851,6 @@ def calculate_snr(signal_in, noise_count=10):
     # Use the peak value
     peak_value = signal_in[i_peak_calc]
 
-    # Find noise values
-    i_noise_calc = find_tran_baselines(signal_in)
-
     if i_noise_calc is np.nan or len(i_noise_calc) < 5:
         return np.nan, np.nan, np.nan, np.nan, np.nan, np.nan
     data_noise = signal_in[i_noise_calc]
@@ -968,7 +1880,331 @@ def calculate_snr(signal_in, noise_count=10):
     return snr, rms_bounds, peak_peak, sd_noise, ir_noise, ir_peak
 
 
-def map_snr(stack_in, noise_count=10):
+def calculate_snr_signals(signals_in, i_peaks=None, i_starts=None, i_ends=None):
+    """Calculate the Signal-to-Noise ratios of many signal arrays at once,
+    equivalent to calling calculate_snr for every signal
+
+        Parameters
+        ----------
+        signals_in : ndarray
+            A 2-D array (N, T) of N signal arrays, dtype : uint16 or float
+        i_peaks : ndarray, optional
+            The index of each signal's peak, or NaN (see find_tran_peaks), found if not provided
+        i_starts, i_ends : ndarray, optional
+            The first and after-last baseline (noise) indexes of each signal, or NaN
+            (see find_tran_baselines_signals), found if not provided
+
+        Returns
+        -------
+        snr : ndarray
+             The Signal-to-Noise ratio of each signal, dtype : float
+        rms_bounds : ndarray
+             A 2-D array (2, N) of the RMSs of each signal's noise and peak, dtype : float
+        peak_peak : ndarray
+             The absolute difference between the RMSs of each signal's peak and noise, dtype : float
+        sd_noise : ndarray
+             The standard deviation of each signal's noise values, dtype : float
+
+        Notes
+        -----
+            Signals with incalculable SNRs are assigned NaN
+        """
+    # Check parameters
+    if type(signals_in) is not np.ndarray:
+        raise TypeError('Signals data type must be an "ndarray"')
+    if len(signals_in.shape) != 2:
+        raise TypeError('Signals must be a 2-D ndarray (N, T)')
+
+    if i_peaks is None:
+        i_peaks = find_tran_peaks(signals_in)
+    if i_starts is None or i_ends is None:
+        i_starts, i_ends = find_tran_baselines_signals(signals_in, i_peaks)
+    n_signals = len(signals_in)
+    snr, peak_peak, sd_noise = np.full(n_signals, np.nan), np.full(n_signals, np.nan), np.full(n_signals, np.nan)
+    rms_bounds = np.full((2, n_signals), np.nan)
+
+    noise_counts = i_ends - i_starts
+    is_found = ~np.isnan(i_peaks) & (noise_counts >= BASELINES_MIN)
+    signals = signals_in[is_found].astype(float)
+    i_peak = i_peaks[is_found].astype(int)
+    i_start, noise_count = i_starts[is_found].astype(int), noise_counts[is_found].astype(int)
+
+    # Gather each signal's noise values, padded with NaN to the longest baseline
+    i_noise = i_start[:, np.newaxis] + np.arange(noise_count.max(initial=0))
+    is_noise = i_noise < (i_start + noise_count)[:, np.newaxis]
+    data_noise = np.take_along_axis(signals, np.where(is_noise, i_noise, 0), axis=1)
+    data_noise[~is_noise] = np.nan
+
+    # Use noise values and their RMS
+    noise_mean = np.nansum(data_noise, axis=1) / noise_count
+    noise_rms = np.sqrt(noise_mean ** 2)
+    if signals_in.dtype == np.uint16:
+        # Sums of integer values are exact, leaving one rounding of the variance, as statistics.stdev does
+        # (Python 3.11 also rounds its square root once, which can differ in the last digit)
+        noise_sums = np.nansum(data_noise, axis=1), np.nansum(data_noise ** 2, axis=1)
+        noise_sd = np.sqrt((noise_count * noise_sums[1] - noise_sums[0] ** 2) / (noise_count * (noise_count - 1)))
+    else:
+        noise_sd = np.sqrt(np.nansum((data_noise - noise_mean[:, np.newaxis]) ** 2, axis=1) / (noise_count - 1))
+    # Use the peak value
+    peak_value = signals[np.arange(len(signals)), i_peak]
+
+    # Calculate Peak-Peak value
+    found_peak_peak = np.abs(peak_value - noise_rms)
+
+    # Exclusions
+    is_flat = noise_sd == 0
+    noise_sd[is_flat] = found_peak_peak[is_flat] / 200  # Noise data too flat to detect SD
+    signals_max = signals.max(axis=1, initial=-np.inf)
+    if (signals_max < noise_rms).any():
+        i_signal = np.argmax(signals_max < noise_rms)
+        raise ValueError('Signal max {} seems to be < noise rms {}'.format(signals_max[i_signal], noise_rms[i_signal]))
+
+    # Calculate SNR
+    snr[is_found] = found_peak_peak / noise_sd
+    # RMSs are converted to the signals' dtype, as calculate_snr does
+    rms_bounds[:, is_found] = np.stack((noise_rms, peak_value)).astype(signals_in.dtype)
+    peak_peak[is_found] = found_peak_peak
+    sd_noise[is_found] = noise_sd
+
+    return snr, rms_bounds, peak_peak, sd_noise
+
+
+# Stack shared with this worker process, attached once by _pool_attach
+_pool_shm = None
+_pool_stack = None
+
+
+def _pool_attach(shm_name, shape, dtype):
+    """Attach a worker process to a stack in shared memory"""
+    global _pool_shm, _pool_stack
+    _pool_shm = shared_memory.SharedMemory(name=shm_name)
+    _pool_stack = np.ndarray(shape, dtype=dtype, buffer=_pool_shm.buf)
+
+
+def _pool_tile(tile_func, i_tile, tile, kwargs):
+    """Apply a tile function to a tile of the shared stack"""
+    (y0, y1), (x0, x1) = tile
+    return i_tile, tile_func(_pool_stack[:, y0:y1, x0:x1], **kwargs)
+
+
+def _pool_tile_star(args):
+    return _pool_tile(*args)
+
+
+def tile_bounds(map_shape, pixel_bytes, tile_bytes=TILE_BYTES, tiles_min=1):
+    """Split a map into tiles of whole rows, or parts of a row, that fit a memory budget
+
+        Parameters
+        ----------
+        map_shape : tuple
+            The height and width (px) of the map
+        pixel_bytes : int
+            The number of bytes needed to process one pixel
+        tile_bytes : int
+            The memory budget (bytes) of each tile, default is TILE_BYTES
+        tiles_min : int
+            The minimum number of tiles, default is 1
+
+        Returns
+        -------
+        tiles : list
+            The ((y0, y1), (x0, x1)) bounds of each tile, in row-major order
+        """
+    if type(tile_bytes) is not int:
+        raise TypeError('Tile bytes must be an "int"')
+    if tile_bytes < 1:
+        raise ValueError('Tile bytes must be >= 1')
+
+    height, width = map_shape
+    tile_pixels = min(tile_bytes // pixel_bytes, -(-height * width // tiles_min))
+    tile_pixels = max(1, tile_pixels)
+    if tile_pixels >= width:
+        tile_shape = (tile_pixels // width, width)
+    else:
+        tile_shape = (1, tile_pixels)
+
+    tiles = [((y, min(y + tile_shape[0], height)), (x, min(x + tile_shape[1], width)))
+             for y in range(0, height, tile_shape[0]) for x in range(0, width, tile_shape[1])]
+    return tiles
+
+
+def map_tiles(stack_in, tile_func, workers=None, tile_bytes=TILE_BYTES, progress=None, cancel=None, maps=None,
+              **kwargs):
+    """Apply a function to spatial tiles of a stack and assemble the results,
+    optionally with a pool of worker processes sharing the stack in memory
+
+        Parameters
+        ----------
+        stack_in : ndarray
+            A 3-D array (T, Y, X) of optical data
+        tile_func : function
+            A module-level function accepting a 3-D tile (T, y, x) and kwargs,
+            returning an array whose last two axes are (y, x), e.g. a 2-D map or a 3-D stack
+        workers : int, optional
+            The number of worker processes to use, default is None (the calling process only)
+        tile_bytes : int
+            The memory budget (bytes) of each tile's pixel data as float64, default is TILE_BYTES
+        progress : function, optional
+            Called as progress(done, total) with the number of tiles completed
+        cancel : threading.Event, optional
+            Checked between tiles, once set the remaining tiles are abandoned
+        maps : dict, optional
+            2-D arrays (Y, X) of per-pixel values, each tile's part passed to tile_func by keyword
+        **kwargs
+            Passed to tile_func, must be picklable when using workers
+
+        Returns
+        -------
+        result : ndarray
+            The assembled tile results, last two axes (Y, X)
+
+        Raises
+        ------
+        CancelledError
+            If cancel was set before all tiles were completed
+
+        Notes
+        -----
+            Workers read pixel data from multiprocessing.shared_memory, only tile bounds and results are pickled.
+            Falls back to the calling process if shared memory is unavailable (Python < 3.8)
+        """
+    # Check parameters
+    if not isinstance(stack_in, np.ndarray):
+        raise TypeError('Stack type must be an "ndarray"')
+    if len(stack_in.shape) != 3:
+        raise TypeError('Stack must be a 3-D ndarray (T, Y, X)')
+    if workers is not None:
+        if type(workers) is not int:
+            raise TypeError('Workers must be an "int"')
+        if workers < 1:
+            raise ValueError('Workers must be >= 1')
+    if maps is not None:
+        for name, map_in in maps.items():
+            if np.shape(map_in) != stack_in.shape[1:]:
+                raise ValueError('Map "{}" shape must be the same as the stack frames:'
+                                 '\nMap:\t{}\nFrame:\t{}'.format(name, np.shape(map_in), stack_in.shape[1:]))
+    if workers is None or shared_memory is None:
+        workers = 1
+
+    tiles_min = 1 if workers == 1 else workers * TILES_PER_WORKER
+    tiles = tile_bounds(stack_in.shape[1:], stack_in.shape[0] * np.dtype(float).itemsize, tile_bytes, tiles_min)
+    result = None
+
+    def tile_kwargs(i_tile):
+        if maps is None:
+            return kwargs
+        (y0, y1), (x0, x1) = tiles[i_tile]
+        return dict(kwargs, **{name: map_in[y0:y1, x0:x1] for name, map_in in maps.items()})
+
+    def assemble(i_tile, result_tile, done):
+        nonlocal result
+        if result is None:
+            result = np.empty(result_tile.shape[:-2] + stack_in.shape[1:], dtype=result_tile.dtype)
+        (y0, y1), (x0, x1) = tiles[i_tile]
+        result[..., y0:y1, x0:x1] = result_tile
+        if progress is not None:
+            progress(done + 1, len(tiles))
+
+    if workers == 1:
+        for done, ((y0, y1), (x0, x1)) in enumerate(tiles):
+            if cancel is not None and cancel.is_set():
+                raise CancelledError('Mapping cancelled after {} / {} tiles'.format(done, len(tiles)))
+            assemble(done, tile_func(stack_in[:, y0:y1, x0:x1], **tile_kwargs(done)), done)
+        return result
+
+    shm = shared_memory.SharedMemory(create=True, size=max(stack_in.nbytes, 1))
+    try:
+        stack_shared = np.ndarray(stack_in.shape, dtype=stack_in.dtype, buffer=shm.buf)
+        stack_shared[:] = stack_in
+        del stack_shared
+        with Pool(min(workers, len(tiles)), initializer=_pool_attach,
+                  initargs=(shm.name, stack_in.shape, stack_in.dtype.str)) as pool:
+            results = pool.imap_unordered(_pool_tile_star,
+                                          [(tile_func, i_tile, tile, tile_kwargs(i_tile))
+                                           for i_tile, tile in enumerate(tiles)])
+            for done, (i_tile, result_tile) in enumerate(results):
+                if cancel is not None and cancel.is_set():
+                    # leaving the pool terminates the remaining workers
+                    raise CancelledError('Mapping cancelled after {} / {} tiles'.format(done, len(tiles)))
+                assemble(i_tile, result_tile, done)
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return result
+
+
+def map_valid(stack_in, mask=None, tile_bytes=TILE_BYTES):
+    """Map the pixels of a stack that can be analyzed,
+    i.e. those not masked and with a signal that is not too flat to have a valid peak
+
+        Parameters
+        ----------
+        stack_in : ndarray
+            A 3-D array (T, Y, X) of optical data, dtype : uint16 or float
+        mask : ndarray, optional
+            A binary 2-D array (Y, X) of masked pixels (see mask_apply), dtype : np.bool_
+        tile_bytes : int
+            The memory budget (bytes) of each tile (see map_tiles), default is TILE_BYTES
+
+        Returns
+        -------
+        map_out : ndarray
+            A 2-D array (Y, X) of analyzable pixels, dtype : np.bool_
+
+        Notes
+        -----
+            Signals must vary and have at least UNIQUE_MIN distinct values,
+            the same test applied to each signal by find_tran_peak
+        """
+    # Check parameters
+    if not isinstance(stack_in, np.ndarray):
+        raise TypeError('Stack type must be an "ndarray"')
+    if len(stack_in.shape) != 3:
+        raise TypeError('Stack must be a 3-D ndarray (T, Y, X)')
+    if mask is not None:
+        if type(mask) is not np.ndarray:
+            raise TypeError('Mask type must be an "ndarray"')
+        if mask.shape != stack_in.shape[1:]:
+            raise ValueError('Mask shape must be the same as the stack frames:'
+                             '\nMask:\t{}\nFrame:\t{}'.format(mask.shape, stack_in.shape[1:]))
+
+    map_out = map_tiles(stack_in, _map_valid_tile, tile_bytes=tile_bytes)
+    if mask is not None:
+        map_out &= ~mask.astype(bool)
+
+    return map_out
+
+
+def _map_valid_tile(stack_in):
+    """Map the analyzable pixels in a tile of a stack"""
+    # Flat pixels (e.g. masked ones) are excluded before counting distinct values
+    map_out = np.ptp(stack_in, axis=0) > 0
+    # Most signals have enough distinct values within their first frames, only the rest are counted in full
+    map_counted = _count_unique(stack_in[:UNIQUE_FRAMES, map_out]) >= UNIQUE_MIN
+    map_uncounted = map_out.copy()
+    map_uncounted[map_out] = ~map_counted
+    map_out[map_uncounted] = _count_unique(stack_in[:, map_uncounted]) >= UNIQUE_MIN
+    return map_out
+
+
+def _count_unique(signals_in):
+    # Number of distinct values in each column of a 2-D array (T, N)
+    signals_sorted = np.sort(signals_in, axis=0)
+    return np.count_nonzero(np.diff(signals_sorted, axis=0), axis=0) + 1
+
+
+def _map_baselines_tile(stack_in):
+    """Map the transient peak index, and the first and after-last baseline indexes,
+    of each pixel in a tile of a stack (see find_tran_baselines_signals)"""
+    signals = stack_in.reshape(stack_in.shape[0], -1).T
+    i_peaks = find_tran_peaks(signals)
+    i_starts, i_ends = find_tran_baselines_signals(signals, i_peaks)
+    return np.stack((i_peaks, i_starts, i_ends)).reshape((3,) + stack_in.shape[1:])
+
+
+def map_snr(stack_in, noise_count=10, workers=None, tile_bytes=TILE_BYTES, progress=None, cancel=None,
+            components=False):
     """Generate a map_out of Signal-to-Noise ratios for signal arrays within a stack,
     defined as the ratio of the Peak-Peak amplitude to the population standard deviation of the noise.
 
@@ -978,11 +2214,23 @@ def map_snr(stack_in, noise_count=10):
             A 3-D array (T, Y, X) of optical data, dtype : uint16 or float
         noise_count : int
              The number of noise values to be used in the calculation, default is 10
+        workers : int, optional
+             The number of worker processes to use (see map_tiles), default is None
+        tile_bytes : int
+             The memory budget (bytes) of each tile (see map_tiles), default is TILE_BYTES
+        progress : function, optional
+             Called as progress(done, total) between tiles (see map_tiles)
+        cancel : threading.Event, optional
+             Checked between tiles, once set a CancelledError is raised (see map_tiles)
+        components : bool
+             Whether to also map the components of each SNR, default is False
 
         Returns
         -------
         map : ndarray
              A 2-D array of Signal-to-Noise ratios, dtype : float
+             or if components, a 3-D array (5, Y, X) of maps stacked in the order of SNR_COMPONENTS
+             (see calculate_snr_signals), dtype : float
 
         Notes
         -----
@@ -993,30 +2241,33 @@ def map_snr(stack_in, noise_count=10):
         raise TypeError('Stack type must be an "ndarray"')
     if len(stack_in.shape) is not 3:
         raise TypeError('Stack must be a 3-D ndarray (T, Y, X)')
-    if stack_in.dtype not in [np.uint16, float]:
-        raise TypeError('Stack values must either be "np.uint16" or "float"')
+    if stack_in.dtype not in [np.uint16, np.float32, float]:
+        raise TypeError('Stack values must either be "np.uint16", "np.float32" or "float"')
 
     if type(noise_count) is not int:
         raise TypeError('Noise count must be an "int"')
+    if noise_count < 0:
+        raise ValueError('Noise count must be >= 0')
+    if noise_count >= stack_in.shape[0]:
+        raise ValueError('Number of noise values to use must be < length of signal array')
 
     # print('Generating SNR map ...')
-    map_shape = stack_in.shape[1:]
-    map_out = np.empty(map_shape)
-    # Assign an SNR to each pixel
-    for iy, ix in np.ndindex(map_shape):
-        # print('\r\tRow:\t{}\t/ {}\tx\tCol:\t{}\t/ {}'.format(iy + 1, map_shape[0], ix + 1, map_shape[1]),
-        #       end='', flush=True)
-        pixel_data = stack_in[:, iy, ix]
-        # # Characterize the signal
-        # signal_bounds = (pixel_data.min(), pixel_data.max())
-        # signal_range = signal_bounds[1] - signal_bounds[0]
-
-        snr, rms_bounds, peak_peak, sd_noise, ir_noise, ir_peak = calculate_snr(pixel_data, noise_count)
-        # Set every pixel's values to the SNR of the signal at that pixel
-        map_out[iy, ix] = snr
+    maps_out = map_tiles(stack_in, _map_snr_tile, workers=workers, tile_bytes=tile_bytes,
+                         progress=progress, cancel=cancel, noise_count=noise_count)
 
     # print('\nDONE Mapping SNR')
-    return map_out
+    if components:
+        return maps_out
+    return maps_out[0]
+
+
+def _map_snr_tile(stack_in, noise_count):
+    """Map the SNR, and its components, of each pixel in a tile of a stack (see SNR_COMPONENTS)"""
+    signals = stack_in.reshape(stack_in.shape[0], -1).T
+    i_peaks, i_starts, i_ends = _map_baselines_tile(stack_in).reshape(3, -1)
+    snr, rms_bounds, peak_peak, sd_noise = calculate_snr_signals(signals, i_peaks, i_starts, i_ends)
+    maps_out = np.stack((snr, rms_bounds[0], rms_bounds[1], peak_peak, sd_noise))
+    return maps_out.reshape((len(SNR_COMPONENTS),) + stack_in.shape[1:])
 
 
 def calc_ensemble(time_in, signal_in, crop='center'):
@@ -1061,7 +2312,7 @@ def calc_ensemble(time_in, signal_in, crop='center'):
         raise TypeError('Time values must either be "int" or "float"')
     if type(signal_in) is not np.ndarray:
         raise TypeError('Signal data type must be an "ndarray"')
-    if signal_in.dtype not in [np.uint16, float]:
+    if signal_in.dtype not in [np.uint16, np.float32, float]:
         raise TypeError('Signal values must either be "uint16" or "float"')
 
     # Calculate the number of transients in the signal
@@ -1069,7 +2320,7 @@ def calc_ensemble(time_in, signal_in, crop='center'):
     signal_bounds = (signal_in.min(), signal_in.max())
     unique, counts = np.unique(signal_in, return_counts=True)
 
-    if len(unique) < 10:  # signal is too flat to have a valid peak
+    if len(unique) < UNIQUE_MIN:  # signal is too flat to have a valid peak
         raise ArithmeticError('Signal is too flat to detect peaks')
 
     # Find the peaks
@@ -1158,14 +2409,10 @@ def calc_ensemble(time_in, signal_in, crop='center'):
             signal_align = signal_in[i_align:i_align + (crop[1] - crop[0])]
 
         signal_align = normalize_signal(signal_align)
-        # Use correlation to tighten alignment
-        shift_max = 0
-        if act_num > 0:
-            signal_align, shift = align_signals(signals_trans_act[0], signal_align)
-            shift_max = np.nanmax([shift_max, abs(shift)])
         signals_trans_act.append(signal_align)
 
-    signals_trans_act = [sig[:-shift_max] for sig in signals_trans_act]
+    # Use correlation to tighten alignment, all at once
+    signals_trans_act = list(_align_transients(signals_trans_act))
     # use the lowest activation time
     # cycle_shift = min(min(i_acts), cycle_shift)
     # for act_num, act in enumerate(i_acts):
@@ -1184,13 +2431,14 @@ def calc_ensemble(time_in, signal_in, crop='center'):
     return signal_time, signal_out, signals, i_peaks, i_acts, est_cycle
 
 
-def calc_ensemble_stack(time_in, stack_in):
+def calc_ensemble_stack(time_in, stack_in, reference=None, beats=None, workers=None, tile_bytes=TILE_BYTES,
+                        progress=None, cancel=None):
     """Convert a stack from pixels with multiple transients to those with an averaged signal,
     segmented by activation times. Discards the first and last transients.
 
-        # 1) Confirm the brightest pixel has enough peaks
-        # 2) Find pixel(s) with earliest second peak
-        # 3) Use the cycle time and end time of that peak's left baseline to align all ensembled signals
+        # 1) Segment the beats once, using the activation times of a reference signal
+        # 2) Gather every beat of every pixel, delayed by an activation map if provided
+        # 3) Align each pixel's beats to its first one by FFT cross-correlation, and average them
 
         Parameters
         ----------
@@ -1198,109 +2446,356 @@ def calc_ensemble_stack(time_in, stack_in):
             The array of timestamps (ms) corresponding to signal_in, dtyoe : int or float
         stack_in : ndarray
             A 3-D array (T, Y, X) of an optical transient, dtype : uint16 or float
+        reference : ndarray, optional
+            The signal (T) to segment beats with, default is the mean signal of all analyzable pixels
+            or an activation map (Y, X) of indexes, shifting each pixel's beats by its delay from the earliest
+            (segmented with the default reference signal)
+        beats : BeatTable, optional
+            The beats of the stack (see segment_beats), reusing its segmentation instead of a reference signal's
+        workers : int, optional
+            The number of worker processes to use (see map_tiles), default is None
+        tile_bytes : int
+            The memory budget (bytes) of each tile (see map_tiles), default is TILE_BYTES
+        progress : function, optional
+            Called as progress(done, total) between tiles (see map_tiles)
+        cancel : threading.Event, optional
+            Checked between tiles, once set a CancelledError is raised (see map_tiles)
 
         Returns
         -------
         stack_out : ndarray
-             A spatially isolated 3-D array (T, Y, X) of optical data, dtype : float
+             A 3-D array (T, Y, X) of each pixel's normalized ensemble, one cycle long, dtype : get_precision()
+        ensemble_crop : tuple
+             The first and after-last indexes of the first beat used
+        ensemble_yx : tuple
+             The pixel (row-major first) with the earliest ensembled peak
 
         Notes
         -----
             Should not be applied to signal data containing at least one transient.
             Pixels with incalculable ensembles are assigned an array of zeros
         """
+    # Check parameters
+    if type(time_in) is not np.ndarray:
+        raise TypeError('Time data type must be an "ndarray"')
+    if type(stack_in) is not np.ndarray:
+        raise TypeError('Stack type must be an "ndarray"')
+    if len(stack_in.shape) != 3:
+        raise TypeError('Stack must be a 3-D ndarray (T, Y, X)')
+    if stack_in.dtype not in [np.uint16, np.float32, float]:
+        raise TypeError('Stack values must either be "np.uint16", "np.float32" or "float"')
+    if reference is not None:
+        if type(reference) is not np.ndarray:
+            raise TypeError('Reference type must be an "ndarray"')
+        if reference.shape not in [stack_in.shape[:1], stack_in.shape[1:]]:
+            raise ValueError('Reference must be a signal (T) or an activation map (Y, X) of the stack:'
+                             '\nReference:\t{}\nStack:\t{}'.format(reference.shape, stack_in.shape))
+    if beats is not None:
+        if type(beats) is not BeatTable:
+            raise TypeError('Beats type must be a "BeatTable"')
+        if beats.shape != stack_in.shape[1:]:
+            raise ValueError('Beats must be segmented from the stack:'
+                             '\nBeats:\t{}\nStack:\t{}'.format(beats.shape, stack_in.shape))
+    if len(time_in) != stack_in.shape[0]:
+        raise ValueError('Time and stack must have the same length')
+
+    map_analyzable = map_valid(stack_in, tile_bytes=tile_bytes)
+    map_delay = np.zeros(stack_in.shape[1:], dtype=int)
+    if reference is not None and reference.shape == stack_in.shape[1:]:
+        map_analyzable &= ~np.isnan(reference)
+        if map_analyzable.any():
+            map_delay[map_analyzable] = np.round(reference[map_analyzable] - reference[map_analyzable].min())
+        reference = None
+
+    # 1) Segment the beats using the peaks and activations of the reference
+    if beats is None:
+        if reference is None:
+            # the mean signal of all analyzable pixels
+            if not map_analyzable.any():
+                raise ArithmeticError('No analyzable pixels to ensemble')
+            reference = _mean_signal(stack_in, map_analyzable)
+        i_starts, ensemble_cycle = _segment_beats(reference)
+    else:
+        i_starts, ensemble_cycle = beats.windows.astype(int), beats.cycle
+    # keep the beats whose delayed windows fit within the stack
+    i_starts = i_starts[i_starts + ensemble_cycle + map_delay.max() <= stack_in.shape[0]]
+    if len(i_starts) < 2:
+        raise ArithmeticError('Only {} complete beat(s) detected, 2 are needed to ensemble'.format(len(i_starts)))
+    ensemble_crop = (int(i_starts[0]), int(i_starts[0] + ensemble_cycle))
+
+    # 2) & 3) for each pixel ...
+    stack_out = map_tiles(stack_in, _ensemble_tile, workers=workers, tile_bytes=tile_bytes,
+                          progress=progress, cancel=cancel,
+                          maps={'map_analyzable': map_analyzable, 'map_delay': map_delay},
+                          i_starts=i_starts, length=ensemble_cycle, dtype=get_precision())
+
+    # the first pixel (row-major) with the earliest ensembled peak
+    map_peak = np.where(map_analyzable, np.argmax(stack_out, axis=0), stack_out.shape[0])
+    ensemble_yx = tuple(int(i) for i in np.unravel_index(np.argmin(map_peak), map_peak.shape))
 
-    print('Ensembling a stack ...')
-    map_shape = stack_in.shape[1:]
-    i_peak_0_min = stack_in.shape[0]
-    yx_peak_1_min = (0, 0)
-    i_peak_1_min = stack_in.shape[0]
-
-    # for each pixel ...
-    for iy, ix in np.ndindex(map_shape):
-        print('\r\tPeak Search of Row:\t{}\t/ {}\tx\tCol:\t{}\t/ {}'.format(
-            iy + 1, map_shape[0], ix + 1, map_shape[1]), end='', flush=True)
-        # Get first half of signal to save time
-        pixel_data = stack_in[:int(stack_in.shape[0]), iy, ix]
-        # Characterize the signal
-        signal_bounds = (pixel_data.min(), pixel_data.max())
-        signal_range = signal_bounds[1] - signal_bounds[0]
-        unique, counts = np.unique(pixel_data, return_counts=True)
-
-        if len(unique) < 10:  # signal is too flat to have a valid peak
-            continue
-
-        # Find the peaks
-        # i_peaks, _ = find_peaks(pixel_data, prominence=signal_range / 4,
-        #                         distance=20)
-        i_peaks, _ = find_tran_peak(pixel_data, props=True)
-
-        if i_peaks is np.nan:
-            continue
-        if len(i_peaks) < 4:
-            # raise ArithmeticError('No peaks detected'.format(len(i_peaks), i_peaks))
-            # np.zeros_like(pixel_data)
-            continue
-        # if len(i_peaks) > 3:
-        #     print('* {} peaks detected at {} in signal_in'.format(len(i_peaks), i_peaks))
-        # else:
-        #     raise ValueError('Only {} peak detected at {} in signal_in'.format(len(i_peaks), i_peaks))
-
-        # 2) Find pixel(s) with earliest second peak
-        # find the first peak and preserve the minimum among all pixels
-        if i_peaks[0] < i_peak_0_min:
-            i_peak_0_min = i_peaks[0]
-            i_peak_1_min = i_peaks[1]
-            yx_peak_1_min = (iy, ix)
-        # i_peak_1_min = max(i_peaks[1], i_peak_1_min)
-
-    # calculating alignment crop needed to preserve activation propagation
-    pixel_data = stack_in[:, yx_peak_1_min[0], yx_peak_1_min[1]]
-
-    i_peaks, _ = find_tran_peak(pixel_data, props=True)
+    return stack_out, ensemble_crop, ensemble_yx
 
-    # Split up the signal using peaks and estimated cycle length
-    est_cycle = np.diff(i_peaks).astype(float)
-    est_cycle_i = np.nanmean(est_cycle)
-    est_cycle_i = np.floor(est_cycle_i).astype(int)
-    # est_cycle = est_cycle_i * np.nanmean(np.diff(time_in))
-    # cycle_shift = np.floor(est_cycle_i / 2).astype(int)
-
-    peak_1_min_crop = (i_peak_1_min - est_cycle_i, i_peak_1_min + est_cycle_i)
-    pixel_data_peak_1_min = pixel_data[peak_1_min_crop[0]: peak_1_min_crop[1]]
-
-    # i_peak_1_min_baselines_l = find_tran_baselines(pixel_data_peak_1_min, peak_side='left')
-    # i_peak_1_min_baselines_r = find_tran_baselines(pixel_data_peak_1_min, peak_side='right')
-
-    # ensemble_crop = (i_peak_1_min_baselines_l[-1], i_peak_1_min_baselines_r[1])
-    # ensemble_crop = (i_peak_1_min_baselines_l[1] + peak_1_min_crop[0],
-    #                  i_peak_1_min_baselines_r[-1] + peak_1_min_crop[0])
-    ensemble_crop = peak_1_min_crop
-    ensemble_crop_len = ensemble_crop[1] - ensemble_crop[0]
-
-    # 3) Use the cycle time and time of that peak to align all ensembled signals
-    # for each pixel ...
-    stack_out = np.empty_like(stack_in[:ensemble_crop_len, :, :], dtype=float)
-
-    for iy, ix in np.ndindex(map_shape):
-        print('\r\tEnsemble of Row:\t{}\t/ {}\tx\tCol:\t{}\t/ {}'.format(iy + 1, map_shape[0], ix + 1, map_shape[1]),
-              end='', flush=True)
-        # get signal
-        pixel_data = stack_in[:, iy, ix]
-        unique, counts = np.unique(pixel_data, return_counts=True)
-        if len(unique) < 10:  # signal is too flat to have a valid peak
-            signal_ensemble = np.zeros_like(pixel_data[:ensemble_crop_len])
-        else:
-            # calculate the ensemble of it
-            time_ensemble, signal_ensemble, signals, signal_peaks, signal_acts, est_cycle_length \
-                = calc_ensemble(time_in, pixel_data, crop=ensemble_crop)
 
-        stack_out[:, iy, ix] = signal_ensemble
+def _mean_signal(stack_in, map_analyzable):
+    """The mean signal of all analyzable pixels of a stack"""
+    return np.tensordot(stack_in, map_analyzable.astype(float), axes=2) / np.count_nonzero(map_analyzable)
 
-    ensemble_yx = yx_peak_1_min
-    print('\nDONE Ensembling stack')
 
-    return stack_out, ensemble_crop, ensemble_yx
+def _segment_beats(reference):
+    """Segment the beats of a multi-transient reference signal, using its peaks and activations.
+    Returns the first index of each complete beat's window, and the windows' length (its cycle length)"""
+    i_peaks, ensemble_cycle = _ensemble_peaks(reference)
+    cycle_shift = np.floor(ensemble_cycle / 2).astype(int)
+    i_acts = []
+    for i_peak in i_peaks:
+        i_beat = max(i_peak - cycle_shift, 0)
+        i_act = find_tran_act(reference[i_beat:i_peak + cycle_shift])
+        i_acts.append(i_peak if i_act is np.nan else i_beat + i_act)
+    i_starts = np.array(i_acts) - int(ensemble_cycle * ENSEMBLE_LEAD)
+    # keep the beats whose windows fit within the signal
+    i_starts = i_starts[(i_starts >= 0) & (i_starts + ensemble_cycle <= len(reference))]
+    return i_starts, ensemble_cycle
+
+
+def _ensemble_peaks(signal_in):
+    """Find the peaks of a multi-transient signal (as calc_ensemble does), without the first and last,
+    and its cycle length (indexes)"""
+    signal_mean = np.nanmean(signal_in)
+    prominence = (signal_in.max() - signal_mean) * 0.8
+    i_peaks, properties = find_peaks(signal_in, height=signal_mean, prominence=prominence,
+                                     distance=ENSEMBLE_DISTANCE_MIN)
+    if len(i_peaks) < 4:
+        raise ArithmeticError('Only {} peak(s) detected, 4 are needed to ensemble'.format(len(i_peaks)))
+    # do not use the first and last peaks
+    i_peaks = i_peaks[1:-1]
+    ensemble_cycle = int(np.floor(np.mean(np.diff(i_peaks))))
+    return i_peaks, ensemble_cycle
+
+
+def _ensemble_tile(stack_in, i_starts, length, map_analyzable, map_delay, dtype):
+    """Ensemble each pixel in a tile of a stack, given its beats' first indexes"""
+    signals = stack_in.reshape(stack_in.shape[0], -1)
+    analyzable = map_analyzable.ravel()
+    i_pixel = np.flatnonzero(analyzable)
+    # Gather every beat of every pixel (beats, length, pixels)
+    i_beats = i_starts[:, np.newaxis, np.newaxis] + np.arange(length)[:, np.newaxis] + map_delay.ravel()[i_pixel]
+    beats = signals[i_beats, i_pixel].astype(float)
+    # normalized from 0 to 1, as calc_ensemble does
+    beats_min = beats.min(axis=1, keepdims=True)
+    beats_range = beats.max(axis=1, keepdims=True) - beats_min
+    beats = np.divide(beats - beats_min, beats_range, out=np.zeros_like(beats), where=beats_range > 0)
+
+    # Use correlation with each pixel's first beat to tighten alignment, shifted beats are filled with NaN
+    beats = beats.transpose(2, 0, 1)  # (pixels, beats, length)
+    align_signals_fft(beats[:, :1], beats, out=beats)
+
+    # use the mean of all aligned beats
+    beats_count = np.count_nonzero(~np.isnan(beats), axis=1)
+    ensembles = np.divide(np.nansum(beats, axis=1), beats_count, out=np.zeros((len(i_pixel), length)),
+                          where=beats_count > 0).T
+    # signals too flat to have a valid peak are left as zeros
+    stack_out = np.zeros((length, signals.shape[1]), dtype=dtype)
+    stack_out[:, analyzable] = ensembles
+    return stack_out.reshape((length,) + stack_in.shape[1:])
+
+
+class BeatTable:
+    """Landmark indexes (start, activation, peak and end) of every beat in every pixel of a stack,
+    segmented once (see segment_beats) and reused by every beat-resolved analysis
+
+        Parameters
+        ----------
+        landmarks : ndarray
+            A 4-D array (4, B, Y, X) of each pixel's landmark indexes for B beats, in the order of BEAT_LANDMARKS,
+            or BEAT_NONE if incalculable, dtype : int32
+        windows : ndarray
+            The first index of each beat's window, as segmented from the reference signal, dtype : int32
+        cycle : int
+            The length (indexes) of every beat window, the reference signal's estimated cycle length
+
+        Attributes
+        ----------
+        starts, activations, peaks, ends : ndarray
+            3-D arrays (B, Y, X) of each landmark's indexes, views of landmarks
+        beats : int
+            The number of beats, B
+        shape : tuple
+            The shape of a frame, (Y, X)
+
+        Notes
+        -----
+            Landmark indexes are frames of the whole stack, not of the beat windows.
+            Use save(file_path) and BeatTable.load(file_path) to reuse a table between sessions.
+        """
+
+    def __init__(self, landmarks, windows, cycle):
+        # Check parameters
+        if type(landmarks) is not np.ndarray:
+            raise TypeError('Landmarks data type must be an "ndarray"')
+        if type(windows) is not np.ndarray:
+            raise TypeError('Windows data type must be an "ndarray"')
+        if len(landmarks.shape) != 4 or landmarks.shape[0] != len(BEAT_LANDMARKS):
+            raise ValueError('Landmarks must be a 4-D ndarray ({}, B, Y, X)'.format(len(BEAT_LANDMARKS)))
+        if windows.shape != landmarks.shape[1:2]:
+            raise ValueError('Windows must have one index per beat:'
+                             '\nWindows:\t{}\nBeats:\t{}'.format(windows.shape, landmarks.shape[1]))
+
+        self.landmarks = landmarks.astype(np.int32, copy=False)
+        self.windows = windows.astype(np.int32, copy=False)
+        self.cycle = int(cycle)
+        self.starts, self.activations, self.peaks, self.ends = self.landmarks
+
+    @property
+    def beats(self):
+        return self.landmarks.shape[1]
+
+    @property
+    def shape(self):
+        return self.landmarks.shape[2:]
+
+    def landmark(self, name):
+        """A landmark's indexes (see BEAT_LANDMARKS), with NaN if incalculable, dtype : float"""
+        landmark = self.landmarks[BEAT_LANDMARKS.index(name)]
+        return np.where(landmark == BEAT_NONE, np.nan, landmark)
+
+    def cycle_lengths(self):
+        """The number of indexes between each beat's and the next beat's activation (B - 1, Y, X)"""
+        activations = self.landmark('activation')
+        return np.diff(activations, axis=0)
+
+    def durations(self):
+        """The number of indexes between each beat's activation and end (B, Y, X)"""
+        return self.landmark('end') - self.landmark('activation')
+
+    def diastolic_intervals(self):
+        """The number of indexes between each beat's end and the next beat's activation (B - 1, Y, X)"""
+        return self.landmark('activation')[1:] - self.landmark('end')[:-1]
+
+    def save(self, file_path):
+        """Save the table as a compressed NumPy file, ".npz" is appended to file_path if missing"""
+        np.savez_compressed(file_path, landmarks=self.landmarks, windows=self.windows, cycle=self.cycle)
+
+    @classmethod
+    def load(cls, file_path):
+        """Load a table saved with BeatTable.save"""
+        with np.load(file_path) as table:
+            return cls(table['landmarks'], table['windows'], int(table['cycle']))
+
+
+def segment_beats(stack_in, reference=None, workers=None, tile_bytes=TILE_BYTES, progress=None, cancel=None):
+    """Find the landmarks of every beat in every pixel of a stack of multi-transient optical data,
+    segmenting the beats once for all pixels. Discards the first and last transients.
+
+        Parameters
+        ----------
+        stack_in : ndarray
+            A 3-D array (T, Y, X) of optical data, dtype : uint16 or float
+        reference : ndarray, optional
+            The signal (T) to segment beats with, default is the mean signal of all analyzable pixels
+        workers : int, optional
+            The number of worker processes to use (see map_tiles), default is None
+        tile_bytes : int
+            The memory budget (bytes) of each tile (see map_tiles), default is TILE_BYTES
+        progress : function, optional
+            Called as progress(done, total) between tiles (see map_tiles)
+        cancel : threading.Event, optional
+            Checked between tiles, once set a CancelledError is raised (see map_tiles)
+
+        Returns
+        -------
+        beats : BeatTable
+            The start, activation, peak and end indexes of each beat of each pixel
+
+        Notes
+        -----
+            Beat windows are one cycle long, beginning before the reference's activations (see ENSEMBLE_LEAD).
+            Within each window, a pixel's peak is found as find_tran_peaks does, its start is the first index of
+            its pre-upstroke baseline (see find_tran_baselines_signals), its activation is found as find_tran_act
+            does, and its end is the first index after the peak that returns to the baseline's mean.
+        """
+    # Check parameters
+    if type(stack_in) is not np.ndarray:
+        raise TypeError('Stack type must be an "ndarray"')
+    if len(stack_in.shape) != 3:
+        raise TypeError('Stack must be a 3-D ndarray (T, Y, X)')
+    if stack_in.dtype not in [np.uint16, np.float32, float]:
+        raise TypeError('Stack values must either be "np.uint16", "np.float32" or "float"')
+    if reference is not None:
+        if type(reference) is not np.ndarray:
+            raise TypeError('Reference type must be an "ndarray"')
+        if reference.shape != stack_in.shape[:1]:
+            raise ValueError('Reference must be a signal (T) of the stack:'
+                             '\nReference:\t{}\nStack:\t{}'.format(reference.shape, stack_in.shape))
+
+    map_analyzable = map_valid(stack_in, tile_bytes=tile_bytes)
+    if reference is None:
+        # the mean signal of all analyzable pixels
+        if not map_analyzable.any():
+            raise ArithmeticError('No analyzable pixels to segment')
+        reference = _mean_signal(stack_in, map_analyzable)
+    i_windows, cycle = _segment_beats(reference)
+    if len(i_windows) < 1:
+        raise ArithmeticError('No complete beats detected')
+
+    landmarks = map_tiles(stack_in, _beats_tile, workers=workers, tile_bytes=tile_bytes,
+                          progress=progress, cancel=cancel, maps={'map_analyzable': map_analyzable},
+                          i_windows=i_windows, length=cycle)
+    return BeatTable(landmarks, i_windows, cycle)
+
+
+def _beats_tile(stack_in, i_windows, length, map_analyzable):
+    """Landmarks (see BEAT_LANDMARKS) of every beat of each pixel in a tile of a stack, given the beats' windows"""
+    signals = stack_in.reshape(stack_in.shape[0], -1)
+    analyzable = map_analyzable.ravel()
+    i_pixel = np.flatnonzero(analyzable)
+    n_beats = len(i_windows)
+    landmarks = np.full((len(BEAT_LANDMARKS), n_beats, signals.shape[1]), BEAT_NONE, dtype=np.int32)
+    if len(i_pixel) == 0:
+        return landmarks.reshape(landmarks.shape[:2] + stack_in.shape[1:])
+
+    # Gather every beat of every pixel as a signal (pixels * beats, length)
+    i_beats = i_windows[:, np.newaxis] + np.arange(length)
+    beats = signals[i_beats[:, :, np.newaxis], i_pixel].transpose(2, 0, 1).reshape(-1, length).astype(float)
+    i_peaks = find_tran_peaks(beats)
+    x_spline, beats_spline, beats_df, beats_df2 = spline_signals(beats)
+    i_starts, i_ends = find_tran_baselines_signals(beats, i_peaks, beats_df)
+
+    is_found = ~np.isnan(i_peaks) & ~np.isnan(i_starts)
+    is_peak = ~np.isnan(i_peaks)
+    i_peak = np.where(is_peak, i_peaks, 0).astype(int)
+    i_start = np.where(is_found, i_starts, 0).astype(int)
+    i_end = np.where(is_found, i_ends, 1).astype(int)
+    i_signal = np.arange(length)
+    rows = np.arange(len(beats))
+
+    # the Signal-to-Noise ratio used by find_tran_act, from the baselines' mean and standard deviation
+    is_baseline = (i_signal >= i_start[:, np.newaxis]) & (i_signal < i_end[:, np.newaxis])
+    n_baselines = is_baseline.sum(axis=1)
+    baselines_mean = np.where(is_baseline, beats, 0).sum(axis=1) / np.maximum(n_baselines, 1)
+    baselines_dev = np.where(is_baseline, beats - baselines_mean[:, np.newaxis], 0)
+    baselines_sd = np.sqrt((baselines_dev ** 2).sum(axis=1) / np.maximum(n_baselines - 1, 1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        snr = (beats[rows, i_peak] - np.abs(baselines_mean)) / baselines_sd
+
+    # the 1st derivative max between the last baseline index and the peak
+    i_df = np.arange(beats_df.shape[1])
+    in_search = (i_df >= ((i_end - 1) * SPLINE_FIDELITY)[:, np.newaxis]) & \
+                (i_df < (i_peak * SPLINE_FIDELITY)[:, np.newaxis])
+    i_act = np.argmax(np.where(in_search, beats_df, -np.inf), axis=1) // SPLINE_FIDELITY
+    is_act = is_found & ~(snr < SNR_MIN) & in_search.any(axis=1)
+
+    # the first index after the peak at or below the baselines' mean
+    is_recovered = (beats <= np.abs(baselines_mean)[:, np.newaxis]) & (i_signal > i_peak[:, np.newaxis])
+    i_recovered = np.argmax(is_recovered, axis=1)
+    is_recovered = is_found & is_recovered.any(axis=1)
+
+    # beat indexes of each landmark, as stack indexes, in the order of BEAT_LANDMARKS
+    i_offset = np.tile(i_windows, len(i_pixel))
+    for i_landmark, (landmark, is_landmark) in enumerate(
+            [(i_start, is_found), (i_act, is_act), (i_peak, is_peak), (i_recovered, is_recovered)]):
+        landmark_found = np.where(is_landmark, landmark + i_offset, BEAT_NONE)
+        landmarks[i_landmark][:, analyzable] = landmark_found.reshape(len(i_pixel), n_beats).T
+    return landmarks.reshape(landmarks.shape[:2] + stack_in.shape[1:])
 
 
 def calculate_error(ideal, modified):